@@ -0,0 +1,105 @@
+"""Micro-benchmark of the TFTP DATA packet send path.
+
+Compares the legacy createDATA() path, which packs a new bytes object for
+every block, against the scatter/gather path that sends a reused header buffer
+and a memoryview of the payload with socket.sendmsg().
+
+Run from the programmer directory:
+
+    python -m benchmarks.bench_data_send [--size BYTES] [--blksize N]
+"""
+
+import argparse
+import socket
+import threading
+import time
+import tracemalloc
+
+from tftp import proto
+
+
+def _drain(sock, stop):
+    buf = bytearray(65536)
+    while not stop.is_set():
+        try:
+            sock.recv_into(buf)
+        except socket.timeout:
+            pass
+
+
+def send_createDATA(sock, addr, image, blksize):
+    for num, offset in enumerate(range(0, len(image), blksize), 1):
+        packet = proto.TFTPHelper.createDATA(num & 0xFFFF,
+                                             image[offset:offset + blksize])
+        sock.sendto(packet, addr)
+
+
+def send_vector(sock, addr, image, blksize):
+    header = bytearray(proto.DATA_HEADER.size)
+    for num, offset in enumerate(range(0, len(image), blksize), 1):
+        packet = proto.TFTPHelper.createDATAVector(
+                num & 0xFFFF, image[offset:offset + blksize], header)
+        sock.sendmsg(packet, [], 0, addr)
+
+
+def allocations_per_block(send, sock, addr, image, blksize):
+    """Return the number of bytes transiently allocated to send a block, as
+    seen by tracemalloc. Objects allocated for a block are released before
+    the next one, so the peak over several blocks is the per-block cost."""
+    blocks = image[:blksize * 64]
+    tracemalloc.start()
+    try:
+        send(sock, addr, blocks, blksize)  # warm up
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        send(sock, addr, blocks, blksize)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak - current
+
+
+def run(send, sock, addr, image, blksize, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        send(sock, addr, image, blksize)
+    elapsed = time.perf_counter() - start
+    return len(image) * rounds / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024,
+                        help='image size in bytes')
+    parser.add_argument('--blksize', type=int, default=1468)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    image = memoryview(bytes(args.size))
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(0.1)
+    addr = receiver.getsockname()
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    stop = threading.Event()
+    drain = threading.Thread(target=_drain, args=(receiver, stop))
+    drain.daemon = True
+    drain.start()
+
+    print('%d bytes image, blksize %d' % (args.size, args.blksize))
+    for name, send in (('createDATA + sendto', send_createDATA),
+                       ('header + sendmsg', send_vector)):
+        rate = run(send, sender, addr, image, args.blksize, args.rounds)
+        alloc = allocations_per_block(send, sender, addr, image,
+                                      args.blksize)
+        print('  %-20s %8.1f MB/s  %6d bytes allocated/block'
+              % (name, rate / 1e6, alloc))
+
+    stop.set()
+    drain.join()
+
+
+if __name__ == '__main__':
+    main()
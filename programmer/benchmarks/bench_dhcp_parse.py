@@ -0,0 +1,173 @@
+"""Benchmark of the DHCP request parser.
+
+Times the handling of the frames captured in bootp/test_bootpPacket.py by
+bootp.DHCPPacket, as DHCPServer uses it, and by a reference implementation,
+the copying parser the module used to have, and reports the frames per
+second of both:
+
+    retransmit  parse a request, and look up its reply cache key
+    request     parse a request, and look its fields up as DHCPServer does
+    reject ...  reject a frame which is not a DHCP request
+
+Measures of the reference and current parsers are interleaved, and the best
+one of each kept, so that the results hold on a busy machine.
+
+Run from the programmer directory:
+
+    python -m benchmarks.bench_dhcp_parse [--number N] [--repeat N]
+"""
+
+import argparse
+import struct
+import timeit
+
+from bootp import Constants
+from bootp import DHCPPacket
+from bootp.test_bootpPacket import (INVALID_ETH_PROTOCOL, INVALID_IP_PROTOCOL,
+                                    VALID)
+
+# Number of times DHCPServer looks the vendor class of a request up.
+DHCP_SERVER_VENDOR_CLASS_LOOKUPS = 4
+
+
+class Reference(object):
+    """The reference parser."""
+
+    def __init__(self, pkt):
+        # Setup Defaults
+        self.unknown_options = []
+        self.is_pxe_request = False
+        self.requested_ip = None
+        # BOOTP Requests do no have the DCHP_OPTION_OP, so assume it's
+        # Discover unless otherwise stated.
+        self.op = Constants.DHCP_OP_DHCPDISCOVER
+        self.vendor_class = 'unknown'
+
+        # Check the ethernet type. It needs to be IP (0x800).
+        if struct.unpack('!H', pkt[12:14])[0] != Constants.ETHERNET_IP_PROTO:
+            raise DHCPPacket.NotDhcpPacketError("Invalid Ethernet Protocol")
+        self.server_mac, self.client_mac = pkt[0:6], pkt[6:12]
+
+        # Strip off the ethernet frame and check the IP packet type. It should
+        # be UDP (0x11)
+        pkt = pkt[14:]
+        if pkt[9] != Constants.IP_UDP_PROTO:
+            raise DHCPPacket.NotDhcpPacketError("Not UDP Protocol")
+
+        # Strip off the IP header and check the source/destination ports in the
+        # UDP datagram. The packet should be from port 68 to port 67 to
+        # tentatively be DHCP.
+        header_len = (pkt[0] & 0xF) * 4
+        pkt = pkt[header_len:]
+        (src, dst) = struct.unpack('!2H', pkt[:4])
+        if not (src == 68 and dst == 67):
+            raise DHCPPacket.NotDhcpPacketError("Invalid src/dest port")
+
+        # Looks like a DHCP request. Parse out the interesting data from the
+        # base DHCP packet and check that the magic cookie is right.
+        dhcp_fmt = '!12xL20x6s202xL'
+        dhcp_size = struct.calcsize(dhcp_fmt)
+        (xid, mac, cookie) = struct.unpack(dhcp_fmt, pkt[:dhcp_size])
+
+        if cookie != Constants.DHCP_MAGIC_COOKIE or self.client_mac != mac:
+            raise DHCPPacket.NotDhcpPacketError("Invalid magic cookie")
+
+        self.xid = xid
+
+        self.uuid = 'not specified'
+
+        self._parse_dhcp_options(pkt[dhcp_size:])
+
+    def _parse_dhcp_options(self, options):
+        for option, value in DHCPPacket._dhcp_options(options):
+            if option == Constants.DHCP_OPTION_OP:
+                self.op = ord(value)
+                # We only care about interesting "incoming" DHCP ops.
+                if self.op not in (Constants.DHCP_OP_DHCPDISCOVER,
+                                   Constants.DHCP_OP_DHCPREQUEST):
+                    raise DHCPPacket.UninterestingDhcpPacket()
+            elif (option in (Constants.DHCP_OPTION_CLIENT_UUID,
+                             Constants.DHCP_OPTION_CLIENT_UUID2) and
+                  len(value[1:]) == DHCPPacket.DHCP_CLIENT_UUID_LENGTH):
+                # First byte of the UUID is \0
+                self.uuid = DHCPPacket._unpack_uuid(value[1:])
+            elif option == Constants.DHCP_OPTION_VENDOR_CLASS_ID:
+                self.vendor_class = value.decode('utf-8')
+            elif option == Constants.DHCP_OPTION_REQUESTED_IP:
+                self.requested_ip = DHCPPacket._unpack_ip(value)
+            else:
+                # Keep them around, in case other code feels like
+                # being knowledgeable.
+                self.unknown_options.append((option, value))
+
+
+def retransmit(parser, frame):
+    """Parse a request, and look its reply cache key up."""
+    pkt = parser(frame)
+    return pkt.client_mac, pkt.xid, pkt.op
+
+
+def request(parser, frame):
+    """Parse a request, and look its fields up as DHCPServer does."""
+    pkt = parser(frame)
+    for _ in range(DHCP_SERVER_VENDOR_CLASS_LOOKUPS - 1):
+        pkt.vendor_class
+    return (pkt.op, pkt.xid, pkt.client_mac, pkt.vendor_class, pkt.uuid,
+            pkt.requested_ip)
+
+
+def reject_reference(frame):
+    try:
+        Reference(frame)
+    except DHCPPacket.NotDhcpPacketError:
+        return False
+    return True
+
+
+CASES = [
+    ('retransmit', VALID, lambda frame: retransmit(Reference, frame),
+     lambda frame: retransmit(DHCPPacket.DhcpPacket.parse, frame)),
+    ('request', VALID, lambda frame: request(Reference, frame),
+     lambda frame: request(DHCPPacket.DhcpPacket.parse, frame)),
+    ('reject eth', INVALID_ETH_PROTOCOL, reject_reference,
+     DHCPPacket.DhcpPacket.parse),
+    ('reject ip', INVALID_IP_PROTOCOL, reject_reference,
+     DHCPPacket.DhcpPacket.parse),
+]
+
+
+def run(number, repeat):
+    """Return the (case, reference time, current time) results, in seconds
+    per frame."""
+    results = []
+    for name, frame, reference, current in CASES:
+        times = ([], [])
+        for _ in range(repeat):
+            for function, measures in zip((reference, current), times):
+                measures.append(timeit.timeit(lambda: function(frame),
+                                              number=number) / number)
+        results.append((name, min(times[0]), min(times[1])))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--number', type=int, default=20000,
+                        help='calls per measure')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='measures per case, the best one is kept')
+    args = parser.parse_args()
+
+    assert (request(Reference, VALID) ==
+            request(DHCPPacket.DhcpPacket, VALID))
+
+    print('%-12s %14s %14s %7s' % ('case', 'reference/s', 'current/s',
+                                   'speedup'))
+    for name, reference, current in run(args.number, args.repeat):
+        print('%-12s %14.0f %14.0f %6.1fx' % (name, 1 / reference,
+                                              1 / current,
+                                              reference / current))
+
+
+if __name__ == '__main__':
+    main()
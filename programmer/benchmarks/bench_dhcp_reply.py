@@ -0,0 +1,68 @@
+"""Benchmark of the DHCP reply encoding.
+
+Times the encoding of OFFER and ACK replies from scratch, as
+DHCPServer._encode_dhcp_reply does, and from the precomputed frames of
+bootp.ReplyTemplate, and reports the replies per second of both.
+
+Run from the programmer directory:
+
+    python -m benchmarks.bench_dhcp_reply [--number N] [--repeat N]
+"""
+
+import argparse
+import timeit
+from collections import namedtuple
+
+from bootp import Constants
+from bootp.DHCPServer import DHCPServer
+from bootp.ReplyTemplate import ReplyTemplates
+
+Request = namedtuple('Request', 'op xid client_mac')
+
+REQUESTS = [
+    (Request(Constants.DHCP_OP_DHCPDISCOVER, 0x0c550101,
+             b'\xc8\xdf\x84\xaf\x98\x88'), '192.168.4.2', 'u-boot-spl-restore.bin'),
+    (Request(Constants.DHCP_OP_DHCPREQUEST, 0x0c550102,
+             b'\xc8\xdf\x84\xaf\x98\x88'), '192.168.4.2', 'u-boot-restore.img'),
+]
+
+
+def build(request_pkt, client_ip, filename):
+    return DHCPServer._encode_dhcp_reply(request_pkt, client_ip, filename,
+                                         'de:ad:be:ef:00:11', '192.168.4.1',
+                                         '255.255.255.0', '192.168.4.1',
+                                         '192.168.4.1', None)
+
+
+def measure(encode, number, repeat):
+    """Return the best time to encode a reply, in seconds."""
+    def run():
+        for request, client_ip, filename in REQUESTS:
+            encode(request, client_ip, filename)
+    return min(timeit.repeat(run, number=number,
+                             repeat=repeat)) / number / len(REQUESTS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--number', type=int, default=20000,
+                        help='calls per measure')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='measures per encoder, the best one is kept')
+    args = parser.parse_args()
+
+    templates = ReplyTemplates(build)
+    for request, client_ip, filename in REQUESTS:
+        assert templates.encode(request, client_ip, filename) == \
+            build(request, client_ip, filename)
+
+    before = measure(build, args.number, args.repeat)
+    after = measure(templates.encode, args.number, args.repeat)
+    print('%-10s %12s %10s' % ('encoder', 'replies/s', 'per reply'))
+    print('%-10s %12.0f %8.0fns' % ('encoded', 1 / before, before * 1e9))
+    print('%-10s %12.0f %8.0fns' % ('templates', 1 / after, after * 1e9))
+    print('speedup: %.1fx' % (before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""Micro-benchmarks of the TFTP packet codecs, with regression thresholds.
+
+Every codec of tftp.proto is timed against a reference implementation, the
+straightforward format-string based codecs the module used to have. Codecs
+are compared by their speed relative to the reference, rather than by their
+absolute speed, so that the thresholds hold on any machine: a codec slower
+than its threshold times the reference is reported as a regression, and makes
+the run exit with status 1. Timings depend on the load of the machine, so the
+check is not part of the unit tests: run it on purpose, e.g. from a dedicated
+CI job. A codec only regressed if it is too slow in every one of --runs runs.
+
+Run from the programmer directory:
+
+    python -m benchmarks.bench_proto [--number N] [--repeat N] [--runs N]
+"""
+
+import argparse
+import struct
+import sys
+import timeit
+
+from tftp import proto
+from tftp.proto import TFTPHelper
+
+
+class Reference(object):
+    """The reference codecs."""
+
+    @staticmethod
+    def createRRQ(filename, mode, opts):
+        packet = struct.pack('!H%dsc%dsc' % (len(filename), len(mode)),
+                             proto.OP_RRQ,
+                             filename.encode('ascii'), b'\0',
+                             mode.encode('ascii'), b'\0')
+        for opt, val in opts.items():
+            packet += struct.pack('!%dsc%dsc' % (len(opt), len(str(val))),
+                                  opt.encode('ascii'), b'\0',
+                                  str(val).encode('ascii'), b'\0')
+        return packet
+
+    @staticmethod
+    def createACK(num):
+        return struct.pack('!HH', proto.OP_ACK, num)
+
+    @staticmethod
+    def createERROR(errno, errmsg=None):
+        error = proto.TFTP_ERRORS[errno]
+        if errno == proto.ERROR_UNDEF and errmsg:
+            error = errmsg
+        return struct.pack('!HH%dsc' % len(error), proto.OP_ERROR, errno,
+                           error.encode('ascii'), b'\0')
+
+    @staticmethod
+    def createDATA(num, data):
+        return struct.pack('!HH', proto.OP_DATA, num) + data
+
+    @staticmethod
+    def createOACK(opts):
+        opts_str = ''
+        for opt, val in opts.items():
+            opts_str += '%s%c%s%c' % (opt, '\0', val, '\0')
+        return struct.pack('!H%ds' % len(opts_str), proto.OP_OACK,
+                           opts_str.encode('ascii'))
+
+    @staticmethod
+    def parseRRQ(request):
+        packet = request.split(b'\0')[:-1]
+        if len(packet) % 2 != 0:
+            raise SyntaxError('invalid request packet')
+        filename = packet[0].decode('ascii')
+        if not filename:
+            raise SyntaxError('invalid filename')
+        mode = packet[1].decode('ascii').lower()
+        if mode not in proto.TFTP_MODES:
+            raise SyntaxError('unknown mode %s' % mode)
+        opts = {}
+        for i in range(2, len(packet)-1, 2):
+            opt = packet[i].decode('ascii').lower()
+            val = packet[i+1].decode('ascii')
+            if opt in proto.TFTP_OPTIONS:
+                opts[opt] = val
+        return filename, mode, opts
+
+    @staticmethod
+    def parseACK(request):
+        try:
+            packet = struct.unpack('!H', request)
+        except struct.error:
+            raise SyntaxError('invalid acknowledgment packet')
+        return packet[0]
+
+    @staticmethod
+    def parseDATA(request):
+        try:
+            packet = struct.unpack('!H', request[:2])
+        except struct.error:
+            raise SyntaxError('invalid data packet')
+        return packet[0], request[2:]
+
+    @staticmethod
+    def parseERROR(request):
+        try:
+            packet = struct.unpack('!H', request[:2])
+            errmsg = request[2:].split(b'\0')[0].decode('ascii')
+        except (struct.error, IndexError):
+            raise SyntaxError('invalid error packet')
+        return packet[0], errmsg
+
+    @staticmethod
+    def parseOACK(request):
+        packet = request.split(b'\0')[:-1]
+        if len(packet) % 2 != 0:
+            raise SyntaxError('invalid request packet')
+        opts = {}
+        for i in range(0, len(packet)-1, 2):
+            opts[packet[i].decode('ascii').lower()] = \
+                packet[i+1].decode('ascii')
+        return opts
+
+
+OPTS = {proto.TFTP_OPTION_BLKSIZE: 1468, proto.TFTP_OPTION_WINDOWSIZE: 8,
+        proto.TFTP_OPTION_TSIZE: 0}
+PAYLOAD = bytes(1468)
+
+# (codec, arguments, threshold). The threshold is the largest acceptable
+# time of the codec, relative to the reference. The codecs of the transfer
+# hot path must be faster than the reference.
+CASES = (
+    ('createRRQ', ('u-boot.img', 'octet', OPTS), 1.5),
+    ('createACK', (1234,), 0.8),
+    ('createERROR', (proto.ERROR_UNKNOWN_ID,), 0.8),
+    ('createDATA', (1234, PAYLOAD), 1.2),
+    ('createOACK', (OPTS,), 0.8),
+    ('parseRRQ', (Reference.createRRQ('u-boot.img', 'octet', OPTS)[2:],),
+     1.5),
+    ('parseACK', (b'\x04\xd2',), 1.1),
+    ('parseDATA', (memoryview(Reference.createDATA(1234, PAYLOAD))[2:],),
+     1.1),
+    ('parseERROR', (b'\x00\x05Unknown transfer ID.\x00',), 1.5),
+    ('parseOACK', (Reference.createOACK(OPTS)[2:],), 1.5),
+)
+
+
+def measure(func, args, number, repeat):
+    """Return the best time of a call, in seconds."""
+    return min(timeit.repeat(lambda: func(*args), number=number,
+                             repeat=repeat)) / number
+
+
+def run(number=20000, repeat=5):
+    """Time all the codecs.
+
+    Returns:
+        A list of (codec, reference time, time, threshold) tuples, with
+        times in seconds.
+    """
+
+    results = []
+    for name, args, threshold in CASES:
+        reference = measure(getattr(Reference, name), args, number, repeat)
+        current = measure(getattr(TFTPHelper, name), args, number, repeat)
+        results.append((name, reference, current, threshold))
+    return results
+
+
+def regressions(results):
+    """Return the codecs of the results slower than their threshold."""
+    return [name for name, reference, current, threshold in results
+            if current > reference * threshold]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--number', type=int, default=20000,
+                        help='calls per measure')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='measures per codec, the best one is kept')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='runs a codec must be too slow in to regress')
+    args = parser.parse_args()
+
+    # Timings are noisy: runs go on while some codec was too slow in all
+    # of them.
+    slow = None
+    for _ in range(args.runs):
+        results = run(args.number, args.repeat)
+        found = set(regressions(results))
+        slow = found if slow is None else slow & found
+        if not slow:
+            break
+
+    print('%-12s %10s %10s %7s %9s' % ('codec', 'reference', 'current',
+                                       'ratio', 'threshold'))
+    for name, reference, current, threshold in results:
+        print('%-12s %8.0fns %8.0fns %7.2f %9.2f%s' % (
+                name, reference * 1e9, current * 1e9, current / reference,
+                threshold,
+                '  REGRESSION' if name in slow else ''))
+
+    sys.exit(1 if slow else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Benchmark of the memory and file descriptors held by TFTP sessions.
+
+Reports the memory taken by a TFTPState, and runs many short simulated
+transfers with a bounded number of them in flight, some of which end with an
+error or time out, to report the file descriptor high-water mark. Transfers
+release their file as soon as they end, so the high-water mark should stay
+close to the number of transfers in flight.
+
+Run from the programmer directory:
+
+    python -m benchmarks.bench_sessions [--sessions N] [--concurrency N]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from tftp import proto
+from tftp import state
+from tftp.sessions import SessionTable
+
+# Session timeout of the simulated transfers.
+SESSION_TIMEOUT_SECS = 0.05
+
+
+def bytes_per_session(count):
+    """Return the memory taken by a fresh session, as seen by
+    tracemalloc."""
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        sessions = [state.TFTPState(('127.0.0.1', port), proto.OP_RRQ,
+                                    '/tftpboot', 'u-boot.img', 'octet')
+                    for port in range(count)]
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del sessions
+    return (after - before) / count
+
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def start(root, port):
+    peer_state = state.TFTPState(('127.0.0.1', port), proto.OP_RRQ, root,
+                                 'MLO', 'octet')
+    peer_state.file = open(peer_state.filepath, 'rb')
+    peer_state.packetnum = 0
+    peer_state.state = state.STATE_SEND
+    return peer_state
+
+
+def step(peer_state):
+    """Send a packet of the transfer, and have it acked. Returns whether the
+    transfer is over."""
+    response = peer_state.next()
+    while type(response) == tuple:
+        response = response[1]()
+    if peer_state.state == state.STATE_SEND_LAST:
+        peer_state.ack(peer_state.packetnum)
+        return True
+    peer_state.ack(peer_state.packetnum)
+    return False
+
+
+def simulate(root, count, concurrency, failures):
+    """Run count transfers, concurrency at a time. Returns the file
+    descriptor high-water mark above the baseline, and the elapsed time."""
+    rng = random.Random(0)
+    table = SessionTable(timeout=SESSION_TIMEOUT_SECS,
+                         expired=lambda peer, peer_state: peer_state.close())
+    active = set()
+    baseline = highest = open_fds()
+    started = time.perf_counter()
+
+    port = 0
+    while port < count or len(table):
+        while port < count and len(table) < concurrency:
+            port += 1
+            peer = ('127.0.0.1', port)
+            table[peer] = start(root, port)
+            active.add(peer)
+        highest = max(highest, open_fds())
+
+        for peer in list(active):
+            outcome = rng.random()
+            if outcome < failures:
+                active.discard(peer)
+                # The client either gave up with an ERROR packet, or went
+                # away and the session will expire.
+                if outcome < failures / 2:
+                    table.pop(peer).close()
+            elif step(table[peer]):
+                active.discard(peer)
+                table.pop(peer).close()
+
+        if not active:
+            time.sleep(SESSION_TIMEOUT_SECS / 10)
+        table.reap()
+
+    return highest - baseline, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=256)
+    parser.add_argument('--size', type=int, default=4096,
+                        help='size of the transferred file, in bytes')
+    parser.add_argument('--failures', type=float, default=0.02,
+                        help='ratio of packets ending their transfer early')
+    args = parser.parse_args()
+
+    print('%.0f bytes per session' % bytes_per_session(args.sessions))
+
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, 'MLO'), 'wb') as f:
+            f.write(os.urandom(args.size))
+        fds, elapsed = simulate(root, args.sessions, args.concurrency,
+                                args.failures)
+
+    print('%d sessions, %d in flight: %d fds high-water mark, %.0f '
+          'sessions/s' % (args.sessions, args.concurrency, fds,
+                          args.sessions / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import ctypes
+import socket
+import struct
+from bootp import Constants
+
+# Classic BPF instruction classes, sizes, modes and operations, see
+# linux/filter.h.
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_JMP = 0x05
+BPF_RET = 0x06
+
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+
+BPF_IMM = 0x00
+BPF_ABS = 0x20
+BPF_IND = 0x40
+BPF_MSH = 0xa0
+
+BPF_JA = 0x00
+BPF_JEQ = 0x10
+BPF_JGT = 0x20
+BPF_JGE = 0x30
+BPF_JSET = 0x40
+
+BPF_K = 0x00
+BPF_X = 0x08
+
+# Socket options attaching and detaching a filter (asm-generic/socket.h).
+SO_ATTACH_FILTER = getattr(socket, 'SO_ATTACH_FILTER', 26)
+SO_DETACH_FILTER = getattr(socket, 'SO_DETACH_FILTER', 27)
+
+# A filter instruction (struct sock_filter), and a program (struct
+# sock_fprog: its length and a pointer to its instructions).
+_INSTRUCTION = struct.Struct('HBBI')
+_PROGRAM = struct.Struct('HP')
+
+# Frame offsets, from the start of the Ethernet header.
+_ETHERTYPE = 12
+_IP_HEADER = 14
+_IP_FRAGMENT = _IP_HEADER + 6
+_IP_PROTO = _IP_HEADER + 9
+_UDP_SRC_PORT = _IP_HEADER + 0
+_UDP_DST_PORT = _IP_HEADER + 2
+
+# Bytes of an accepted frame copied to the socket, all of it.
+_ACCEPT_BYTES = 0x40000
+
+
+class BpfAssemblerError(Exception):
+    """The BPF program is invalid."""
+
+
+class BpfProgram:
+    """
+    A classic BPF program, assembled from instructions appended in order.
+    Jump targets are labels, placed with label(), which must come after the
+    jumps to them.
+    """
+
+    def __init__(self):
+        self.instructions = []          # (code, jt, jf, k), with label jumps
+        self.labels = {}                # label -> instruction index
+
+    def label(self, name):
+        self.labels[name] = len(self.instructions)
+
+    def _emit(self, code, k=0, jt=None, jf=None):
+        self.instructions.append((code, jt, jf, k))
+
+    def ld(self, offset, size=BPF_W):
+        """Load the word, half-word or byte at the given offset of the frame
+        into A."""
+        self._emit(BPF_LD | size | BPF_ABS, offset)
+
+    def ldh(self, offset):
+        self.ld(offset, BPF_H)
+
+    def ldb(self, offset):
+        self.ld(offset, BPF_B)
+
+    def ldh_ind(self, offset):
+        """Load the half-word at X + offset of the frame into A."""
+        self._emit(BPF_LD | BPF_H | BPF_IND, offset)
+
+    def ldx_msh(self, offset):
+        """Load 4 * (frame[offset] & 0xf) into X, the length of the IP header
+        at offset."""
+        self._emit(BPF_LDX | BPF_B | BPF_MSH, offset)
+
+    def jeq(self, k, jt=None, jf=None):
+        """Jump to label jt if A == k, to label jf otherwise. A missing label
+        stands for the next instruction."""
+        self._emit(BPF_JMP | BPF_JEQ | BPF_K, k, jt, jf)
+
+    def jset(self, k, jt=None, jf=None):
+        """Jump to label jt if A & k, to label jf otherwise."""
+        self._emit(BPF_JMP | BPF_JSET | BPF_K, k, jt, jf)
+
+    def ret(self, k):
+        """Accept k bytes of the frame, or drop it if 0."""
+        self._emit(BPF_RET | BPF_K, k)
+
+    def _offset(self, index, label):
+        if label is None:
+            return 0
+        if label not in self.labels:
+            raise BpfAssemblerError('Unknown label %s' % label)
+        offset = self.labels[label] - index - 1
+        if not 0 <= offset <= 0xff:
+            raise BpfAssemblerError('Jump to %s out of range' % label)
+        return offset
+
+    def assemble(self):
+        """Return the instructions, as (code, jt, jf, k) tuples with relative
+        jump offsets."""
+        return [(code, self._offset(i, jt), self._offset(i, jf), k)
+                for i, (code, jt, jf, k) in enumerate(self.instructions)]
+
+    def pack(self):
+        """Return the program as an array of struct sock_filter."""
+        return b''.join(_INSTRUCTION.pack(*instruction)
+                        for instruction in self.assemble())
+
+
+def dhcp_request_filter():
+    """
+    The filter of the DHCP server's raw socket, which only accepts IPv4/UDP
+    frames from port 68 to port 67. Fragments other than the first one are
+    dropped, as they have no UDP header.
+    """
+    program = BpfProgram()
+    program.ldh(_ETHERTYPE)
+    program.jeq(Constants.ETHERNET_IP_PROTO, jf='drop')
+    program.ldb(_IP_PROTO)
+    program.jeq(Constants.IP_UDP_PROTO, jf='drop')
+    program.ldh(_IP_FRAGMENT)
+    program.jset(0x1fff, jt='drop')
+    program.ldx_msh(_IP_HEADER)
+    program.ldh_ind(_UDP_SRC_PORT)
+    program.jeq(68, jf='drop')
+    program.ldh_ind(_UDP_DST_PORT)
+    program.jeq(67, jf='drop')
+    program.ret(_ACCEPT_BYTES)
+    program.label('drop')
+    program.ret(0)
+    return program
+
+
+def attach_filter(sock, program):
+    """
+    Attach a BPF program to a socket, so that the kernel drops the frames the
+    program does not accept before they reach the socket.
+    :raises OSError: if the filter could not be attached, e.g. the platform
+    does not support socket filters.
+    """
+    instructions = program.pack()
+    buffer = ctypes.create_string_buffer(instructions, len(instructions))
+    fprog = _PROGRAM.pack(len(instructions) // _INSTRUCTION.size,
+                          ctypes.addressof(buffer))
+    # The kernel copies the program, the buffer only has to outlive the call.
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def detach_filter(sock):
+    sock.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+
+
+def interface_rx_frames(interface):
+    """Return the number of frames received on a network interface, or None
+    if unknown."""
+    try:
+        with open('/sys/class/net/%s/statistics/rx_packets' % interface) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
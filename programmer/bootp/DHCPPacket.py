@@ -18,6 +18,19 @@ class UninterestingDhcpPacket(Exception):
 # client UUID by checking their length (16 bytes).
 DHCP_CLIENT_UUID_LENGTH = 16
 
+# Frame offsets and headers: the Ethernet type, the IP header, its protocol
+# byte, and from the start of the UDP header, the UDP ports and the BOOTP
+# header fields we use (transaction ID, client MAC address and magic cookie).
+_ETHER_TYPE = 12
+_IP_HEADER = 14
+_IP_PROTO = _IP_HEADER + 9
+_DHCP = struct.Struct('!HH8xL20x6s202xL')
+
+# The DHCP ops of interest, and the options which may hold the client UUID.
+_REQUEST_OPS = (Constants.DHCP_OP_DHCPDISCOVER, Constants.DHCP_OP_DHCPREQUEST)
+_UUID_OPTIONS = (Constants.DHCP_OPTION_CLIENT_UUID,
+                 Constants.DHCP_OPTION_CLIENT_UUID2)
+
 
 def _dhcp_options(options):
     """Generate a sequence of DHCP options from a raw byte stream."""
@@ -55,69 +68,166 @@ def _unpack_ip(ip_addr):
     return socket.inet_ntoa(ip_addr)
 
 
+def _check(frame):
+    """Check that a frame holds a DHCP request, without copying it. Returns
+    the reason why it does not, or None, followed by the offset of the UDP
+    header, the transaction ID and the client MAC address of the request."""
+    if len(frame) <= _IP_PROTO:
+        return 'Truncated packet', 0, 0, None
+    # The ethernet type needs to be IP (0x800), and the IP packet type UDP
+    # (0x11).
+    if (frame[_ETHER_TYPE] << 8 | frame[_ETHER_TYPE + 1]) != \
+            Constants.ETHERNET_IP_PROTO:
+        return 'Invalid Ethernet Protocol', 0, 0, None
+    if frame[_IP_PROTO] != Constants.IP_UDP_PROTO:
+        return 'Not UDP Protocol', 0, 0, None
+
+    # The datagram should be from port 68 to port 67 to tentatively be DHCP.
+    udp = _IP_HEADER + (frame[_IP_HEADER] & 0xF) * 4
+    if len(frame) < udp + _DHCP.size:
+        return 'Truncated packet', udp, 0, None
+    src, dst, xid, mac, cookie = _DHCP.unpack_from(frame, udp)
+    if src != 68 or dst != 67:
+        return 'Invalid src/dest port', udp, 0, None
+
+    # Looks like a DHCP request, check that the magic cookie is right.
+    if cookie != Constants.DHCP_MAGIC_COOKIE or frame[6:12] != mac:
+        return 'Invalid magic cookie', udp, xid, mac
+    return None, udp, xid, mac
+
+
+def is_dhcp_request(frame):
+    """Return whether a frame holds a DHCP request, which DhcpPacket can
+    parse. It is cheaper than having DhcpPacket reject other frames."""
+    return _check(frame)[0] is None
+
+
 class DhcpPacket(object):
+    """
+    A DHCP request, parsed from an Ethernet frame without copying it: the
+    packet keeps a reference to the frame, bytes or a memoryview into a
+    receive buffer, which must stay valid as long as the packet is used.
+    The options are only indexed, their values are decoded when accessed.
+    """
+
+    __slots__ = ('frame', 'server_mac', 'client_mac', 'xid', 'op', '_options',
+                 '_indexed', '_vendor_class')
+
+    # Kept for compatibility, PXE requests are not told apart.
+    is_pxe_request = False
+
     def __init__(self, pkt):
-        # Setup Defaults
-        self.unknown_options = []
-        self.is_pxe_request = False
-        self.requested_ip = None
+        error, udp, xid, mac = _check(pkt)
+        if error is not None:
+            raise NotDhcpPacketError(error)
+        self._parse(pkt, udp, xid, mac)
+
+    @classmethod
+    def parse(cls, frame):
+        """Return the DHCP request held by a frame, or None if it holds
+        none, rather than raising NotDhcpPacketError."""
+        error, udp, xid, mac = _check(frame)
+        if error is not None:
+            return None
+        packet = cls.__new__(cls)
+        packet._parse(frame, udp, xid, mac)
+        return packet
+
+    def _parse(self, pkt, udp, xid, mac):
+        self.xid = xid
+        self.client_mac = mac
+        self.frame = pkt
+        self.server_mac = bytes(pkt[0:6])
+        self._options = udp + _DHCP.size
+        self._indexed = self._index()
+        self._vendor_class = None
+
         # BOOTP Requests do no have the DCHP_OPTION_OP, so assume it's
         # Discover unless otherwise stated.
         self.op = Constants.DHCP_OP_DHCPDISCOVER
-        self.vendor_class = 'unknown'
-
-        # Check the ethernet type. It needs to be IP (0x800).
-        if struct.unpack('!H', pkt[12:14])[0] != Constants.ETHERNET_IP_PROTO:
-            raise NotDhcpPacketError("Invalid Ethernet Protocol")
-        self.server_mac, self.client_mac = pkt[0:6], pkt[6:12]
-
-        # Strip off the ethernet frame and check the IP packet type. It should
-        # be UDP (0x11)
-        pkt = pkt[14:]
-        if pkt[9] != Constants.IP_UDP_PROTO:
-            raise NotDhcpPacketError("Not UDP Protocol")
-
-        # Strip off the IP header and check the source/destination ports in the
-        # UDP datagram. The packet should be from port 68 to port 67 to
-        # tentatively be DHCP.
-        header_len = (pkt[0] & 0xF) * 4
-        pkt = pkt[header_len:]
-        (src, dst) = struct.unpack('!2H', pkt[:4])
-        if not (src == 68 and dst == 67):
-            raise NotDhcpPacketError("Invalid src/dest port")
-
-        # Looks like a DHCP request. Parse out the interesting data from the
-        # base DHCP packet and check that the magic cookie is right.
-        dhcp_fmt = '!12xL20x6s202xL'
-        dhcp_size = struct.calcsize(dhcp_fmt)
-        (xid, mac, cookie) = struct.unpack(dhcp_fmt, pkt[:dhcp_size])
-
-        if cookie != Constants.DHCP_MAGIC_COOKIE or self.client_mac != mac:
-            raise NotDhcpPacketError("Invalid magic cookie")
-
-        self.xid = xid
-
-        self.uuid = 'not specified'
-
-        self._parse_dhcp_options(pkt[dhcp_size:])
-
-    def _parse_dhcp_options(self, options):
-        for option, value in _dhcp_options(options):
-            if option == Constants.DHCP_OPTION_OP:
-                self.op = ord(value)
-                # We only care about interesting "incoming" DHCP ops.
-                if self.op not in (Constants.DHCP_OP_DHCPDISCOVER, Constants.DHCP_OP_DHCPREQUEST):
-                    raise UninterestingDhcpPacket()
-            elif (option in (Constants.DHCP_OPTION_CLIENT_UUID,
-                             Constants.DHCP_OPTION_CLIENT_UUID2) and
-                  len(value[1:]) == DHCP_CLIENT_UUID_LENGTH):
-                # First byte of the UUID is \0
-                self.uuid = _unpack_uuid(value[1:])
-            elif option == Constants.DHCP_OPTION_VENDOR_CLASS_ID:
-                self.vendor_class = value.decode('utf-8')
-            elif option == Constants.DHCP_OPTION_REQUESTED_IP:
-                self.requested_ip = _unpack_ip(value)
+        start = self._indexed.get(Constants.DHCP_OPTION_OP)
+        if start is not None and pkt[start - 1] and start < len(pkt):
+            self.op = pkt[start]
+            # We only care about interesting "incoming" DHCP ops.
+            if self.op not in _REQUEST_OPS:
+                raise UninterestingDhcpPacket()
+
+    def _index(self):
+        """Return the offsets of the option values, by option code. The last
+        occurrence of an option wins."""
+        frame = self.frame
+        end = len(frame)
+        indexed = {}
+        i = self._options
+        while i < end:
+            code = frame[i]
+            if code == 0:
+                i += 1
+                continue
+            if code == 255 or i + 1 >= end:
+                break
+            i += 2
+            indexed[code] = i
+            i += frame[i - 1]
+        return indexed
+
+    def _option(self, code):
+        """Return the value of an option, or None. The value is a slice of
+        the frame, which is only copied if the frame is bytes."""
+        start = self._indexed.get(code)
+        if start is None:
+            return None
+        return self.frame[start:start + self.frame[start - 1]]
+
+    @property
+    def vendor_class(self):
+        # The server looks it up several times per request, it is decoded
+        # once.
+        if self._vendor_class is None:
+            value = self._option(Constants.DHCP_OPTION_VENDOR_CLASS_ID)
+            if value is None:
+                self._vendor_class = 'unknown'
             else:
-                # Keep them around, in case other code feels like
-                # being knowledgeable.
-                self.unknown_options.append((option, value))
+                self._vendor_class = str(value, 'utf-8')
+        return self._vendor_class
+
+    @property
+    def uuid(self):
+        # Either option may hold the UUID, the last one with the right
+        # length wins.
+        frame = self.frame
+        uuid = None
+        for code in _UUID_OPTIONS:
+            start = self._indexed.get(code)
+            if (start is not None and
+                    frame[start - 1] == DHCP_CLIENT_UUID_LENGTH + 1 and
+                    start + DHCP_CLIENT_UUID_LENGTH < len(frame) and
+                    (uuid is None or start > uuid)):
+                uuid = start
+        if uuid is None:
+            return 'not specified'
+        # First byte of the UUID is \0
+        return _unpack_uuid(frame[uuid + 1:uuid + 1 + DHCP_CLIENT_UUID_LENGTH])
+
+    @property
+    def requested_ip(self):
+        value = self._option(Constants.DHCP_OPTION_REQUESTED_IP)
+        if value is None:
+            return None
+        return _unpack_ip(value)
+
+    @property
+    def unknown_options(self):
+        """The (code, value) pairs of the options the packet does not decode,
+        in case other code feels like being knowledgeable."""
+        options = []
+        for code, value in _dhcp_options(self.frame[self._options:]):
+            if code in _UUID_OPTIONS:
+                if len(value[1:]) == DHCP_CLIENT_UUID_LENGTH:
+                    continue
+            elif code in (Constants.DHCP_OPTION_OP,
+                          Constants.DHCP_OPTION_VENDOR_CLASS_ID,
+                          Constants.DHCP_OPTION_REQUESTED_IP):
+                continue
+            options.append((code, bytes(value)))
+        return options
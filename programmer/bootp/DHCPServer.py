@@ -3,17 +3,63 @@ import socket
 import logging
 import random
 from bootp import Constants
+from bootp import BpfFilter
+from bootp.PacketRing import PacketRing
+from bootp.ReplyTemplate import ReplyTemplates
 import time
-from bootp.DHCPPacket import DhcpPacket, NotDhcpPacketError
+from bootp.DHCPPacket import DhcpPacket, NotDhcpPacketError, \
+    UninterestingDhcpPacket
 from bootp.Utilities import _pack_ip, _unpack_ip, _pack_mac, get_ip_config_for_iface
+from metrics import registry
 
 log = logging.getLogger('dhcpd')
 
+# DHCP metrics, see the metrics package.
+_metrics = registry.get_registry()
+_REQUESTS = _metrics.counter('dhcp_requests_total',
+                             'DHCP requests handled, by interface and type.',
+                             ['interface', 'type'])
+_REPLIES = _metrics.counter('dhcp_replies_total',
+                            'DHCP replies sent, by interface and type.',
+                            ['interface', 'type'])
+_IGNORED = _metrics.counter('dhcp_ignored_packets_total',
+                            'Packets received and ignored, by interface.',
+                            ['interface'])
+_REQUEST_SECONDS = _metrics.histogram(
+    'dhcp_request_seconds', 'Time to handle a DHCP request, by interface.',
+    ['interface'], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                            0.1, 0.25, 1))
+_REPLY_CACHE_HITS = _metrics.counter(
+    'dhcp_reply_cache_hits_total', 'Retransmitted requests answered from the '
+    'reply cache, by interface.', ['interface'])
+_FILTERED = _metrics.gauge('dhcp_filtered_frames',
+                           'Frames received on the interface and not '
+                           'delivered to the socket since its filter was '
+                           'attached, by interface.', ['interface'])
+_RING_DROPPED = _metrics.gauge('dhcp_ring_dropped_frames',
+                               'Frames dropped by the kernel because the '
+                               'packet ring was full, by interface.',
+                               ['interface'])
+_LEASES = _metrics.gauge('dhcp_leases', 'IP addresses leased or offered, by '
+                         'interface.', ['interface'])
+_REQUEST_TYPES = {
+    Constants.DHCP_OP_DHCPDISCOVER: 'discover',
+    Constants.DHCP_OP_DHCPREQUEST: 'request',
+}
+_REPLY_TYPES = {
+    Constants.DHCP_OP_DHCPDISCOVER: 'offer',
+    Constants.DHCP_OP_DHCPREQUEST: 'ack',
+}
+
 # DHCP lease timeout in seconds. Internally, we wait longer, to let
 # the client wrap up cleanly.
 DHCP_LEASE_TIMEOUT = 10 * 60  # 10 minutes
 DHCP_LEASE_TIMEOUT_INTERNAL = 15 * 60  # 15 minutes
 
+# How long a reply is kept to answer the retransmits of its request, in
+# seconds. Clients retransmit with the same transaction ID.
+DHCP_REPLY_CACHE_TIMEOUT = 10
+
 
 class UninterestingBootpPacket(Exception):
     """Packet is BOOTP, but we just don't care about it."""
@@ -25,7 +71,8 @@ class BootpServerConfigurationError(Exception):
 
 
 class DHCPServer(object):
-    def __init__(self, interface, bootfile, router=None, tftp_server=None, connection_callback=None):
+    def __init__(self, interface, bootfile, router=None, tftp_server=None, connection_callback=None,
+                 lease_callback=None, packet_ring=False):
         self.interface = interface
         self.ip, self.netmask, self.mac = get_ip_config_for_iface(interface)
         self.hostname = socket.gethostname()
@@ -33,33 +80,130 @@ class DHCPServer(object):
         self.router = router or self.ip
         self.tftp_server = tftp_server or self.ip
         self.ips_allocated = {}
+        # (client MAC, xid, op) -> (expiry, reply) of the recent replies.
+        self.reply_cache = {}
         self.name_servers = None
+        # Replies are encoded from frames precomputed on the first request of
+        # each kind, see ReplyTemplates.
+        self.reply_templates = ReplyTemplates(self.build_dhcp_reply)
 
         self.sock = socket.socket(socket.PF_PACKET, socket.SOCK_RAW)
         self.sock.bind((self.interface, Constants.ETHERNET_IP_PROTO))
+
+        # Have the kernel drop everything but DHCP requests, rather than
+        # waking up for every frame of the TFTP transfers. Without the
+        # filter, handle_frame() still rejects them, only slower.
+        self.frames_received = 0
+        self.rx_frames_at_attach = None
+        try:
+            BpfFilter.attach_filter(self.sock,
+                                    BpfFilter.dhcp_request_filter())
+            self.rx_frames_at_attach = BpfFilter.interface_rx_frames(
+                interface)
+        except OSError as e:
+            log.warning('Could not attach the socket filter on %s, filtering '
+                        'frames in userspace: %s', interface, e)
+
+        # Optionally receive the frames in batches from a ring shared with
+        # the kernel, rather than with a recv() call each.
+        self.ring = None
+        if packet_ring:
+            try:
+                self.ring = PacketRing(self.sock)
+            except OSError as e:
+                log.warning('Could not set up the packet ring on %s, '
+                            'receiving frames one by one: %s', interface, e)
         self.connection_callback = connection_callback
+        # Called with the IP address and vendor class of each client an
+        # address is offered or leased to, e.g. to let the TFTP server pick
+        # the client's option profile.
+        self.lease_callback = lease_callback
+
+        self.requests = {op: _REQUESTS.labels(interface, name)
+                         for op, name in _REQUEST_TYPES.items()}
+        self.replies = {op: _REPLIES.labels(interface, name)
+                        for op, name in _REPLY_TYPES.items()}
+        self.ignored = _IGNORED.labels(interface)
+        self.reply_cache_hits = _REPLY_CACHE_HITS.labels(interface)
+        self.request_seconds = _REQUEST_SECONDS.labels(interface)
+        _LEASES.labels(interface).set_function(
+            lambda: len(self.ips_allocated))
+        _FILTERED.labels(interface).set_function(self.filtered_frames)
+        if self.ring is not None:
+            _RING_DROPPED.labels(interface).set_function(
+                lambda: self.ring.statistics()[1])
 
     def serve_forever(self):
         log.info('Serving BOOTP requests on %s' % self.interface)
-        while True:
-            data = self.sock.recv(4096)
-            try:
-                pkt = DhcpPacket(data)
-                log.info("Received DHCP request from: %s", pkt.vendor_class)
-                if self.connection_callback is not None:
-                    self.connection_callback(pkt.vendor_class)
-                else:
-                    log.warning("Connection callback was none")
-                self.handle_bootp_request(pkt)
-                log.debug("Boot request handled")
-
-            except (NotDhcpPacketError, UninterestingBootpPacket):
-                continue
+        if self.ring is not None:
+            for frames in self.ring.batches():
+                # The frames are views into the ring, only valid until the
+                # next batch: they are parsed in place, and the packets do
+                # not outlive handle_frame().
+                for frame in frames:
+                    self.handle_frame(frame)
+        else:
+            while True:
+                self.handle_frame(self.sock.recv(4096))
+
+    def handle_frame(self, data):
+        self.frames_received += 1
+        started = time.monotonic()
+        try:
+            # Without the socket filter, most frames are not DHCP requests,
+            # they are rejected without going through an exception.
+            pkt = DhcpPacket.parse(data)
+            if pkt is None:
+                self.ignored.inc()
+                return
+            if self.send_cached_reply(pkt):
+                self.request_seconds.observe(time.monotonic() - started)
+                return
+            log.info("Received DHCP request from: %s", pkt.vendor_class)
+            if self.connection_callback is not None:
+                self.connection_callback(pkt.vendor_class)
+            else:
+                log.warning("Connection callback was none")
+            self.handle_bootp_request(pkt)
+            log.debug("Boot request handled")
+            self.request_seconds.observe(time.monotonic() - started)
+
+        except (NotDhcpPacketError, UninterestingDhcpPacket,
+                UninterestingBootpPacket):
+            self.ignored.inc()
+
+    def filtered_frames(self):
+        """Returns the number of frames dropped by the socket filter since it
+        was attached, or 0 if it is not attached."""
+        if self.rx_frames_at_attach is None:
+            return 0
+        rx_frames = BpfFilter.interface_rx_frames(self.interface)
+        if rx_frames is None:
+            return 0
+        return max(0, rx_frames - self.rx_frames_at_attach -
+                   self.frames_received)
+
+    def send_cached_reply(self, pkt):
+        """Sends the reply to a retransmitted request again, as is, if it is
+        still cached. Returns whether it was."""
+        cached = self.reply_cache.get((pkt.client_mac, pkt.xid, pkt.op))
+        if cached is None or cached[0] <= time.monotonic():
+            return False
+        log.debug('Request %#x retransmitted, replying from the cache',
+                  pkt.xid)
+        self.sock.send(cached[1])
+        self.reply_cache_hits.inc()
+        self.replies[pkt.op].inc()
+        return True
 
     def handle_bootp_request(self, pkt):
         # Clean up old leases before trying to get one for our new
         # client.
         self.gc_allocated_ips()
+        self.gc_reply_cache()
+        counter = self.requests.get(pkt.op)
+        if counter is not None:
+            counter.inc()
         ip = ''
         if pkt.op == Constants.DHCP_OP_DHCPDISCOVER:
             ip = self.generate_free_ip()
@@ -75,8 +219,15 @@ class DHCPServer(object):
                 self.ips_allocated[ip] = timeout
             log.info('PXE booting client %s (uuid : %s)' % (ip, pkt.uuid))
 
+        if self.lease_callback is not None and ip:
+            self.lease_callback(ip, pkt.vendor_class)
+
         filename = DHCPServer.get_filename(pkt.vendor_class)
-        self.sock.send(self.encode_dhcp_reply(pkt, ip, filename))
+        reply = self.encode_dhcp_reply(pkt, ip, filename)
+        self.sock.send(reply)
+        self.replies[pkt.op].inc()
+        self.reply_cache[(pkt.client_mac, pkt.xid, pkt.op)] = (
+            time.monotonic() + DHCP_REPLY_CACHE_TIMEOUT, reply)
 
     def gc_allocated_ips(self):
         current = time.time()
@@ -86,6 +237,13 @@ class DHCPServer(object):
             log.info('Lease on %s expired' % ip)
             del self.ips_allocated[ip]
 
+    def gc_reply_cache(self):
+        current = time.monotonic()
+        old = [key for key, (expiry, _) in self.reply_cache.items()
+               if expiry <= current]
+        for key in old:
+            del self.reply_cache[key]
+
     @staticmethod
     def get_filename(vendor_class):
         if vendor_class == "AM335x ROM":
@@ -96,6 +254,9 @@ class DHCPServer(object):
             return 'zImage'
 
     def encode_dhcp_reply(self, request_pkt, client_ip, filename):
+        return self.reply_templates.encode(request_pkt, client_ip, filename)
+
+    def build_dhcp_reply(self, request_pkt, client_ip, filename):
         return DHCPServer._encode_dhcp_reply(request_pkt, client_ip, filename,
                                              self.mac, self.ip, self.netmask,
                                              self.tftp_server, self.router,
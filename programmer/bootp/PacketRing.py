@@ -0,0 +1,138 @@
+import mmap
+import select
+import socket
+import struct
+import threading
+
+# Packet socket options and values, see linux/if_packet.h.
+SOL_PACKET = getattr(socket, 'SOL_PACKET', 263)
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+
+# Block status, owned by the kernel or by userspace.
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# Default ring geometry: 8 blocks of 32 KiB, each holding up to 16 frames
+# of 2 KiB, which is more than enough for the DHCP traffic of a board.
+PACKET_RING_BLOCK_SIZE = 1 << 15
+PACKET_RING_BLOCK_COUNT = 8
+PACKET_RING_FRAME_SIZE = 1 << 11
+
+# Time after which the kernel hands over a block that is not full, in
+# milliseconds. It bounds the latency added to a request.
+PACKET_RING_TIMEOUT_MS = 10
+
+# struct tpacket_req3: block size, block count, frame size, frame count,
+# block retire timeout, private area size, requested features.
+_REQUEST = struct.Struct('=7I')
+
+# struct tpacket_stats_v3: packets received, packets dropped, block freezes.
+_STATISTICS = struct.Struct('=3I')
+
+# struct tpacket_block_desc, up to the block header fields we use: block
+# status, packet count and offset of the first packet.
+_BLOCK_STATUS = struct.Struct('=I')
+_BLOCK_STATUS_OFFSET = 8
+_BLOCK_HEADER = struct.Struct('=8xIII')
+
+# struct tpacket3_hdr, up to the fields we use: offset of the next packet,
+# captured length, and offset of the frame from the header.
+_FRAME_HEADER = struct.Struct('=I8xI8xH')
+
+
+class PacketRing(object):
+    """
+    A TPACKET_V3 receive ring mapped on a packet socket. The kernel copies
+    the frames into blocks of the ring, and hands over a block once full or
+    after PACKET_RING_TIMEOUT_MS, so that frames are read in batches, in
+    place, without a system call per frame.
+    """
+
+    def __init__(self, sock, block_size=PACKET_RING_BLOCK_SIZE,
+                 block_count=PACKET_RING_BLOCK_COUNT,
+                 frame_size=PACKET_RING_FRAME_SIZE,
+                 timeout_ms=PACKET_RING_TIMEOUT_MS):
+        """
+        Set up the ring on a packet socket.
+        :raises OSError: if the ring could not be set up, e.g. the kernel does
+        not support TPACKET_V3.
+        """
+        self.sock = sock
+        self.block_size = block_size
+        self.block_count = block_count
+
+        sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        sock.setsockopt(SOL_PACKET, PACKET_RX_RING, _REQUEST.pack(
+            block_size, block_count, frame_size,
+            block_size * block_count // frame_size, timeout_ms, 0, 0))
+        self.ring = mmap.mmap(sock.fileno(), block_size * block_count,
+                              mmap.MAP_SHARED,
+                              mmap.PROT_READ | mmap.PROT_WRITE)
+        self.view = memoryview(self.ring)
+        self.block = 0                  # Index of the next block to read
+        self.poll = select.poll()
+        self.poll.register(sock, select.POLLIN | select.POLLERR)
+
+        # Reading the kernel statistics resets them, they are accumulated.
+        self.packets = 0
+        self.drops = 0
+        self.statistics_lock = threading.Lock()
+
+    def batches(self, timeout=None):
+        """
+        Generate the batches of frames received, as lists of memoryviews
+        into the ring. The views are only valid until the next batch is
+        requested, when they are released and their block is handed back to
+        the kernel: frames kept longer must be copied.
+        :param timeout: how long to wait for a batch, in seconds, after which
+        the generator stops. None waits forever.
+        """
+        poll_timeout = None if timeout is None else timeout * 1000
+        while True:
+            offset = self.block * self.block_size
+            status, = _BLOCK_STATUS.unpack_from(
+                self.ring, offset + _BLOCK_STATUS_OFFSET)
+            if not status & TP_STATUS_USER:
+                if not self.poll.poll(poll_timeout):
+                    return
+                continue
+
+            _, count, position = _BLOCK_HEADER.unpack_from(self.ring, offset)
+            position += offset
+            frames = []
+            for _ in range(count):
+                next_offset, snap_len, mac = _FRAME_HEADER.unpack_from(
+                    self.ring, position)
+                frames.append(self.view[position + mac:
+                                        position + mac + snap_len])
+                position += next_offset
+
+            try:
+                yield frames
+            finally:
+                for frame in frames:
+                    frame.release()
+                _BLOCK_STATUS.pack_into(self.ring,
+                                        offset + _BLOCK_STATUS_OFFSET,
+                                        TP_STATUS_KERNEL)
+                self.block = (self.block + 1) % self.block_count
+
+    def statistics(self):
+        """
+        Returns the number of frames received and dropped by the kernel,
+        because the ring was full, since the ring was set up.
+        """
+        with self.statistics_lock:
+            packets, drops, _ = _STATISTICS.unpack(self.sock.getsockopt(
+                SOL_PACKET, PACKET_STATISTICS, _STATISTICS.size))
+            self.packets += packets
+            self.drops += drops
+            return self.packets, self.drops
+
+    def close(self):
+        self.poll.unregister(self.sock)
+        self.view.release()
+        self.ring.close()
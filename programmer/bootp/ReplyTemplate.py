@@ -0,0 +1,58 @@
+import socket
+import struct
+from collections import namedtuple
+
+# Offsets in a reply frame of the fields that depend on the request: the
+# transaction ID, the client IP address (yiaddr) and the client MAC address
+# (chaddr) of the BOOTP header, after the 42 bytes of the Ethernet, IP and
+# UDP headers.
+_XID_OFFSET = 46
+_YIADDR_OFFSET = 58
+_CHADDR_OFFSET = 70
+
+_XID = struct.Struct('!L')
+
+# The request a template is built from, with blank per-request fields.
+_TemplateRequest = namedtuple('_TemplateRequest', 'op xid client_mac')
+
+
+class ReplyTemplates(object):
+    """
+    Encodes DHCP replies from precomputed frames. Everything in a reply frame
+    but the transaction ID, the client IP address and the client MAC address
+    is fixed for a given server, reply kind and boot file, and none of these
+    three fields is covered by the IP header checksum (the UDP checksum is
+    not computed). A frame is thus built once per (request op, boot file),
+    and only these fields are patched into a copy of it for each request.
+    """
+
+    def __init__(self, build):
+        """
+        :param build: the function building a reply frame from a request, a
+        client IP address and a boot file name, called once per template.
+        """
+        self.build = build
+        self.templates = {}             # (op, filename) -> frame
+
+    def template(self, op, filename):
+        """Return the reply frame of the given request op and boot file,
+        with blank per-request fields."""
+        key = (op, filename)
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates[key] = bytes(self.build(
+                _TemplateRequest(op, 0, bytes(6)), '0.0.0.0', filename))
+        return template
+
+    def encode(self, request_pkt, client_ip, filename):
+        """Return the reply to a request, as a bytearray."""
+        reply = bytearray(self.template(request_pkt.op, filename))
+        _XID.pack_into(reply, _XID_OFFSET, request_pkt.xid)
+        reply[_YIADDR_OFFSET:_YIADDR_OFFSET + 4] = socket.inet_aton(client_ip)
+        reply[_CHADDR_OFFSET:_CHADDR_OFFSET + 6] = request_pkt.client_mac
+        return reply
+
+    def clear(self):
+        """Forget the templates, e.g. once the server configuration
+        changed."""
+        self.templates.clear()
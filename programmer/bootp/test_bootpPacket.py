@@ -1,24 +1,37 @@
 from unittest import TestCase
-from bootp.DHCPPacket import DhcpPacket, NotDhcpPacketError
+from bootp import Constants
+from bootp.DHCPPacket import DhcpPacket, NotDhcpPacketError, \
+    UninterestingDhcpPacket, is_dhcp_request
 from bootp.DHCPServer import DHCPServer
 
+# A DHCPDISCOVER captured from an AM335x ROM.
+VALID = b'\xff\xff\xff\xff\xff\xff\xc8\xdf\x84\xaf\x98\x88\x08\x00E\x00\x01\x88\x02\x00\x00\x00@\x11wf\x00\x00\x00\x00\xff\xff\xff\xff\x00D\x00C\x01t\x0cU\x01\x01\x06\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xc8\xdf\x84\xaf\x98\x88\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00c\x82Sc<\nAM335x ROM=Q\x05\x01\x05\x01\x81@\x07\x03\x13\x02\x01\x00\x12\x15\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x14!\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x15\t\x01\x86=7\x8a\x00\x00\x00\x00\xff\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+# The same, with an invalid Ethernet protocol.
+INVALID_ETH_PROTOCOL = b'\xff\xff\xff\xff\xff\xff\xc8\xdf\x84\xaf\x98\x88\x09\x00E\x00\x01\x88\x02\x00\x00\x00@\x11wf\x00\x00\x00\x00\xff\xff\xff\xff\x00D\x00C\x01t\x0cU\x01\x01\x06\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xc8\xdf\x84\xaf\x98\x88\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00c\x82Sc<\nAM335x ROM=Q\x05\x01\x05\x01\x81@\x07\x03\x13\x02\x01\x00\x12\x15\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x14!\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x15\t\x01\x86=7\x8a\x00\x00\x00\x00\xff\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+# The same, with an invalid IP protocol.
+INVALID_IP_PROTOCOL = b'\xff\xff\xff\xff\xff\xff\xc8\xdf\x84\xaf\x98\x88\x08\x00E\x00\x01\x88\x02\x00\x00\x00@\x12wf\x00\x00\x00\x00\xff\xff\xff\xff\x00D\x00C\x01t\x0cU\x01\x01\x06\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xc8\xdf\x84\xaf\x98\x88\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00c\x82Sc<\nAM335x ROM=Q\x05\x01\x05\x01\x81@\x07\x03\x13\x02\x01\x00\x12\x15\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x14!\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x15\t\x01\x86=7\x8a\x00\x00\x00\x00\xff\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+# Offset of the DHCP options in the frames.
+OPTIONS = 282
+
+
+def with_options(frame, options):
+    return frame[:OPTIONS] + options + b'\xff'
+
+
 class TestBootpPacket(TestCase):
     def test_valid_will_initilize(self):
-        valid = b'\xff\xff\xff\xff\xff\xff\xc8\xdf\x84\xaf\x98\x88\x08\x00E\x00\x01\x88\x02\x00\x00\x00@\x11wf\x00\x00\x00\x00\xff\xff\xff\xff\x00D\x00C\x01t\x0cU\x01\x01\x06\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xc8\xdf\x84\xaf\x98\x88\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00c\x82Sc<\nAM335x ROM=Q\x05\x01\x05\x01\x81@\x07\x03\x13\x02\x01\x00\x12\x15\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x14!\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x15\t\x01\x86=7\x8a\x00\x00\x00\x00\xff\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        packet = DhcpPacket(valid)
+        packet = DhcpPacket(VALID)
         self.assertIsNotNone(packet)
         self.assertEqual("AM335x ROM", packet.vendor_class)
 
     def test_invalid_eth_protocol(self):
-        valid = b'\xff\xff\xff\xff\xff\xff\xc8\xdf\x84\xaf\x98\x88\x09\x00E\x00\x01\x88\x02\x00\x00\x00@\x11wf\x00\x00\x00\x00\xff\xff\xff\xff\x00D\x00C\x01t\x0cU\x01\x01\x06\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xc8\xdf\x84\xaf\x98\x88\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00c\x82Sc<\nAM335x ROM=Q\x05\x01\x05\x01\x81@\x07\x03\x13\x02\x01\x00\x12\x15\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x14!\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x15\t\x01\x86=7\x8a\x00\x00\x00\x00\xff\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
         with self.assertRaises(NotDhcpPacketError) as cm:
-            DhcpPacket(valid)
+            DhcpPacket(INVALID_ETH_PROTOCOL)
         self.assertEqual(cm.exception.message, 'Invalid Ethernet Protocol')
 
     def test_invalid_ip_protocol(self):
-        invalid = b'\xff\xff\xff\xff\xff\xff\xc8\xdf\x84\xaf\x98\x88\x08\x00E\x00\x01\x88\x02\x00\x00\x00@\x12wf\x00\x00\x00\x00\xff\xff\xff\xff\x00D\x00C\x01t\x0cU\x01\x01\x06\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xc8\xdf\x84\xaf\x98\x88\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00c\x82Sc<\nAM335x ROM=Q\x05\x01\x05\x01\x81@\x07\x03\x13\x02\x01\x00\x12\x15\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x14!\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x15\t\x01\x86=7\x8a\x00\x00\x00\x00\xff\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
         with self.assertRaises(NotDhcpPacketError) as cm:
-            DhcpPacket(invalid)
+            DhcpPacket(INVALID_IP_PROTOCOL)
         self.assertEqual(cm.exception.message, 'Not UDP Protocol')
 
     def test_encode(self):
@@ -30,9 +43,71 @@ class TestBootpPacket(TestCase):
         tftp = ip
         router = ip
         name_servers = None
-        valid = b'\xff\xff\xff\xff\xff\xff\xc8\xdf\x84\xaf\x98\x88\x08\x00E\x00\x01\x88\x02\x00\x00\x00@\x11wf\x00\x00\x00\x00\xff\xff\xff\xff\x00D\x00C\x01t\x0cU\x01\x01\x06\x00\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\xc8\xdf\x84\xaf\x98\x88\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00c\x82Sc<\nAM335x ROM=Q\x05\x01\x05\x01\x81@\x07\x03\x13\x02\x01\x00\x12\x15\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x14!\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x15\t\x01\x86=7\x8a\x00\x00\x00\x00\xff\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        packet = DhcpPacket(valid)
+        packet = DhcpPacket(VALID)
         result = DHCPServer._encode_dhcp_reply(packet, client_ip, file,
                                                mac, ip, netmask,
                                                tftp, router, name_servers)
         self.assertIsNotNone(result)
+
+    def test_fields(self):
+        packet = DhcpPacket(VALID)
+        self.assertEqual(Constants.DHCP_OP_DHCPDISCOVER, packet.op)
+        self.assertEqual(1, packet.xid)
+        self.assertEqual(b'\xc8\xdf\x84\xaf\x98\x88', packet.client_mac)
+        self.assertEqual(b'\xff' * 6, packet.server_mac)
+        self.assertEqual('not specified', packet.uuid)
+        self.assertIsNone(packet.requested_ip)
+        self.assertEqual([Constants.DHCP_OPTION_CLIENT_UUID],
+                         [code for code, _ in packet.unknown_options])
+
+    def test_options(self):
+        uuid = bytes(range(16))
+        packet = DhcpPacket(with_options(VALID, b''.join([
+            b'\x35\x01\x03',                 # DHCPREQUEST
+            b'\x32\x04\xc0\xa8\x04\x02',     # Requested IP
+            b'\x00\x00',                     # Pads
+            b'\x61\x11\x00' + uuid,           # Client UUID
+            b'\x3c\x11AM335x U-Boot SPL',     # Vendor class
+            b'\x2b\x02\x01\x02',             # PXE vendor extensions
+        ])))
+        self.assertEqual(Constants.DHCP_OP_DHCPREQUEST, packet.op)
+        self.assertEqual('192.168.4.2', packet.requested_ip)
+        self.assertEqual('00010203-0405-0607-0809-0a0b0c0d0e0f', packet.uuid)
+        self.assertEqual('AM335x U-Boot SPL', packet.vendor_class)
+        self.assertEqual([(Constants.DHCP_OPTION_PXE_VENDOR, b'\x01\x02')],
+                         packet.unknown_options)
+
+    def test_memoryview(self):
+        frame = memoryview(bytearray(VALID))
+        packet = DhcpPacket(frame)
+        self.assertEqual("AM335x ROM", packet.vendor_class)
+        self.assertEqual(bytes, type(packet.client_mac))
+        self.assertEqual(DhcpPacket(VALID).xid, packet.xid)
+
+    def test_uninteresting(self):
+        with self.assertRaises(UninterestingDhcpPacket):
+            DhcpPacket(with_options(VALID, b'\x35\x01\x07'))  # DHCPRELEASE
+
+    def test_truncated(self):
+        with self.assertRaises(NotDhcpPacketError) as cm:
+            DhcpPacket(VALID[:OPTIONS - 1])
+        self.assertEqual(cm.exception.message, 'Truncated packet')
+        # Truncated options are cut short.
+        packet = DhcpPacket(VALID[:OPTIONS] + b'\x3c\x0aAM335x')
+        self.assertEqual('AM335x', packet.vendor_class)
+
+    def test_parse(self):
+        self.assertEqual(DhcpPacket(VALID).xid, DhcpPacket.parse(VALID).xid)
+        self.assertIsNone(DhcpPacket.parse(INVALID_ETH_PROTOCOL))
+        self.assertIsNone(DhcpPacket.parse(INVALID_IP_PROTOCOL))
+
+    def test_is_dhcp_request(self):
+        self.assertTrue(is_dhcp_request(VALID))
+        self.assertTrue(is_dhcp_request(memoryview(VALID)))
+        self.assertFalse(is_dhcp_request(INVALID_ETH_PROTOCOL))
+        self.assertFalse(is_dhcp_request(INVALID_IP_PROTOCOL))
+        self.assertFalse(is_dhcp_request(VALID[:OPTIONS - 1]))
+        self.assertFalse(is_dhcp_request(VALID[:20]))
+        # From port 67 to port 68, a reply.
+        self.assertFalse(is_dhcp_request(VALID[:34] + b'\x00\x43\x00\x44' +
+                                         VALID[38:]))
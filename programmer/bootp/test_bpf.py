@@ -0,0 +1,106 @@
+import socket
+import struct
+import sys
+from unittest import TestCase, skipUnless
+from bootp import BpfFilter
+from bootp.BpfFilter import BpfAssemblerError, BpfProgram
+
+
+def run_filter(instructions, frame):
+    """A tiny interpreter of the classic BPF instructions used by the
+    filters, returning the number of bytes of the frame accepted."""
+    a = x = 0
+    pc = 0
+    while True:
+        code, jt, jf, k = instructions[pc]
+        pc += 1
+        cls = code & 0x07
+        if cls == BpfFilter.BPF_RET:
+            return k
+        if cls == BpfFilter.BPF_LDX:
+            x = (frame[k] & 0xf) * 4
+            continue
+        if cls == BpfFilter.BPF_LD:
+            offset = k + (x if code & 0xe0 == BpfFilter.BPF_IND else 0)
+            size = {BpfFilter.BPF_W: 4, BpfFilter.BPF_H: 2,
+                    BpfFilter.BPF_B: 1}[code & 0x18]
+            if offset + size > len(frame):
+                return 0
+            a = int.from_bytes(frame[offset:offset + size], 'big')
+            continue
+        if code & 0xf0 == BpfFilter.BPF_JEQ:
+            pc += jt if a == k else jf
+        elif code & 0xf0 == BpfFilter.BPF_JSET:
+            pc += jt if a & k else jf
+        else:
+            raise ValueError('unsupported instruction %#x' % code)
+
+
+def frame(ethertype=0x800, proto=17, src=68, dst=67, ihl=5, fragment=0):
+    ip = struct.pack('!BBHHHBBH4s4s', 0x40 | ihl, 0, 0, 0, fragment, 64,
+                     proto, 0, bytes(4), b'\xff' * 4) + bytes((ihl - 5) * 4)
+    return (b'\xff' * 6 + b'\xc8\xdf\x84\xaf\x98\x88' +
+            struct.pack('!H', ethertype) + ip +
+            struct.pack('!HHHH', src, dst, 308, 0) + bytes(300))
+
+
+class TestDhcpRequestFilter(TestCase):
+    def setUp(self):
+        self.instructions = BpfFilter.dhcp_request_filter().assemble()
+
+    def accepts(self, data):
+        return run_filter(self.instructions, data) > 0
+
+    def test_accepts_dhcp_requests(self):
+        self.assertTrue(self.accepts(frame()))
+        self.assertTrue(self.accepts(frame(ihl=6)))
+        self.assertTrue(self.accepts(frame(fragment=0x2000)))
+
+    def test_drops_the_rest(self):
+        self.assertFalse(self.accepts(frame(ethertype=0x806)))
+        self.assertFalse(self.accepts(frame(proto=6)))
+        self.assertFalse(self.accepts(frame(src=1234, dst=69)))
+        self.assertFalse(self.accepts(frame(src=67, dst=68)))
+        self.assertFalse(self.accepts(frame(fragment=0x0010)))
+        self.assertFalse(self.accepts(frame()[:30]))
+
+    @skipUnless(sys.platform.startswith('linux'), 'Linux socket filters')
+    def test_attach(self):
+        # The kernel validates the program when it is attached.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            BpfFilter.attach_filter(sock, BpfFilter.dhcp_request_filter())
+            BpfFilter.detach_filter(sock)
+        finally:
+            sock.close()
+
+
+class TestBpfProgram(TestCase):
+    def test_jumps(self):
+        program = BpfProgram()
+        program.ldb(0)
+        program.jeq(1, jt='one', jf='other')
+        program.ret(0)
+        program.label('one')
+        program.ret(1)
+        program.label('other')
+        program.ret(2)
+        instructions = program.assemble()
+        self.assertEqual((BpfFilter.BPF_JMP | BpfFilter.BPF_JEQ, 1, 2, 1),
+                         instructions[1])
+        self.assertEqual(1, run_filter(instructions, b'\x01'))
+        self.assertEqual(2, run_filter(instructions, b'\x02'))
+        self.assertEqual(len(instructions) * 8, len(program.pack()))
+
+    def test_unknown_label(self):
+        program = BpfProgram()
+        program.jeq(1, jf='nowhere')
+        with self.assertRaises(BpfAssemblerError):
+            program.assemble()
+
+    def test_backward_jump(self):
+        program = BpfProgram()
+        program.label('start')
+        program.jeq(1, jf='start')
+        with self.assertRaises(BpfAssemblerError):
+            program.assemble()
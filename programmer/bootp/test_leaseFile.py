@@ -0,0 +1,44 @@
+import os
+import socket
+import tempfile
+from unittest import TestCase
+from bootp.DHCPServer import DHCPServer
+from bootp.test_bootpPacket import VALID as DISCOVER
+from bootp.test_replyCache import Socket
+from tftp import negotiate
+from tftp import proto
+from tftp import state
+
+
+class TestLeaseFile(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'leases.json')
+        try:
+            self.server = DHCPServer(
+                'lo', None,
+                lease_callback=negotiate.LeaseFile(self.path).register)
+        except (AttributeError, OSError) as e:
+            self.dir.cleanup()
+            self.skipTest('No DHCP server on lo: %s' % e)
+        self.server.sock.close()
+        self.server.sock = Socket()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_profile_from_lease(self):
+        # The boot ROM is offered an address by the DHCP server...
+        self.server.handle_frame(DISCOVER)
+        ip = socket.inet_ntoa(self.server.sock.sent[0][58:62])
+
+        # ...and the TFTP server, in another process, negotiates the options
+        # of its RRQ with the ROM's profile, whatever the file requested.
+        policy = negotiate.NegotiationPolicy(
+            leases=negotiate.LeaseFile(self.path))
+        peer_state = state.TFTPState((ip, 1234), proto.OP_RRQ, '/tmp',
+                                     'zImage', 'octet')
+        opts = policy.negotiate(peer_state, {'blksize': '1468'})
+        self.assertEqual({proto.TFTP_OPTION_BLKSIZE: 512}, opts)
+        self.assertEqual(negotiate.PROFILE_AM335X_ROM.timeout,
+                         peer_state.rto())
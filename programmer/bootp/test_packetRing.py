@@ -0,0 +1,71 @@
+import os
+import socket
+from unittest import TestCase
+from bootp import Constants
+from bootp.PacketRing import PacketRing
+
+
+class TestPacketRing(TestCase):
+    def setUp(self):
+        try:
+            self.sock = socket.socket(socket.PF_PACKET, socket.SOCK_RAW)
+            self.sock.bind(('lo', Constants.ETHERNET_IP_PROTO))
+        except (AttributeError, OSError) as e:
+            self.skipTest('No packet socket on lo: %s' % e)
+        self.addCleanup(self.sock.close)
+        self.ring = PacketRing(self.sock, block_size=1 << 12, block_count=2,
+                               timeout_ms=1)
+        self.addCleanup(self.ring.close)
+
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.udp.close)
+        self.udp.bind(('127.0.0.1', 0))
+        self.port = self.udp.getsockname()[1]
+
+    def send(self, payload):
+        self.udp.sendto(payload, ('127.0.0.1', self.port))
+
+    def receive(self, payload):
+        """Return the frames of the ring carrying the payload, copied."""
+        received = []
+        for frames in self.ring.batches(timeout=1):
+            received.extend(bytes(frame) for frame in frames
+                            if bytes(frame).endswith(payload))
+            if received:
+                break
+        return received
+
+    def test_receive(self):
+        payload = os.urandom(16)
+        self.send(payload)
+        frames = self.receive(payload)
+        self.assertTrue(frames)
+        frame = frames[0]
+        self.assertEqual(Constants.ETHERNET_IP_PROTO,
+                         int.from_bytes(frame[12:14], 'big'))
+        self.assertEqual(14 + 20 + 8 + len(payload), len(frame))
+
+    def test_blocks_are_handed_back(self):
+        # More batches than blocks can only be read if each block is handed
+        # back to the kernel once read.
+        for _ in range(5):
+            payload = os.urandom(16)
+            self.send(payload)
+            self.assertTrue(self.receive(payload))
+
+    def test_views_are_released(self):
+        self.send(b'released')
+        batches = self.ring.batches(timeout=1)
+        frames = next(batches)
+        batches.close()
+        with self.assertRaises(ValueError):
+            bytes(frames[0])
+
+    def test_statistics(self):
+        self.send(b'statistics')
+        self.receive(b'statistics')
+        packets, drops = self.ring.statistics()
+        self.assertGreaterEqual(packets, 1)
+        self.assertEqual(0, drops)
+        # Reading the statistics resets the kernel's, they must add up.
+        self.assertGreaterEqual(self.ring.statistics()[0], packets)
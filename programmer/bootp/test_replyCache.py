@@ -0,0 +1,61 @@
+import struct
+from unittest import TestCase
+from bootp import DHCPServer as DHCPServerModule
+from bootp.DHCPServer import DHCPServer
+from bootp.test_bootpPacket import VALID as DISCOVER
+
+
+class Socket(object):
+    """Records the frames sent."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(bytes(data))
+
+
+def with_xid(frame, xid):
+    return frame[:46] + struct.pack('!L', xid) + frame[50:]
+
+
+class TestReplyCache(TestCase):
+    def setUp(self):
+        try:
+            self.server = DHCPServer('lo', None,
+                                     connection_callback=self.connected)
+        except (AttributeError, OSError) as e:
+            self.skipTest('No DHCP server on lo: %s' % e)
+        self.server.sock.close()
+        self.server.sock = Socket()
+        self.connections = []
+        # The metrics are process-wide, shared with the other tests.
+        self.hits = self.server.reply_cache_hits.value()
+
+    def connected(self, vendor_class):
+        self.connections.append(vendor_class)
+
+    def test_retransmit(self):
+        self.server.handle_frame(DISCOVER)
+        self.server.handle_frame(DISCOVER)
+        sent = self.server.sock.sent
+        self.assertEqual(2, len(sent))
+        self.assertEqual(sent[0], sent[1])
+        self.assertEqual(['AM335x ROM'], self.connections)
+        self.assertEqual(self.hits + 1,
+                         self.server.reply_cache_hits.value())
+
+    def test_other_transaction(self):
+        self.server.handle_frame(DISCOVER)
+        self.server.handle_frame(with_xid(DISCOVER, 0x12345678))
+        self.assertEqual(2, len(self.connections))
+        self.assertEqual(self.hits, self.server.reply_cache_hits.value())
+
+    def test_expired(self):
+        self.server.handle_frame(DISCOVER)
+        for key, (expiry, reply) in self.server.reply_cache.items():
+            self.server.reply_cache[key] = (
+                expiry - DHCPServerModule.DHCP_REPLY_CACHE_TIMEOUT, reply)
+        self.server.handle_frame(DISCOVER)
+        self.assertEqual(2, len(self.connections))
+        self.assertEqual(1, len(self.server.reply_cache))
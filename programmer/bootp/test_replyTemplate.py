@@ -0,0 +1,59 @@
+from collections import namedtuple
+from unittest import TestCase
+from bootp import Constants
+from bootp.DHCPServer import DHCPServer
+from bootp.ReplyTemplate import ReplyTemplates
+
+Request = namedtuple('Request', 'op xid client_mac')
+
+
+def build(request_pkt, client_ip, filename):
+    return DHCPServer._encode_dhcp_reply(request_pkt, client_ip, filename,
+                                         'de:ad:be:ef:00:11', '192.168.4.1',
+                                         '255.255.255.0', '192.168.4.1',
+                                         '192.168.4.1', None)
+
+
+class TestReplyTemplates(TestCase):
+    def setUp(self):
+        self.builds = 0
+
+        def counting_build(*args):
+            self.builds += 1
+            return build(*args)
+        self.templates = ReplyTemplates(counting_build)
+
+    def test_same_as_encoded(self):
+        requests = [
+            (Request(Constants.DHCP_OP_DHCPDISCOVER, 0x0c550101,
+                     b'\xc8\xdf\x84\xaf\x98\x88'), '192.168.4.2', 'zImage'),
+            (Request(Constants.DHCP_OP_DHCPREQUEST, 0xffffffff,
+                     b'\x00\x11\x22\x33\x44\x55'), '192.168.4.254',
+             'u-boot-spl-restore.bin'),
+            (Request(Constants.DHCP_OP_DHCPDISCOVER, 0,
+                     b'\xff' * 6), '192.168.4.17', 'u-boot-restore.img'),
+            (Request(Constants.DHCP_OP_DHCPREQUEST, 42,
+                     b'\xc8\xdf\x84\xaf\x98\x88'), '192.168.4.2', 'zImage'),
+        ]
+        for request, client_ip, filename in requests:
+            self.assertEqual(build(request, client_ip, filename),
+                             self.templates.encode(request, client_ip,
+                                                   filename))
+
+    def test_built_once(self):
+        request = Request(Constants.DHCP_OP_DHCPDISCOVER, 1, bytes(6))
+        for i in range(10):
+            self.templates.encode(request, '192.168.4.%d' % (i + 2), 'zImage')
+        self.assertEqual(1, self.builds)
+        self.templates.encode(request, '192.168.4.2', 'u-boot-restore.img')
+        self.assertEqual(2, self.builds)
+        self.templates.clear()
+        self.templates.encode(request, '192.168.4.2', 'zImage')
+        self.assertEqual(3, self.builds)
+
+    def test_template_unchanged(self):
+        request = Request(Constants.DHCP_OP_DHCPREQUEST, 7, b'\x01' * 6)
+        template = self.templates.template(request.op, 'zImage')
+        self.templates.encode(request, '192.168.4.9', 'zImage')
+        self.assertEqual(template,
+                         self.templates.template(request.op, 'zImage'))
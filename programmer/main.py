@@ -1,11 +1,19 @@
+import argparse
 import threading
 import logging
 from .bootp.DHCPServer import DHCPServer
 import netifaces
 import time
 from .state.event_handler import EventHandler
+from .metrics import exporter
+from .tftp import negotiate
 from logging.handlers import RotatingFileHandler
 
+# Interfaces whose DHCP server receives frames from a packet ring, rather
+# than with a recv() call each. It falls back to recv() if the ring cannot be
+# set up.
+PACKET_RING_INTERFACES = {'usb0', 'usb1', 'usb2', 'usb3'}
+
 
 def wait_for_interface(iface, poll_time, logger, handler):
     logger.info("Waiting for %s to become available", iface)
@@ -26,28 +34,40 @@ def wait_for_interface(iface, poll_time, logger, handler):
         handler.no_connection()
 
 
-def start_bootp(iface, ip, handler):
+def start_bootp(iface, ip, handler, leases):
     try:
         log.info("bootp for %s on ip %s", iface, ip)
-        server = DHCPServer(iface, None, ip, ip, connection_callback=handler.handle_connection)
+        server = DHCPServer(iface, None, ip, ip, connection_callback=handler.handle_connection,
+                            lease_callback=leases.register,
+                            packet_ring=iface in PACKET_RING_INTERFACES)
         server.serve_forever()
     except:
         log.info('Network is disconnected')
 
 
-def dhcp_thread(iface, handler):
+def dhcp_thread(iface, handler, leases):
     logging.info("starting thread %s", iface)
     while True:
         try:
             address = wait_for_interface(iface, 0.5, log, handler)
             logging.info("found interface with ip : %s", address)
-            start_bootp(iface, address)
+            start_bootp(iface, address, handler, leases)
         except Exception as ex:
             log.error("unhandled exception occurred on thread %s", iface)
             log.exception(ex)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='BeagleBone programming station')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='localhost port the DHCP metrics are served on, '
+                             'in the Prometheus text format (default: '
+                             'disabled)')
+    parser.add_argument('--metrics-snapshot', metavar='FILE',
+                        help='JSON file the DHCP metrics are written to every '
+                             'minute')
+    args = parser.parse_args()
+
     h1 = EventHandler(7, 11, 13)
     h2 = EventHandler(15, 29, 31)
     h3 = EventHandler(12, 16, 18)
@@ -62,10 +82,20 @@ if __name__ == "__main__":
     log = logging.getLogger('main')
     log.info("System Started")
 
-    usb1_thread = threading.Thread(target=dhcp_thread, args=('usb0', h1))
-    usb2_thread = threading.Thread(target=dhcp_thread, args=('usb1', h2))
-    usb3_thread = threading.Thread(target=dhcp_thread, args=('usb2', h3))
-    usb4_thread = threading.Thread(target=dhcp_thread, args=('usb3', h4))
+    if args.metrics_port:
+        exporter.MetricsHTTPServer(args.metrics_port).start()
+    if args.metrics_snapshot:
+        exporter.SnapshotWriter(args.metrics_snapshot).start()
+
+    # The TFTP server, which runs in its own process, picks the option
+    # profile of each client from the vendor class it leased its address
+    # with.
+    leases = negotiate.LeaseFile()
+
+    usb1_thread = threading.Thread(target=dhcp_thread, args=('usb0', h1, leases))
+    usb2_thread = threading.Thread(target=dhcp_thread, args=('usb1', h2, leases))
+    usb3_thread = threading.Thread(target=dhcp_thread, args=('usb2', h3, leases))
+    usb4_thread = threading.Thread(target=dhcp_thread, args=('usb3', h4, leases))
     usb1_thread.start()
     usb2_thread.start()
     usb3_thread.start()
@@ -0,0 +1,185 @@
+"""Metrics exporters.
+
+The metrics of a registry are served in the Prometheus text exposition
+format, and as JSON, by an HTTP server listening on localhost:
+
+    GET /metrics        Prometheus text format
+    GET /metrics.json   JSON snapshot
+
+They can also be written to a JSON snapshot file at a regular interval, for
+boards that are not scraped. Snapshot files are replaced atomically.
+"""
+
+import http.server
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from metrics import registry as metrics_registry
+
+log = logging.getLogger('metrics')
+
+# Default port of the HTTP exporter.
+METRICS_DEFAULT_PORT = 9110
+
+# Default interval between two JSON snapshots, in seconds.
+METRICS_SNAPSHOT_SECS = 60
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    escaped = [str(value).replace('\\', '\\\\').replace('\n', '\\n')
+               .replace('"', '\\"') for value in values]
+    return '{%s}' % ','.join('%s="%s"' % pair
+                             for pair in zip(names, escaped))
+
+
+def prometheus_text(registry=None):
+    """Return the metrics of the registry, the process-wide one by default,
+    in the Prometheus text exposition format."""
+    registry = registry or metrics_registry.get_registry()
+
+    lines = []
+    for metric in registry.metrics():
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for values, value in sorted(metric.samples()):
+            if metric.kind != metrics_registry.HISTOGRAM:
+                lines.append('%s%s %s' % (
+                        metric.name,
+                        _format_labels(metric.labelnames, values),
+                        _format_value(value)))
+                continue
+
+            buckets, total, count = value
+            names = metric.labelnames + ('le',)
+            bounds = metric.buckets + (float('inf'),)
+            for bound, n in zip(bounds, buckets):
+                lines.append('%s_bucket%s %d' % (
+                        metric.name,
+                        _format_labels(names, values + (_format_value(
+                                float(bound)),)), n))
+            labels = _format_labels(metric.labelnames, values)
+            lines.append('%s_sum%s %s' % (metric.name, labels,
+                                          _format_value(total)))
+            lines.append('%s_count%s %d' % (metric.name, labels, count))
+    return '\n'.join(lines) + '\n'
+
+
+def json_snapshot(registry=None):
+    """Return the metrics of the registry, the process-wide one by default,
+    as a JSON serializable dictionnary."""
+    registry = registry or metrics_registry.get_registry()
+
+    snapshot = {'timestamp': time.time(), 'metrics': {}}
+    for metric in registry.metrics():
+        samples = []
+        for values, value in sorted(metric.samples()):
+            sample = {'labels': dict(zip(metric.labelnames, values))}
+            if metric.kind == metrics_registry.HISTOGRAM:
+                buckets, total, count = value
+                sample['buckets'] = dict(zip(
+                        [str(bound) for bound in metric.buckets] + ['+Inf'],
+                        buckets))
+                sample['sum'] = total
+                sample['count'] = count
+            else:
+                sample['value'] = value
+            samples.append(sample)
+        snapshot['metrics'][metric.name] = {
+            'type': metric.kind,
+            'help': metric.help,
+            'samples': samples,
+        }
+    return snapshot
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        registry = self.server.registry
+        if self.path == '/metrics':
+            body = prometheus_text(registry).encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path == '/metrics.json':
+            body = json.dumps(json_snapshot(registry)).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('%s - %s', self.address_string(), format % args)
+
+
+class MetricsHTTPServer(threading.Thread):
+    """A thread serving the metrics over HTTP."""
+
+    def __init__(self, port=METRICS_DEFAULT_PORT, address='127.0.0.1',
+                 registry=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.httpd = http.server.ThreadingHTTPServer(
+                (address, port), _MetricsRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = registry or metrics_registry.get_registry()
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def run(self):
+        log.info('Serving metrics on http://%s:%d/metrics',
+                 *self.httpd.server_address[:2])
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class SnapshotWriter(threading.Thread):
+    """A thread writing the metrics to a JSON file at a regular interval."""
+
+    def __init__(self, path, interval=METRICS_SNAPSHOT_SECS, registry=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.registry = registry or metrics_registry.get_registry()
+        self.stopped = threading.Event()
+
+    def write(self):
+        """Write a snapshot now."""
+        tmppath = '%s.tmp' % self.path
+        with open(tmppath, 'w') as f:
+            json.dump(json_snapshot(self.registry), f)
+        os.replace(tmppath, self.path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                log.error('Could not write the metrics snapshot %s: %s',
+                          self.path, e)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,244 @@
+"""Metrics registry.
+
+Counters and histograms are updated from the serving threads, on every
+packet, so updating one must cost next to nothing: each thread updates its
+own cells, without any lock, and the cells of all threads are only added up
+when the metrics are collected, e.g. by the exporter. The cells of threads
+that are gone are folded into a total when collected, or when another thread
+gets its cells.
+
+Gauges are either set, or computed when collected by a function, e.g. the
+size of a table.
+
+Metrics may have labels. A labelled metric is a family of children, one per
+set of label values:
+
+    requests = registry.counter('tftp_requests_total', 'TFTP requests.',
+                                ['op'])
+    requests.labels('RRQ').inc()
+"""
+
+import bisect
+import threading
+import weakref
+
+# Default histogram buckets, for durations in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+class _Cells(object):
+    """Per-thread cells of a metric, each a list of numbers of the given
+    length, added up when collected."""
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.cells = []                     # (thread weakref, cell)
+        self.dead = [0] * size              # Sum of the dead threads' cells
+        self.lock = threading.Lock()
+
+    def cell(self):
+        """Return the calling thread's cell, creating it."""
+        cell = [0] * self.size
+        with self.lock:
+            self._fold()
+            self.cells.append((weakref.ref(threading.current_thread()), cell))
+        self.local.cell = cell
+        return cell
+
+    def _fold(self):
+        """Fold the cells of the dead threads into the total. Must be called
+        with the lock held."""
+        alive = []
+        for ref, cell in self.cells:
+            thread = ref()
+            if thread is not None and thread.is_alive():
+                alive.append((ref, cell))
+            else:
+                self.dead = [a + b for a, b in zip(self.dead, cell)]
+        self.cells = alive
+
+    def total(self):
+        with self.lock:
+            self._fold()
+            total = list(self.dead)
+            for _, cell in self.cells:
+                for i, value in enumerate(cell):
+                    total[i] += value
+        return total
+
+
+class Metric(object):
+    """A metric family, whose children are the metrics with a given set of
+    label values. A metric without labels is its own only child."""
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """Return the child of the given label values."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('%s expects labels %s' % (self.name,
+                                                           self.labelnames))
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def samples(self):
+        """Return the (label values, child value) pairs of the family."""
+        with self._lock:
+            children = list(self._children.items())
+        return [(values, child.value()) for values, child in children]
+
+    def _child(self):
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    """A monotonically increasing count."""
+
+    kind = COUNTER
+
+    def __init__(self, name, help, labelnames=()):
+        Metric.__init__(self, name, help, labelnames)
+        self._cells = _Cells(1)
+        if not self.labelnames:
+            self._children[()] = self
+
+    def _child(self):
+        return Counter(self.name, self.help)
+
+    def inc(self, amount=1):
+        try:
+            self._cells.local.cell[0] += amount
+        except AttributeError:
+            self._cells.cell()[0] += amount
+
+    def value(self):
+        return self._cells.total()[0]
+
+
+class Gauge(Metric):
+    """A value that goes up and down, set or computed when collected."""
+
+    kind = GAUGE
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        Metric.__init__(self, name, help, labelnames)
+        self.function = function
+        self._value = 0
+        if not self.labelnames:
+            self._children[()] = self
+
+    def _child(self):
+        return Gauge(self.name, self.help)
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        """Compute the value of the gauge with the given function."""
+        self.function = function
+
+    def value(self):
+        if self.function is not None:
+            return self.function()
+        return self._value
+
+
+class Histogram(Metric):
+    """A distribution of observed values, counted in buckets."""
+
+    kind = HISTOGRAM
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # A cell per bucket, then the +Inf bucket, the sum and the count.
+        self._cells = _Cells(len(self.buckets) + 3)
+        if not self.labelnames:
+            self._children[()] = self
+
+    def _child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value):
+        try:
+            cell = self._cells.local.cell
+        except AttributeError:
+            cell = self._cells.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def value(self):
+        """Return the cumulative bucket counts, including +Inf, the sum and
+        the count of the observed values."""
+        total = self._cells.total()
+        cumulative = []
+        count = 0
+        for n in total[:-2]:
+            count += n
+            cumulative.append(count)
+        return cumulative, total[-2], total[-1]
+
+
+class Registry(object):
+    """A collection of metrics, by name."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif type(metric) != cls:
+                raise ValueError('%s is already registered as a %s' %
+                                 (name, metric.kind))
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        """Return the counter of the given name, registering it if
+        needed."""
+        return self._register(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=(), function=None):
+        """Return the gauge of the given name, registering it if needed."""
+        return self._register(Gauge, name, help, labelnames,
+                              function=function)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Return the histogram of the given name, registering it if
+        needed."""
+        return self._register(Histogram, name, help, labelnames,
+                              buckets=buckets)
+
+    def metrics(self):
+        """Return the registered metrics, sorted by name."""
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+
+# The process-wide registry.
+_registry = Registry()
+
+
+def get_registry():
+    """Return the process-wide metrics registry."""
+    return _registry
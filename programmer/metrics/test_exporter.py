@@ -0,0 +1,61 @@
+import json
+import os
+import tempfile
+import urllib.request
+from unittest import TestCase
+from metrics import exporter
+from metrics.registry import Registry
+
+
+class TestExporter(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.registry.counter('dhcp_replies_total', 'DHCP replies.',
+                              ['interface', 'type']).labels(
+                                      'usb0', 'offer').inc(3)
+        self.registry.gauge('tftp_sessions', 'Sessions.').set(2)
+        self.registry.histogram('tftp_transfer_seconds', 'Durations.',
+                                ['file'], buckets=(1,)).labels(
+                                        'MLO').observe(0.5)
+
+    def test_prometheus_text(self):
+        self.assertEqual(
+            '# HELP dhcp_replies_total DHCP replies.\n'
+            '# TYPE dhcp_replies_total counter\n'
+            'dhcp_replies_total{interface="usb0",type="offer"} 3\n'
+            '# HELP tftp_sessions Sessions.\n'
+            '# TYPE tftp_sessions gauge\n'
+            'tftp_sessions 2\n'
+            '# HELP tftp_transfer_seconds Durations.\n'
+            '# TYPE tftp_transfer_seconds histogram\n'
+            'tftp_transfer_seconds_bucket{file="MLO",le="1.0"} 1\n'
+            'tftp_transfer_seconds_bucket{file="MLO",le="+Inf"} 1\n'
+            'tftp_transfer_seconds_sum{file="MLO"} 0.5\n'
+            'tftp_transfer_seconds_count{file="MLO"} 1\n',
+            exporter.prometheus_text(self.registry))
+
+    def test_http(self):
+        server = exporter.MetricsHTTPServer(0, registry=self.registry)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:%d/metrics' % server.port
+            with urllib.request.urlopen(url) as response:
+                self.assertIn(b'tftp_sessions 2\n', response.read())
+            with urllib.request.urlopen(url + '.json') as response:
+                snapshot = json.loads(response.read().decode('utf-8'))
+            self.assertEqual(
+                    [{'labels': {}, 'value': 2}],
+                    snapshot['metrics']['tftp_sessions']['samples'])
+        finally:
+            server.shutdown()
+
+    def test_snapshot_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.json')
+            exporter.SnapshotWriter(path, registry=self.registry).write()
+            with open(path) as f:
+                snapshot = json.load(f)
+        samples = snapshot['metrics']['tftp_transfer_seconds']['samples']
+        self.assertEqual([{'labels': {'file': 'MLO'},
+                           'buckets': {'1': 1, '+Inf': 1},
+                           'sum': 0.5, 'count': 1}], samples)
@@ -0,0 +1,60 @@
+import threading
+from unittest import TestCase
+from metrics.registry import Registry
+
+
+class TestRegistry(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_across_threads(self):
+        counter = self.registry.counter('packets_total', 'Packets.')
+
+        def count():
+            for _ in range(1000):
+                counter.inc()
+
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        self.assertLessEqual(counter.value(), 4000)
+        for thread in threads:
+            thread.join()
+        counter.inc(5)
+
+        # Collected twice, once the threads are gone.
+        self.assertEqual(4005, counter.value())
+        self.assertEqual(4005, counter.value())
+
+    def test_labels(self):
+        counter = self.registry.counter('requests_total', 'Requests.',
+                                        ['op'])
+        counter.labels('RRQ').inc()
+        counter.labels('RRQ').inc()
+        counter.labels('WRQ').inc()
+        self.assertEqual([(('RRQ',), 2), (('WRQ',), 1)],
+                         sorted(counter.samples()))
+        with self.assertRaises(ValueError):
+            counter.labels('RRQ', 'extra')
+
+    def test_registered_once(self):
+        counter = self.registry.counter('requests_total', 'Requests.')
+        self.assertIs(counter,
+                      self.registry.counter('requests_total', 'Requests.'))
+        with self.assertRaises(ValueError):
+            self.registry.gauge('requests_total', 'Requests.')
+
+    def test_gauge(self):
+        gauge = self.registry.gauge('sessions', 'Sessions.')
+        gauge.set(3)
+        self.assertEqual(3, gauge.value())
+        sessions = [1, 2]
+        gauge.set_function(lambda: len(sessions))
+        self.assertEqual(2, gauge.value())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('seconds', 'Durations.',
+                                            buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(([2, 3, 4], 14.5, 4), histogram.value())
@@ -1,4 +1,5 @@
 import state.leds as leds
+from metrics import registry
 from threading import Thread
 from time import sleep
 
@@ -11,10 +12,30 @@ READY_LIMIT = 4 * 30 # 30 Seconds
 STARTED_LIMIT = 1 # .25 Seconds
 ERROR_LIMIT = 4 * 30 # 30 Seconds
 
+STATE_NAMES = {
+    STATE_IDLE: 'idle',
+    STATE_READY: 'ready',
+    STATE_STARTED: 'started',
+    STATE_ERROR: 'error',
+}
+
+# Board metrics, see the metrics package. Boards are named after the pins of
+# their LEDs.
+_metrics = registry.get_registry()
+_TRANSITIONS = _metrics.counter('board_state_transitions_total',
+                                'Board state transitions, by board and new '
+                                'state.', ['board', 'state'])
+_STATE = _metrics.gauge('board_state', 'Current state of each board (0 idle, '
+                        '1 ready, 2 started, 1000 error).', ['board'])
+
 
 class EventHandler:
     def __init__(self, red:int, green:int, blue:int):
+        self.name = '%d-%d-%d' % (red, green, blue)
+        _STATE.labels(self.name).set_function(lambda: self.current)
         self.current = STATE_IDLE
+        self.counted = STATE_IDLE           # Last state counted in the
+                                            # transitions metric
         self.idle_count = 0
         self.set_led_for_state()
         self.red = red
@@ -104,6 +125,11 @@ class EventHandler:
 
     def set_led_for_state(self):
         state = self.current
+        # The LEDs are set again for every request of a board, only changes
+        # of state are counted.
+        if state != self.counted:
+            _TRANSITIONS.labels(self.name, STATE_NAMES[state]).inc()
+            self.counted = state
         if state == STATE_IDLE:
             self.turn_all_off()
         elif state == STATE_READY:
@@ -1,17 +1,65 @@
+from tftp.AsyncServer import AsyncServer
 from tftp.Server import Server
+from tftp import negotiate
+from tftp import trace
+from metrics import exporter
+import argparse
 import logging
+import tempfile
 
 
-def run_server():
+def run_server(engine=Server, pacing=0, policy=None):
     iface = '0.0.0.0'
     root = '/var/tftproot'
-    port = 69 
+    port = 69
 
-    server = Server(iface, root, port)
+    server = engine(iface, root, port, pacing=pacing, policy=policy)
     server.serve_forever()
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
-    run_server()
+    parser = argparse.ArgumentParser(description='BeagleBone TFTP server')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='serve requests from an asyncio event loop')
+    parser.add_argument('--pacing', type=float, default=0, metavar='SECS',
+                        help='delay between the DATA packets of a window')
+    parser.add_argument('--blksize-table', metavar='FILE',
+                        help='JSON file of the best block size of each '
+                             'interface')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='explore block sizes across transfers and '
+                             'record their goodput in the block size table')
+    parser.add_argument('--lease-file',
+                        default=negotiate.LEASE_FILE_DEFAULT,
+                        help='JSON file the DHCP server records the vendor '
+                             'class of its clients in')
+    parser.add_argument('--trace-dir', default=tempfile.gettempdir(),
+                        help='directory the packet traces are dumped to on '
+                             'SIGUSR1, as pcap files')
+    parser.add_argument('--metrics-port', type=int,
+                        default=exporter.METRICS_DEFAULT_PORT,
+                        help='localhost port the metrics are served on, in '
+                             'the Prometheus text format (0 to disable)')
+    parser.add_argument('--metrics-snapshot', metavar='FILE',
+                        help='JSON file the metrics are written to every '
+                             'minute')
+    args = parser.parse_args()
+
+    if args.benchmark and not args.blksize_table:
+        parser.error('--benchmark requires --blksize-table')
 
+    blksizes = None
+    if args.blksize_table:
+        blksizes = negotiate.BlksizeTable(args.blksize_table,
+                                          explore=args.benchmark)
+
+    logging.basicConfig(level=logging.DEBUG)
+    trace.install_signal_handler(args.trace_dir)
+    if args.metrics_port:
+        exporter.MetricsHTTPServer(args.metrics_port).start()
+    if args.metrics_snapshot:
+        exporter.SnapshotWriter(args.metrics_snapshot).start()
+    run_server(AsyncServer if args.use_async else Server, args.pacing,
+               negotiate.NegotiationPolicy(
+                       blksizes=blksizes,
+                       leases=negotiate.LeaseFile(args.lease_file)))
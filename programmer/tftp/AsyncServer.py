@@ -0,0 +1,393 @@
+# coding=utf-8
+# This file is part of pTFTPd.
+#
+# pTFTPd is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pTFTPd is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pTFTPd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""asyncio TFTP Server.
+
+An alternative to tftp.Server.Server that serves TFTP requests from an asyncio
+event loop instead of a socketserver.UDPServer. Each transfer is driven by its
+own coroutine, which reads the peer's datagrams from the transfer's own
+ephemeral port, feeds them to the same TFTPServerHandler and TFTPState machine
+as the threaded server, and times the transfer out without blocking any other
+transfer.
+
+Requests (RRQ and WRQ), which open files, are handled in the loop's default
+executor, as are the last blocks of uploads, which wait for the file to be
+written out, so a slow storage device never stalls transfers in progress.
+Several servers, for example one per USB gadget interface, can share a
+single event loop through serve_all().
+"""
+
+import asyncio
+import os
+
+from . import cache
+from . import events
+from . import negotiate
+from . import notify
+from . import proto
+from . import sessions
+from . import timers
+from . import trace
+from .Server import TFTPServerConfigurationError, TFTPServerHandler
+from .Server import TFTPTransferHandler, REQUEST_OPS, _PTFTPD_DEFAULT_PORT
+from .Server import _PTFTPD_TRANSFER_POLL_SECS, _SESSIONS, expire_session
+
+l = notify.getLogger('tftpd')
+
+
+class AsyncTFTPServerHandler(TFTPServerHandler):
+    """
+    A TFTPServerHandler that hands its response back to the calling
+    coroutine instead of sending it, so that windows can be sent without
+    holding up the event loop.
+    """
+
+    response = None
+
+    def send_response(self, response):
+        self.response = response
+
+
+class AsyncTFTPTransferHandler(AsyncTFTPServerHandler, TFTPTransferHandler):
+    """
+    The datagram handler of a transfer's own endpoint, serving all the
+    datagrams of the transfer.
+    """
+
+
+class TFTPDatagramProtocol(asyncio.DatagramProtocol):
+    """Hands the datagrams received on an endpoint to a callback."""
+
+    def __init__(self, receive):
+        self.receive = receive
+
+    def datagram_received(self, data, addr):
+        self.receive(data, addr)
+
+    def error_received(self, exc):
+        l.debug('Socket error: %s', exc)
+
+
+class AsyncServer(object):
+    def __init__(self, ip, root, port=_PTFTPD_DEFAULT_PORT,
+                 strict_rfc1350=True, notification_callbacks=None,
+                 image_cache_size=cache.IMAGE_CACHE_DEFAULT_SIZE,
+                 packet_tables=False, pacing=0, policy=None,
+                 netascii_images=False, fsync=True, sync_bytes=0):
+
+        if notification_callbacks is None:
+            notification_callbacks = {}
+
+        self.ip, self.root, self.port, self.strict_rfc1350 = ip, root, port, strict_rfc1350
+        self.clients = sessions.SessionTable(expired=self.expire)
+        self.transfer_ip = ip
+        self.transport = None
+        self.loop = None
+        # Running transfers, by state.
+        self.transfers = {}
+        self.timers = timers.TimerWheel()
+        self.pacing = pacing
+        self.bursts = {}
+        self.policy = policy or negotiate.NegotiationPolicy()
+
+        if not os.path.isdir(self.root):
+            raise TFTPServerConfigurationError(
+                'The specified TFTP root does not exist')
+
+        if image_cache_size:
+            self.image_cache = cache.get_image_cache()
+            self.image_cache.set_max_bytes(image_cache_size)
+        else:
+            self.image_cache = None
+        self.packet_tables = packet_tables and bool(image_cache_size)
+        self.netascii_images = netascii_images and bool(image_cache_size)
+        self.fsync = fsync
+        self.sync_bytes = sync_bytes
+
+        # Trace of the packets sent and received with peers of unknown
+        # interfaces, see Server.get_peer_trace_ring().
+        self.trace = trace.get_trace_ring(ip, ip)
+
+        _SESSIONS.labels(ip).set_function(lambda: len(self.clients))
+
+        # Transfer notifications are delivered by the event bus' thread, off
+        # the event loop.
+        if notification_callbacks:
+            events.get_event_bus().subscribe(events.NotifyAdapter(
+                    notify.CallbackEngine(notification_callbacks)))
+
+    def datagram_received(self, data, peer):
+        asyncio.ensure_future(self.request(data, peer))
+
+    async def request(self, data, peer):
+        """Serve a datagram received on the server port, and run the
+        transfer it starts, if any."""
+        loop = asyncio.get_running_loop()
+        request = (data, self.transport)
+
+        try:
+            opcode = proto.TFTPHelper.get_opcode(data)
+        except SyntaxError:
+            opcode = None
+
+        if opcode in REQUEST_OPS:
+            handler = await loop.run_in_executor(
+                    None, AsyncTFTPServerHandler, request, peer, self)
+        else:
+            handler = AsyncTFTPServerHandler(request, peer, self)
+
+        if handler.socket is self.transport:
+            await self.send_response(self.transport, handler.response, peer,
+                                     self.port, handler.trace)
+            return
+
+        # The request started a new transfer, on its own socket. Make sure a
+        # duplicate request did not replace it in the meantime.
+        peer_state = self.clients.get(peer)
+        if peer_state is None or peer_state.sock is not handler.socket:
+            handler.socket.close()
+            return
+
+        await self.transfer(peer_state, handler.response)
+
+    def start_transfer(self, peer_state):
+        # Transfers are run by the coroutine that served their request.
+        pass
+
+    def resend_transfer(self, peer_state):
+        """Have a running transfer resend its unacknowledged packets, e.g.
+        on a duplicate request. Called from the executor."""
+        def resend():
+            transfer = self.transfers.get(peer_state)
+            # A transfer yet to start sends its first reply anyway.
+            if transfer is not None:
+                transfer.resend()
+
+        self.loop.call_soon_threadsafe(resend)
+
+    def expire(self, peer, peer_state):
+        """Clean up after a timed out client, unless its transfer is serving
+        a packet off the event loop, in which case the transfer cleans up
+        once done."""
+        transfer = self.transfers.get(peer_state)
+        if transfer is not None and transfer.lock.locked():
+            transfer.expired = True
+            return
+        expire_session(peer, peer_state)
+
+    async def transfer(self, peer_state, response):
+        """Run a transfer on its own endpoint until it completes or times
+        out."""
+        transfer = AsyncTransfer(self, peer_state)
+        await transfer.run(response)
+
+    async def send_response(self, transport, response, peer, port, ring):
+        """Send a response packet sequence (see
+        TFTPServerHandler.send_response) to the peer from the given local
+        port, recording it in the given trace ring, letting other transfers
+        run between the packets of a window, and pacing them if asked to."""
+        while response:
+            delay = 0
+            if type(response) == tuple:
+                if len(response) > 2:
+                    delay = response[2]
+                message, response = response[:2]
+            else:
+                message, response = response, None
+
+            if type(message) == list:
+                message = b''.join(message)
+            ring.record(trace.TRACE_OUT, message, peer, port)
+            transport.sendto(message, peer)
+
+            if response:
+                await asyncio.sleep(delay)
+                response = response()
+
+    async def serve(self):
+        """Serve TFTP requests on the running event loop, forever."""
+        loop = self.loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: TFTPDatagramProtocol(self.datagram_received),
+                local_addr=(self.ip, self.port))
+
+        l.info('Serving TFTP requests on %s:%d in %s',
+               self.ip, self.port, self.root)
+        try:
+            while True:
+                await asyncio.sleep(self.timers.tick)
+                self.timers.advance()
+                self.clients.reap()
+        finally:
+            self.transport.close()
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+
+class AsyncTransfer(object):
+    """
+    A transfer served by a coroutine of the event loop, from its own
+    endpoint, until it ends or times out.
+    """
+
+    def __init__(self, server, peer_state):
+        self.server = server
+        self.peer_state = peer_state
+        self.queue = asyncio.Queue()
+        self.transport = None
+        self.timer = None
+        self.trace = None
+
+        # Held while a packet is served off the event loop, during which
+        # nothing else may touch the state: the retransmission timer is
+        # stopped, and an expired state is left to the transfer.
+        self.lock = asyncio.Lock()
+        self.expired = False
+
+    async def run(self, response):
+        loop = asyncio.get_running_loop()
+        server, peer_state = self.server, self.peer_state
+        peer = peer_state.peer
+
+        self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: TFTPDatagramProtocol(
+                        lambda data, addr: self.queue.put_nowait(data)),
+                sock=peer_state.sock)
+
+        handler = AsyncTFTPTransferHandler(self.transport, peer, server,
+                                           peer_state.tid)
+        self.trace = handler.trace
+        server.transfers[peer_state] = self
+
+        try:
+            await server.send_response(self.transport, response, peer,
+                                       peer_state.tid, self.trace)
+            self.arm()
+
+            # The transfer is over once its state is gone from the table,
+            # whether it completed, failed or expired.
+            while server.clients.get(peer) is peer_state:
+                try:
+                    data = await asyncio.wait_for(self.queue.get(),
+                                                  _PTFTPD_TRANSFER_POLL_SECS)
+                except asyncio.TimeoutError:
+                    continue
+
+                if data is None:
+                    continue
+
+                # Uploads wait for their file to be written out on their last
+                # block, which must not stall the event loop.
+                blocks = self.blocks(data)
+                if blocks:
+                    async with self.lock:
+                        self.timer.cancel()
+                        response = await loop.run_in_executor(
+                                None, handler.serve, data)
+                else:
+                    response = handler.serve(data)
+                await server.send_response(self.transport, response, peer,
+                                           peer_state.tid, self.trace)
+                if response or blocks:
+                    self.arm()
+        except Exception:
+            l.exception('Server Error.')
+        finally:
+            server.transfers.pop(peer_state, None)
+            if self.timer is not None:
+                self.timer.cancel()
+            # Unless the packet it was serving completed it.
+            if self.expired and not peer_state.done:
+                expire_session(peer, peer_state)
+            # The state may also have been replaced by a new request.
+            peer_state.close()
+            self.transport.close()
+
+    def blocks(self, data):
+        """Returns whether serving a datagram may wait for an upload to be
+        written out, which is done off the event loop: the last block of
+        the upload completes it, possibly along with blocks received ahead
+        of it."""
+        peer_state = self.peer_state
+        return (peer_state.op == proto.OP_WRQ and
+                (bool(peer_state.ahead) or
+                 len(data) - proto.DATA_HEADER.size <
+                 peer_state.opts[proto.TFTP_OPTION_BLKSIZE]))
+
+    def arm(self):
+        """(Re)arm the retransmission timer of the transfer."""
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.server.timers.schedule(self.peer_state.rto(),
+                                                 self.retransmit)
+
+    def send(self, packets):
+        peer_state = self.peer_state
+        for packet in packets:
+            if type(packet) == list:
+                packet = b''.join(packet)
+            self.trace.record(trace.TRACE_OUT, packet, peer_state.peer,
+                              peer_state.tid)
+            self.transport.sendto(packet, peer_state.peer)
+
+    def resend(self):
+        """Resend the unacknowledged packets, e.g. on a duplicate
+        request."""
+        peer_state = self.peer_state
+        if self.server.clients.get(peer_state.peer) is not peer_state or \
+                self.lock.locked():
+            return
+
+        l.debug('Resending %d packet(s) to %s:%d.', len(peer_state.unacked),
+                *peer_state.peer)
+        self.send(peer_state.resend())
+        self.arm()
+
+    def retransmit(self):
+        """Retransmission timer callback."""
+        server, peer_state = self.server, self.peer_state
+        if server.clients.get(peer_state.peer) is not peer_state:
+            return
+
+        packets = peer_state.retransmit()
+        if packets is None:
+            l.warning('Transfer of %s abandoned after %d retransmissions.',
+                      peer_state.filename, peer_state.retransmits)
+            events.publish(events.FAILED, peer_state)
+            peer_state.close()
+            server.clients.pop(peer_state.peer)
+            # Wake the transfer up so that it ends.
+            self.queue.put_nowait(None)
+            return
+
+        if not packets:
+            return
+
+        l.debug('Retransmitting %d packet(s) to %s:%d.', len(packets),
+                *peer_state.peer)
+        self.send(packets)
+        self.arm()
+
+
+def serve_all(servers):
+    """Serve TFTP requests for all the given AsyncServers from a single event
+    loop, forever."""
+
+    async def _serve():
+        await asyncio.gather(*[server.serve() for server in servers])
+
+    asyncio.run(_serve())
@@ -24,23 +24,37 @@
 pTFTPd is a simple TFTP daemon written in Python. It fully supports
 the TFTP specification as defined in RFC1350. It also supports the
 TFTP Option Extension protocol (per RFC2347), the block size option as
-defined in RFC2348 and the transfer size option from RFC2349.
+defined in RFC2348 and the timeout interval and transfer size options
+from RFC2349.
 
-Note that this program currently does *not* support the timeout
-interval option from RFC2349.
+The server retransmits unacknowledged packets after the negotiated timeout
+interval (or one second by default), backing off exponentially. Windows
+(RFC7440) are sent in bursts whose size adapts to packet loss, additively
+growing on clean windows and halving on lost packets, optionally paced.
 """
 
 import errno
+import ipaddress
 import netifaces
 import os
-import subprocess
+import socket
 import stat
+import struct
 import threading
 import time
 
+from metrics import registry
+
+from . import cache
+from . import events
+from . import negotiate
 from . import notify
 from . import proto
+from . import sessions
 from . import state
+from . import timers
+from . import trace
+from . import writer
 
 try:
     import SocketServer as socketserver  # Py2
@@ -53,11 +67,82 @@ _PTFTPD_SERVER_NAME = 'bbbTftp'
 _PTFTPD_DEFAULT_PORT = 69
 _PTFTPD_DEFAULT_PATH = '/tftpboot'
 
-
-def get_max_udp_datagram_size():
-    """Retrieve the maximum UDP datagram size allowed by the system."""
-    val = subprocess.check_output(['sysctl', '-n', 'net.inet.udp.maxdgram'])
-    return int(val)
+# Largest datagram a transfer socket may receive.
+_PTFTPD_MAX_DATAGRAM = 65536
+
+# Interval at which transfer threads check that their transfer is still
+# alive while waiting for a packet.
+_PTFTPD_TRANSFER_POLL_SECS = 1
+
+# Opcodes served on the server port, and on per-transfer ports.
+REQUEST_OPS = frozenset([proto.OP_RRQ, proto.OP_WRQ])
+TRANSFER_OPS = frozenset([proto.OP_DATA, proto.OP_ACK, proto.OP_ERROR])
+
+# Server metrics, see the metrics package.
+_metrics = registry.get_registry()
+_PACKETS = _metrics.counter('tftp_packets_received_total',
+                            'TFTP packets received, by opcode.', ['opcode'])
+_PACKETS_BY_OPCODE = {opcode: _PACKETS.labels(name)
+                      for opcode, name in proto.TFTP_OPS.items()}
+_PACKETS_INVALID = _PACKETS.labels('invalid')
+_SESSIONS = _metrics.gauge('tftp_sessions', 'TFTP transfers in progress, by '
+                           'server address.', ['address'])
+
+
+def open_transfer_socket(ip, peer):
+    """Open the socket of a new transfer with the given peer, bound to an
+    ephemeral port (the transfer ID). The socket is connected to the peer,
+    so that the kernel only delivers the transfer's own packets to it."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind((ip, 0))
+        sock.connect(peer)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def send_packet(sock, packet, address):
+    """Send a packet to the given address. Scatter/gather vectors are sent
+    as one datagram, without being copied."""
+    if type(packet) == list:
+        sock.sendmsg(packet, [], 0, address)
+    else:
+        sock.sendto(packet, address)
+
+
+def get_interfaces():
+    """Generate the (ipaddress.IPv4Interface, name) pairs of the IPv4
+    addresses of the network interfaces."""
+    for interface in netifaces.interfaces():
+        for addr in netifaces.ifaddresses(interface).get(netifaces.AF_INET,
+                                                         []):
+            try:
+                yield ipaddress.IPv4Interface(
+                        '%s/%s' % (addr['addr'], addr['netmask'])), interface
+            except (KeyError, ValueError):
+                continue
+
+
+_peer_interfaces = negotiate.PeerInterfaces(get_interfaces)
+
+
+def get_peer_interface(peer_ip):
+    """Return the name of the network interface whose IPv4 subnet holds the
+    given peer address, or None. The addresses of the interfaces are cached,
+    see negotiate.PeerInterfaces."""
+    return _peer_interfaces.get(peer_ip)
+
+
+def get_peer_trace_ring(peer_ip, default):
+    """Return the trace ring of the network interface the given peer is
+    reached through, recording the interface's address, or the given default
+    ring if the interface is unknown."""
+    found = _peer_interfaces.find(peer_ip)
+    if found is None:
+        return default
+    return trace.get_trace_ring(*found)
 
 
 class TFTPServerConfigurationError(Exception):
@@ -65,43 +150,140 @@ class TFTPServerConfigurationError(Exception):
     pass
 
 
+class BufferPool(object):
+    """
+    A pool of preallocated datagram receive buffers, reused from one
+    transfer to the next.
+    """
+
+    def __init__(self, size=_PTFTPD_MAX_DATAGRAM, limit=64):
+        self.size = size
+        self.limit = limit
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return bytearray(self.size)
+
+    def release(self, buffer):
+        with self._lock:
+            if len(self._free) < self.limit:
+                self._free.append(buffer)
+
+
+class TFTPUDPServer(socketserver.UDPServer):
+    """
+    A UDPServer receiving requests into a preallocated buffer, rather than
+    into a new bytes object for every datagram. Requests are handled one at
+    a time, so handlers get a memoryview of the buffer, valid until they
+    return.
+    """
+
+    max_packet_size = _PTFTPD_MAX_DATAGRAM
+
+    def __init__(self, server_address, RequestHandlerClass):
+        self.buffer = bytearray(self.max_packet_size)
+        self.view = memoryview(self.buffer)
+        socketserver.UDPServer.__init__(self, server_address,
+                                        RequestHandlerClass)
+
+    def get_request(self):
+        size, client_addr = self.socket.recvfrom_into(self.buffer)
+        return (self.view[:size], self.socket), client_addr
+
+
 # noinspection PyPep8Naming
-class TFTPServerHandler(socketserver.DatagramRequestHandler):
+class TFTPServerHandler(socketserver.BaseRequestHandler):
     """
     The SocketServer UDP datagram handler for the TFTP protocol.
+
+    Requests (RRQ and WRQ) are served on the server port. As per RFC1350,
+    each transfer then moves to its own ephemeral port, whose datagrams are
+    served by a TFTPTransferHandler.
     """
 
+    # Opcodes accepted by this handler
+    ops = REQUEST_OPS
+
+    response = None
+
+    def setup(self):
+        self.packet, self.socket = self.request
+        self.local_port = self.server.port
+        self.trace = get_peer_trace_ring(self.client_address[0],
+                                         self.server.trace)
+
     def handle(self):
         """
         Handles an incoming request by unpacking the TFTP opcode and
         dispatching to one of the serve* method of this class.
         """
-        request = self.rfile.read()
+        self.dispatch(self.packet)
+
+    def dispatch(self, packet):
+        """
+        Serve a datagram, dispatching it to one of the serve* methods of this
+        class through the handlers table.
+
+        Args:
+          packet (bytes-like): the datagram, usually a memoryview of the
+            receive buffer. It is only valid until this method returns.
+        """
+
+        self.response = None
+        self.trace.record(trace.TRACE_IN, packet, self.client_address,
+                          self.local_port)
 
         # Get the packet opcode and dispatch
-        opcode = proto.TFTPHelper.get_opcode(request)
+        try:
+            opcode = proto.OPCODE.unpack_from(packet)[0]
+        except struct.error:
+            opcode = None
 
         if not opcode:
+            _PACKETS_INVALID.inc()
             l.error('Can\'t find packet opcode, packet ignored')
             return
         else:
             l.debug('processing opcode: %d', opcode)
 
-        if opcode not in proto.TFTP_OPS:
+        counter = _PACKETS_BY_OPCODE.get(opcode)
+        if counter is not None:
+            counter.inc()
+        else:
+            _PACKETS_INVALID.inc()
             l.error('Unknown operation %d', opcode)
             response = proto.TFTPHelper.createERROR(proto.ERROR_ILLEGAL_OP)
             self.send_response(response)
             return
 
+        if opcode not in self.ops:
+            # Never answer an ERROR packet with another one.
+            if opcode == proto.OP_ERROR:
+                return
+            l.error('Unexpected %s packet from %s:%d', proto.TFTP_OPS[opcode],
+                    *self.client_address)
+            if opcode in TRANSFER_OPS:
+                error = proto.ERROR_UNKNOWN_ID
+            else:
+                error = proto.ERROR_ILLEGAL_OP
+            self.send_response(proto.TFTPHelper.createERROR(error))
+            return
+
         response = None
         try:
-            handler = getattr(self, 'serve' + proto.TFTP_OPS[opcode])
-            response = handler(opcode, request[2:])
-        except AttributeError:
-            l.error('Unsupported operation %s', opcode)
-            response = proto.TFTPHelper.createERROR(
-                    proto.ERROR_UNDEF,
-                    'Operation not supported by server.')
+            serve = self.handlers.get(opcode)
+            if serve is None:
+                l.error('Unsupported operation %s', opcode)
+                response = proto.TFTPHelper.createERROR(
+                        proto.ERROR_UNDEF,
+                        'Operation not supported by server.')
+            else:
+                response = self.response = serve(self, opcode,
+                                                 memoryview(packet)[2:])
         except:
             l.exception('Server Error.')
             response = proto.TFTPHelper.createERROR(
@@ -115,25 +297,70 @@ class TFTPServerHandler(socketserver.DatagramRequestHandler):
         Send a response to the client.
 
         Args:
-            response (bytes or tuple): the response packet sequence. If the
-            argument is a simple bytestring object, it is sent as-is. If it is
-            a tuple, it is expected to be a 2-uple containing first a
-            bytestring packet, and second a function that, when called, returns
-            the next packet sequence to send through this method (recursively).
+            response (bytes, list or tuple): the response packet sequence. If
+            the argument is a simple bytestring object, it is sent as-is. If it
+            is a list, it is a scatter/gather vector of buffers sent as one
+            datagram. If it is a tuple, it is expected to be a 2-uple
+            containing first a packet, and second a function that, when called,
+            returns the next packet sequence to send through this method
+            (recursively), or a 3-uple with a delay to wait for, in seconds,
+            before calling that function. The packet is always sent before the
+            function is called, as the function may reuse the packet's
+            buffers.
         """
         while response:
+            delay = 0
             if type(response) == tuple:
-                message, response = response[0], response[1]()
+                if len(response) > 2:
+                    delay = response[2]
+                message, response = response[:2]
             else:
                 message, response = response, None
 
-            self.wfile.write(message)
-            self.wfile.flush()
+            self.send_message(message)
+            if response:
+                if delay:
+                    time.sleep(delay)
+                response = response()
+
+    def send_message(self, message):
+        """Send a single datagram to the client."""
+        self.trace.record(trace.TRACE_OUT, message, self.client_address,
+                          self.local_port)
+        send_packet(self.socket, message, self.client_address)
 
     def finish_state(self, peer_state):
+        # Failed requests are answered from the server port and forgotten.
+        if peer_state.state == state.STATE_ERROR:
+            events.publish(events.FAILED, peer_state)
+            return peer_state.next()
+
+        try:
+            peer_state.sock = open_transfer_socket(self.server.transfer_ip,
+                                                   self.client_address)
+        except OSError as e:
+            l.error('Could not open transfer socket: %s', e)
+            peer_state.state = state.STATE_ERROR
+            peer_state.error = proto.ERROR_UNDEF
+            events.publish(events.FAILED, peer_state)
+            return peer_state.next()
+
+        peer_state.tid = peer_state.sock.getsockname()[1]
         self.server.clients[self.client_address] = peer_state
+        self.server.start_transfer(peer_state)
+        events.publish(events.STARTED, peer_state)
+
+        # The first reply already goes out from the transfer's port.
+        self.socket = peer_state.sock
+        self.local_port = peer_state.tid
         return peer_state.next()
 
+    def resend(self, peer_state):
+        """Answer a duplicate request of a transfer in progress: the transfer
+        resends its unacknowledged packets, from its own port."""
+        self.server.resend_transfer(peer_state)
+        return None
+
     def serveRRQ(self, op, request):
         """
         Serves RRQ packets (GET requests).
@@ -152,6 +379,14 @@ class TFTPServerHandler(socketserver.DatagramRequestHandler):
             # Ignore malformed RRQ requests
             return None
 
+        # A retransmitted request means our reply got lost: send it again
+        # from the transfer's port, rather than starting over.
+        peer_state = self.server.clients.get(self.client_address)
+        if (peer_state is not None and peer_state.op == op and
+                peer_state.filename == filename and peer_state.mode == mode):
+            l.debug('Duplicate RRQ for %s, resending.', filename)
+            return self.resend(peer_state)
+
         peer_state = state.TFTPState(self.client_address, op,
                                      self.server.root, filename, mode,
                                      not self.server.strict_rfc1350)
@@ -160,13 +395,21 @@ class TFTPServerHandler(socketserver.DatagramRequestHandler):
             peer_state.state = state.STATE_ERROR
             peer_state.error = proto.ERROR_ACCESS_VIOLATION
 
-            l.warning('Out-of-jail path requested: %s!', filename,
-                      extra=peer_state.extra(notify.TRANSFER_FAILED))
+            l.warning('Out-of-jail path requested: %s!', filename)
             return self.finish_state(peer_state)
 
         try:
-            peer_state.file = open(peer_state.filepath, 'rb')
-            peer_state.filesize = os.stat(peer_state.filepath)[stat.ST_SIZE]
+            st = os.stat(peer_state.filepath)
+            peer_state.filesize = st[stat.ST_SIZE]
+            if self.server.image_cache is not None:
+                peer_state.image = self.server.image_cache.get(
+                        peer_state.filepath, st)
+            if peer_state.image is not None and mode == 'netascii' and \
+                    self.server.netascii_images:
+                peer_state.image = self.server.image_cache.get_netascii(
+                        peer_state.image)
+            if peer_state.image is None:
+                peer_state.file = open(peer_state.filepath, 'rb')
             peer_state.packetnum = 0
             peer_state.state = state.STATE_SEND
 
@@ -175,47 +418,53 @@ class TFTPServerHandler(socketserver.DatagramRequestHandler):
 
             # Only set options if not running in RFC1350 compliance mode
             # and when option were received.
-            if not self.server.strict_rfc1350 and len(opts):
-                opts = proto.TFTPHelper.parse_options(opts)
-                if opts:
-                    blksize = opts[proto.TFTP_OPTION_BLKSIZE]
-                    windowsize = opts[proto.TFTP_OPTION_WINDOWSIZE]
-                    max_window_size = int(
-                            get_max_udp_datagram_size() /
-                            proto.TFTPHelper.get_data_size(blksize))
-                    if windowsize > max_window_size:
-                        l.info('Restricting window size to %d to fit UDP.',
-                               max_window_size)
-                        opts[proto.TFTP_OPTION_WINDOWSIZE] = max_window_size
-
-                    # HOOK: this is where we should check that we accept
-                    # the options requested by the client.
-
-                    peer_state.state = state.STATE_SEND_OACK
-                    peer_state.set_opts(opts)
-                else:
-                    peer_state.file.close()
-                    peer_state.state = state.STATE_ERROR
-                    peer_state.error = proto.ERROR_OPTION_NEGOCIATION
+            if self.server.strict_rfc1350:
+                opts = {}
+            opts = self.server.policy.negotiate(
+                    peer_state, opts,
+                    get_peer_interface(self.client_address[0]))
+            if opts:
+                peer_state.state = state.STATE_SEND_OACK
+                peer_state.set_opts(opts)
+            elif opts is None:
+                peer_state.state = state.STATE_ERROR
+                peer_state.error = proto.ERROR_OPTION_NEGOCIATION
 
         except IOError as e:
             peer_state.state = state.STATE_ERROR
 
             if e.errno == errno.ENOENT:
                 peer_state.error = proto.ERROR_FILE_NOT_FOUND
-                l.warning('Client requested non-existent file %s', filename,
-                          extra=peer_state.extra(notify.TRANSFER_FAILED))
+                l.warning('Client requested non-existent file %s', filename)
             elif e.errno == errno.EACCES or e.errno == errno.EPERM:
                 peer_state.error = proto.ERROR_ACCESS_VIOLATION
-                l.error('Client requested inaccessible file %s', filename,
-                        extra=peer_state.extra(notify.TRANSFER_FAILED))
+                l.error('Client requested inaccessible file %s', filename)
             else:
                 peer_state.error = proto.ERROR_UNDEF
-                l.error('Unknown error while accessing file %s', filename,
-                        extra=peer_state.extra(notify.TRANSFER_FAILED))
+                l.error('Unknown error while accessing file %s', filename)
         except Exception as e:
             l.exception('Error occurred', e)
 
+        # Serve hot images from their precomputed DATA packets when enabled.
+        if (self.server.packet_tables and peer_state.image is not None and
+                peer_state.state in (state.STATE_SEND,
+                                     state.STATE_SEND_OACK)):
+            table = self.server.image_cache.get_packet_table(
+                    peer_state.image,
+                    peer_state.opts[proto.TFTP_OPTION_BLKSIZE],
+                    peer_state.mode)
+            # Tables wrap packet numbers around, which is only fine if the
+            # transfer does too or never gets that far.
+            if table is not None and (
+                    peer_state.loop_packetnum or
+                    len(table.packets) < proto.TFTP_PACKETNUM_MAX):
+                peer_state.packets = table.packets
+
+        # Start from the burst size the client's last transfer ended with.
+        if peer_state.state in (state.STATE_SEND, state.STATE_SEND_OACK):
+            peer_state.seed(self.server.bursts.get(self.client_address[0]))
+            peer_state.pacing = self.server.pacing
+
         return self.finish_state(peer_state)
 
     def serveWRQ(self, op, request):
@@ -244,19 +493,17 @@ class TFTPServerHandler(socketserver.DatagramRequestHandler):
             peer_state.state = state.STATE_ERROR
             peer_state.error = proto.ERROR_ACCESS_VIOLATION
 
-            l.warning('Out-of-jail path requested: %s!', filename,
-                      extra=peer_state.extra(notify.TRANSFER_FAILED))
+            l.warning('Out-of-jail path requested: %s!', filename)
             return self.finish_state(peer_state)
 
         try:
             # Try to open the file. If it succeeds, it means the file
             # already exists and report the error
-            peer_state.file = open(peer_state.filepath)
+            open(peer_state.filepath).close()
             peer_state.state = state.STATE_ERROR
             peer_state.error = proto.ERROR_FILE_ALREADY_EXISTS
 
-            l.warning('Client attempted to overwrite file %s!', filename,
-                      extra=peer_state.extra(notify.TRANSFER_FAILED))
+            l.warning('Client attempted to overwrite file %s!', filename)
             return self.finish_state(peer_state)
 
         except IOError as e:
@@ -264,36 +511,46 @@ class TFTPServerHandler(socketserver.DatagramRequestHandler):
             # exist, create it and go on
             if e.errno == errno.ENOENT:
                 try:
-                    peer_state.file = open(peer_state.filepath, 'wb')
+                    peer_state.file = writer.Writer(
+                            peer_state.filepath, self.server.fsync,
+                            self.server.sync_bytes)
                     peer_state.packetnum = 1
                     peer_state.state = state.STATE_RECV_ACK
-                    l.info('Upload of %s began.', filename,
-                           extra=peer_state.extra(notify.TRANSFER_STARTED))
+                    l.info('Upload of %s began.', filename)
                 except IOError:
                     peer_state.state = state.STATE_ERROR
                     peer_state.error = proto.ERROR_ACCESS_VIOLATION
-                    l.warning('Error creating file %s for upload!', filename,
-                              extra=peer_state.extra(notify.TRANSFER_FAILED))
+                    l.warning('Error creating file %s for upload!', filename)
             else:
                 peer_state.state = state.STATE_ERROR
                 peer_state.error = proto.ERROR_ACCESS_VIOLATION
-                l.warning('Error creating file %s for upload!', filename,
-                          extra=peer_state.extra(notify.TRANSFER_FAILED))
+                l.warning('Error creating file %s for upload!', filename)
 
         # Only set options if not running in RFC1350 compliance mode
-        if not self.server.strict_rfc1350 and len(opts):
-            opts = proto.TFTPHelper.parse_options(opts)
+        if self.server.strict_rfc1350:
+            opts = {}
+        if peer_state.state != state.STATE_ERROR:
+            opts = self.server.policy.negotiate(
+                    peer_state, opts,
+                    get_peer_interface(self.client_address[0]))
             if opts:
-                # HOOK: this is where we should check that we accept
-                # the options requested by the client.
-
                 peer_state.packetnum = 1
                 peer_state.state = state.STATE_SEND_OACK
                 peer_state.set_opts(opts)
-            else:
+            elif opts is None:
                 peer_state.state = state.STATE_ERROR
                 peer_state.error = proto.ERROR_OPTION_NEGOCIATION
 
+        # Reserve the space of the announced file size.
+        if peer_state.state == state.STATE_SEND_OACK:
+            try:
+                peer_state.file.preallocate(
+                        opts.get(proto.TFTP_OPTION_TSIZE))
+            except OSError:
+                peer_state.state = state.STATE_ERROR
+                peer_state.error = proto.ERROR_DISK_FULL
+                l.warning('Not enough space left for %s!', filename)
+
         l.info('finish serverWRQ with the following peer state')
         l.info(peer_state)
         return self.finish_state(peer_state)
@@ -326,57 +583,71 @@ class TFTPServerHandler(socketserver.DatagramRequestHandler):
                 peer_state.state = state.STATE_ERROR
                 peer_state.error = proto.ERROR_ILLEGAL_OP
                 l.error('Client did not reply correctly to the OACK packet. '
-                        'Aborting transmission.',
-                        extra=peer_state.extra(notify.TRANSFER_FAILED))
+                        'Aborting transmission.')
+                events.publish(events.FAILED, peer_state)
             else:
                 peer_state.state = state.STATE_SEND
 
             return peer_state.next()
 
-        elif peer_state.state == state.STATE_SEND:
-            if peer_state.packetnum == num + 1:
-                # Ignore duplicate N-1 ACK packets
+        elif peer_state.state in (state.STATE_SEND, state.STATE_SEND_LAST):
+            acked = peer_state.ack(num)
+
+            if acked == state.ACK_DUPLICATE:
+                # Ignore duplicate and stale ACK packets. Lost packets are
+                # retransmitted on timeout, answering duplicates as well would
+                # double the traffic (Sorcerer's Apprentice syndrome).
                 l.debug('Got duplicate ACK packet #%d. Ignoring.', num)
-                pass
-            elif peer_state.packetnum != num:
-                # TODO: handle ACK recovery when operating in streaming mode.
+                return None
+            elif acked == state.ACK_INVALID:
                 peer_state.state = state.STATE_ERROR
                 peer_state.error = proto.ERROR_ILLEGAL_OP
                 l.error('Got ACK with incoherent data packet number. '
-                        'Aborting transfer.',
-                        extra=peer_state.extra(notify.TRANSFER_FAILED))
+                        'Aborting transfer.')
+                events.publish(events.FAILED, peer_state)
+            elif acked == state.ACK_PARTIAL:
+                # Part of the window was lost (RFC7440): resume from the
+                # first packet the client did not get.
+                l.debug('Got ACK #%d within the window, resending from #%d.',
+                        num, (num + 1) % proto.TFTP_PACKETNUM_MAX)
+            elif peer_state.state == state.STATE_SEND_LAST:
+                l.debug('  >  DATA: %d data packet(s) sent.',
+                        peer_state.total_packets)
+                l.debug('  <   ACK: Transfer complete, %d byte(s).',
+                        peer_state.filesize)
+                l.debug('  >  DATA: %d packet(s) retransmitted.',
+                        peer_state.retransmits)
+                l.debug('  >  DATA: %.1f kB/s, burst trajectory %s.',
+                        peer_state.throughput() / 1024,
+                        peer_state.trajectory)
+                self.server.bursts[self.client_address[0]] = peer_state.burst
+                self.server.policy.completed(peer_state)
+                l.info('Transfer of file %s completed.', peer_state.filename)
+                events.publish(events.COMPLETED, peer_state)
+                peer_state.close()
+                self.server.clients.pop(self.client_address)
+                return None
+            elif acked == state.ACK_WINDOW:
+                events.progress(peer_state)
 
             if not self.server.strict_rfc1350 and \
                     num == proto.TFTP_PACKETNUM_MAX - 1:
                 l.debug('Packet number wraparound.')
 
-            peer_state.last_acked = num
             return peer_state.next()
 
         elif peer_state.state == state.STATE_RECV and num == 0:
             return peer_state.next()
 
         elif peer_state.state == state.STATE_ERROR:
-            l.debug('Error ACKed. Terminating transfer.',
-                    extra=peer_state.extra(notify.TRANSFER_FAILED))
+            l.debug('Error ACKed. Terminating transfer.')
             return None
 
-        elif peer_state.state == state.STATE_SEND_LAST:
-            l.debug('  >  DATA: %d data packet(s) sent.',
-                    peer_state.total_packets)
-            l.debug('  <   ACK: Transfer complete, %d byte(s).',
-                    peer_state.filesize)
-            l.info('Transfer of file %s completed.', peer_state.filename,
-                   extra=peer_state.extra(notify.TRANSFER_COMPLETED))
-            del self.server.clients[self.client_address]
-            return None
+        l.error('Unexpected ACK!')
+        events.publish(events.FAILED, peer_state)
 
-        l.error('Unexpected ACK!',
-                extra=peer_state.extra(notify.TRANSFER_FAILED))
-
-        if peer_state.op == proto.OP_WRQ:
-            peer_state.purge()
-        del self.server.clients[self.client_address]
+        peer_state.close()
+        self.server.clients.pop(self.client_address)
         return proto.TFTPHelper.createERROR(proto.ERROR_ILLEGAL_OP)
 
     def serveDATA(self, op, request):
@@ -403,41 +674,47 @@ class TFTPServerHandler(socketserver.DatagramRequestHandler):
             return proto.TFTPHelper.createERROR(proto.ERROR_UNKNOWN_ID)
 
         if len(data) > peer_state.opts[proto.TFTP_OPTION_BLKSIZE]:
-            l.warning('Illegal TFTP option received.',
-                      extra=peer_state.extra(notify.TRANSFER_FAILED))
+            l.warning('Illegal TFTP option received.')
+            events.publish(events.FAILED, peer_state)
             return proto.TFTPHelper.createERROR(proto.ERROR_ILLEGAL_OP)
 
         if peer_state.state == state.STATE_RECV:
             l.debug("Serving data.  Expected packet num %d, actual packet num %d", peer_state.packetnum, num)
-            if num != peer_state.packetnum:
-                peer_state.state = state.STATE_ERROR
-                peer_state.error = proto.ERROR_ILLEGAL_OP
-            else:
-                peer_state.data = data
-
-            next_state = peer_state.next()
+            outcome, next_state = peer_state.receive(num, data)
+            if outcome == state.DATA_AHEAD:
+                l.debug('  <  DATA: packet %d received out of order.', num)
+            elif outcome == state.DATA_INVALID:
+                l.warning('DATA packet %d outside of the window.', num)
+                events.publish(events.FAILED, peer_state)
 
             if peer_state.done:
                 l.debug('  <  DATA: %d packet(s) received.',
                         peer_state.total_packets)
+                if peer_state.reordered:
+                    l.debug('  <  DATA: %d packet(s) out of order, by '
+                            'depth: %s.', sum(peer_state.reordered.values()),
+                            dict(sorted(peer_state.reordered.items())))
                 l.debug('  >   ACK: Transfer complete, %d byte(s).',
                         peer_state.filesize)
-                l.info('Transfer of file %s completed.', peer_state.filename,
-                       extra=peer_state.extra(notify.TRANSFER_COMPLETED))
-                del self.server.clients[self.client_address]
+                l.info('Transfer of file %s completed.', peer_state.filename)
+                events.publish(events.COMPLETED, peer_state)
+                peer_state.close()
+                self.server.clients.pop(self.client_address)
 
             elif (not self.server.strict_rfc1350 and
                   num == proto.TFTP_PACKETNUM_MAX-1):
                 l.debug('Packet number wraparound.')
 
+            if outcome == state.DATA_NEXT and not peer_state.done:
+                events.progress(peer_state)
+
             return next_state
 
-        l.error('Unexpected DATA!',
-                extra=peer_state.extra(notify.TRANSFER_FAILED))
+        l.error('Unexpected DATA!')
+        events.publish(events.FAILED, peer_state)
 
-        if peer_state.op == proto.OP_WRQ:
-            peer_state.purge()
-        del self.server.clients[self.client_address]
+        peer_state.close()
+        self.server.clients.pop(self.client_address)
         return proto.TFTPHelper.createERROR(proto.ERROR_ILLEGAL_OP)
 
     def serveERROR(self, op, request):
@@ -458,77 +735,276 @@ class TFTPServerHandler(socketserver.DatagramRequestHandler):
             # Ignore malformed ERROR packets
             return None
 
-        if self.client_address not in self.server.clients:
+        # An error packet immediately terminates a connection
+        peer_state = self.server.clients.pop(self.client_address)
+        if peer_state is None:
             return None
 
-        # An error packet immediately terminates a connection
-        peer_state = self.server.clients[self.client_address]
+        l.warning('Error packet received!')
+        events.publish(events.FAILED, peer_state)
+        peer_state.close()
+
+    # Opcode dispatch table. Subclasses overriding a serve* method must
+    # override the table as well.
+    handlers = {
+        proto.OP_RRQ: serveRRQ,
+        proto.OP_WRQ: serveWRQ,
+        proto.OP_DATA: serveDATA,
+        proto.OP_ACK: serveACK,
+        proto.OP_ERROR: serveERROR,
+    }
+
+
+class TFTPTransferHandler(TFTPServerHandler):
+    """
+    The datagram handler of a transfer's own socket. Unlike request
+    handlers, which serve a single datagram, a transfer handler serves all
+    the datagrams of its transfer, handed to it by serve().
+    """
+
+    ops = TRANSFER_OPS
+
+    def __init__(self, sock, client_address, server, tid):
+        self.socket = sock
+        self.client_address = client_address
+        self.server = server
+        self.local_port = tid
+        self.trace = get_peer_trace_ring(client_address[0], server.trace)
 
-        l.warning('Error packet received!',
-                  extra=peer_state.extra(notify.TRANSFER_FAILED))
-        if peer_state.op == proto.OP_WRQ:
-            peer_state.purge()
-        del self.server.clients[self.client_address]
+    def serve(self, packet):
+        """Serve a datagram of the transfer, and return the response (see
+        send_response), if any."""
+        self.dispatch(packet)
+        return self.response
 
 
-class TFTPServerGarbageCollector(threading.Thread):
+class TFTPTransferThread(threading.Thread):
     """
-    A gc thread to clean up the server's state of timed out clients.
+    A thread serving the datagrams of a single transfer, received on the
+    transfer's own socket, until the transfer ends or times out.
     """
 
-    def __init__(self, clients):
+    def __init__(self, server, peer_state):
         threading.Thread.__init__(self)
-        self.clients = clients
+        self.server = server
+        self.peer_state = peer_state
         self.setDaemon(True)
 
+        # Serializes the handling of received packets with retransmissions,
+        # which happen on the timer thread.
+        self.lock = threading.Lock()
+        self.timer = None
+        self.trace = get_peer_trace_ring(peer_state.peer[0], server.trace)
+
     def run(self):
-        while True:
-            # Sleep a little before doing a cycle.
-            time.sleep(10)
+        peer, sock = self.peer_state.peer, self.peer_state.sock
+        sock.settimeout(_PTFTPD_TRANSFER_POLL_SECS)
 
-            toremove = []
+        # Time out the first reply, sent by the server port handler.
+        with self.lock:
+            self.arm()
 
-            for peer, peer_state in self.clients.items():
-                delta = time.time() - peer_state.last_seen
-                if delta > state.STATE_TIMEOUT_SECS:
-                    if peer_state.state != state.STATE_ERROR:
-                        l.debug('Peer %s:%d timed out.', *peer,
-                                extra=peer_state.extra(notify.TRANSFER_FAILED))
-                    toremove.append(peer)
+        # Datagrams are received into a buffer of the pool, and served from
+        # it without being copied.
+        handler = TFTPTransferHandler(sock, peer, self.server,
+                                      self.peer_state.tid)
+        buffer = self.server.buffers.acquire()
+        view = memoryview(buffer)
 
-            for peer in toremove:
-                if self.clients[peer].op == proto.OP_WRQ:
-                    self.clients[peer].purge()
-                l.debug('Removed stale peer %s:%d.', *peer)
-                del self.clients[peer]
+        try:
+            # The transfer is over once its state is gone from the registry,
+            # whether it completed, failed or was reaped by the session reaper.
+            while self.server.clients.get(peer) is self.peer_state:
+                try:
+                    size = sock.recv_into(buffer)
+                except socket.timeout:
+                    continue
+                except OSError as e:
+                    # e.g. ICMP port unreachable from a client that went away
+                    l.debug('Transfer socket error: %s', e)
+                    continue
+
+                with self.lock:
+                    if handler.serve(view[:size]):
+                        self.arm()
+        finally:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                # The state may also have been replaced by a new request.
+                self.peer_state.close()
+                self.server.transfers.pop(self.peer_state, None)
+            sock.close()
+            self.server.buffers.release(buffer)
+
+    def arm(self):
+        """(Re)arm the retransmission timer of the transfer. Must be called
+        with the lock held."""
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.server.timers.schedule(self.peer_state.rto(),
+                                                 self.retransmit)
+
+    def send(self, packets):
+        """Send packets to the peer, from the transfer's port. Must be called
+        with the lock held."""
+        try:
+            for packet in packets:
+                self.trace.record(trace.TRACE_OUT, packet,
+                                  self.peer_state.peer, self.peer_state.tid)
+                send_packet(self.peer_state.sock, packet, self.peer_state.peer)
+        except OSError as e:
+            l.debug('Transfer socket error: %s', e)
+
+    def resend(self):
+        """Resend the unacknowledged packets, e.g. on a duplicate
+        request."""
+        with self.lock:
+            if self.server.clients.get(self.peer_state.peer) \
+                    is not self.peer_state:
+                return
+
+            l.debug('Resending %d packet(s) to %s:%d.',
+                    len(self.peer_state.unacked), *self.peer_state.peer)
+            self.send(self.peer_state.resend())
+            self.arm()
+
+    def retransmit(self):
+        """Retransmission timer callback."""
+        with self.lock:
+            if self.server.clients.get(self.peer_state.peer) \
+                    is not self.peer_state:
+                return
+
+            packets = self.peer_state.retransmit()
+            if packets is None:
+                l.warning('Transfer of %s abandoned after %d retransmissions.',
+                          self.peer_state.filename,
+                          self.peer_state.retransmits)
+                events.publish(events.FAILED, self.peer_state)
+                self.peer_state.close()
+                self.server.clients.pop(self.peer_state.peer)
+                return
+
+            if not packets:
+                return
+
+            l.debug('Retransmitting %d packet(s) to %s:%d.', len(packets),
+                    *self.peer_state.peer)
+            self.send(packets)
+            self.arm()
+
+
+def expire_session(peer, peer_state):
+    """Clean up after a timed out client (see sessions.SessionTable)."""
+    if peer_state.state != state.STATE_ERROR:
+        l.debug('Peer %s:%d timed out.', *peer)
+        events.publish(events.FAILED, peer_state)
+    peer_state.close()
+    l.debug('Removed stale peer %s:%d.', *peer)
 
 
 class Server(object):
     def __init__(self, ip, root, port=_PTFTPD_DEFAULT_PORT,
-                 strict_rfc1350=True, notification_callbacks=None):
+                 strict_rfc1350=True, notification_callbacks=None,
+                 image_cache_size=cache.IMAGE_CACHE_DEFAULT_SIZE,
+                 packet_tables=False, pacing=0, policy=None,
+                 netascii_images=False, fsync=True, sync_bytes=0):
 
         if notification_callbacks is None:
             notification_callbacks = {}
 
         self.ip, self.root, self.port, self.strict_rfc1350 = ip, root, port, strict_rfc1350
-        self.client_registry = {}
+        self.client_registry = sessions.SessionTable(expired=self.expire)
 
         if not os.path.isdir(self.root):
             raise TFTPServerConfigurationError(
                 'The specified TFTP root does not exist')
 
-        self.server = socketserver.UDPServer((self.ip, port),
-                                             TFTPServerHandler)
+        self.server = TFTPUDPServer((self.ip, port), TFTPServerHandler)
         self.server.root = self.root
         self.server.strict_rfc1350 = self.strict_rfc1350
         self.server.clients = self.client_registry
-        self.cleanup_thread = TFTPServerGarbageCollector(self.client_registry)
+        self.server.transfer_ip = self.ip
+        self.server.start_transfer = self.start_transfer
+        self.server.resend_transfer = self.resend_transfer
+        self.server.transfers = {}
+        self.server.buffers = BufferPool()
+        self.server.port = port
+
+        # Trace of the packets sent and received with peers of unknown
+        # interfaces, see get_peer_trace_ring().
+        self.server.trace = trace.get_trace_ring(self.ip, self.ip)
+
+        _SESSIONS.labels(self.ip).set_function(
+                lambda: len(self.client_registry))
+
+        # Delay between two DATA packets of a window, and the burst size each
+        # client ended its last transfer with.
+        self.server.pacing = pacing
+        self.server.bursts = {}
+
+        # Option negotiation policy, which DHCP servers can register their
+        # clients with.
+        self.policy = policy or negotiate.NegotiationPolicy()
+        self.server.policy = self.policy
+
+        self.timers = timers.TimerWheel()
+        self.server.timers = self.timers
+        self.timer_thread = timers.TimerThread(self.timers)
+
+        # Serve RRQs from the process-wide image cache, unless disabled with
+        # a zero byte budget.
+        if image_cache_size:
+            self.server.image_cache = cache.get_image_cache()
+            self.server.image_cache.set_max_bytes(image_cache_size)
+        else:
+            self.server.image_cache = None
+
+        # Precomputed DATA packet tables and netascii images are built from
+        # cached images.
+        self.server.packet_tables = packet_tables and bool(image_cache_size)
+        self.server.netascii_images = \
+            netascii_images and bool(image_cache_size)
+
+        # Sync policy of uploaded files.
+        self.server.fsync = fsync
+        self.server.sync_bytes = sync_bytes
+
+        self.cleanup_thread = sessions.SessionReaper(self.client_registry)
+
+        # Transfer notifications are delivered by the event bus' thread, off
+        # the serving threads.
+        if notification_callbacks:
+            events.get_event_bus().subscribe(events.NotifyAdapter(
+                    notify.CallbackEngine(notification_callbacks)))
+
+    def start_transfer(self, peer_state):
+        """Serve the datagrams of a new transfer on its own thread."""
+        thread = TFTPTransferThread(self.server, peer_state)
+        self.server.transfers[peer_state] = thread
+        thread.start()
+
+    def expire(self, peer, peer_state):
+        """Clean up after a timed out client, on the reaper thread, holding
+        the lock of its transfer."""
+        thread = self.server.transfers.get(peer_state)
+        if thread is None:
+            expire_session(peer, peer_state)
+            return
+        with thread.lock:
+            expire_session(peer, peer_state)
 
-        # Add callback notifications
-        notify.CallbackEngine.install(l, notification_callbacks)
+    def resend_transfer(self, peer_state):
+        """Have a running transfer resend its unacknowledged packets, on the
+        server thread."""
+        thread = self.server.transfers.get(peer_state)
+        if thread is not None:
+            thread.resend()
 
     def serve_forever(self):
         l.info('Serving TFTP requests on %s:%d in %s',
                self.ip, self.port, self.root)
         self.cleanup_thread.start()
+        self.timer_thread.start()
         self.server.serve_forever()
@@ -0,0 +1,318 @@
+# coding=utf-8
+# This file is part of pTFTPd.
+#
+# pTFTPd is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pTFTPd is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pTFTPd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-memory image cache for the TFTP server.
+
+The programming station serves the same few boot images to several boards at
+once. Rather than having every transfer read its own copy of the file from the
+SD card, images are read once into memory and shared between transfers. Each
+transfer then serves its DATA payloads as memoryview slices of the shared
+buffer.
+
+Entries are keyed by path, inode and modification time so a replaced or
+rewritten file is never served stale, and the cache evicts the least recently
+used images when its byte budget is exceeded.
+
+Optionally, the cache can also hold tables of fully framed DATA packets for a
+given image, block size and transfer mode. Transfers served from such a table
+only have to index into it to get the next packet to send. It can also hold
+the netascii form of images, so that netascii transfers are served without
+converting them again. Packet tables and netascii images share the byte budget
+of the images they are built from, and are dropped along with them.
+"""
+
+import collections
+import os
+import stat
+import sys
+import threading
+
+from . import netascii
+from . import notify
+from . import proto
+
+l = notify.getLogger('tftp-cache')
+
+# Default byte budget of the process-wide image cache. Large enough to hold
+# the SPL, U-Boot and kernel images served by the programming station.
+IMAGE_CACHE_DEFAULT_SIZE = 32 * 1024 * 1024
+
+# Memory overhead of each packet of a packet table: the bytes object header
+# and the list slot pointing to it.
+_PACKET_OVERHEAD = sys.getsizeof(b'') + 8
+
+
+class CachedImage(object):
+    """A file image held in memory.
+
+    Attributes:
+        key (tuple): the (path, inode, mtime) cache key of this image, or the
+            (image key, 'netascii') key of the netascii form of an image.
+        size (int): the image size, in bytes.
+        buffer (memoryview): a read-only view over the image contents.
+        mode (string): 'netascii' if the image has been converted to
+            netascii, 'octet' otherwise.
+    """
+
+    def __init__(self, key, data, mode='octet'):
+        self.key = key
+        self.size = len(data)
+        self.buffer = memoryview(data)
+        self.mode = mode
+
+
+class PacketTable(object):
+    """The DATA packets of a cached image, framed for a given block size and
+    transfer mode.
+
+    Attributes:
+        key (tuple): the (image key, blksize, mode) cache key of this table.
+        packets (list): the DATA packets, in transfer order. Packet numbers
+            wrap around after TFTP_PACKETNUM_MAX - 1.
+        size (int): the memory used by the table, in bytes.
+    """
+
+    def __init__(self, key, packets):
+        self.key = key
+        self.packets = packets
+        self.size = sum(len(p) + _PACKET_OVERHEAD for p in packets)
+
+    @staticmethod
+    def build(image, blksize, mode):
+        """Build the packet table of the given image.
+
+        Args:
+            image (CachedImage): the image to frame.
+            blksize (int): the negotiated block size.
+            mode (string): the transfer mode.
+        Returns:
+            A new PacketTable.
+        """
+
+        data = image.buffer
+        if mode == 'netascii' and image.mode != 'netascii':
+            data = netascii.encode(data)
+
+        # A transfer always ends with a DATA packet shorter than blksize,
+        # which may be empty.
+        packets = []
+        for num, offset in enumerate(range(0, len(data) + 1, blksize), 1):
+            packets.append(proto.TFTPHelper.createDATA(
+                    num % proto.TFTP_PACKETNUM_MAX,
+                    data[offset:offset + blksize]))
+
+        return PacketTable((image.key, blksize, mode), packets)
+
+
+def _path_of(key):
+    """Return the file path of an image or packet table cache key."""
+    while type(key[0]) == tuple:
+        key = key[0]
+    return key[0]
+
+
+class ImageCache(object):
+    """A thread-safe, size-bounded LRU cache of file images and their packet
+    tables."""
+
+    def __init__(self, max_bytes=IMAGE_CACHE_DEFAULT_SIZE):
+        """Creates a new image cache.
+
+        Args:
+            max_bytes (int): the byte budget of the cache. Files larger than
+                this budget are never cached.
+        """
+
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def set_max_bytes(self, max_bytes):
+        """Change the byte budget of the cache, evicting images if needed."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict(0)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def get(self, path, st=None):
+        """Return the cached image of the given file, reading it if needed.
+
+        Args:
+            path (string): the absolute path of the file.
+            st (os.stat_result): the result of os.stat() on the file, if the
+                caller already has it.
+        Returns:
+            A CachedImage, or None if the file does not fit in the cache.
+        Throws:
+            IOError/OSError if the file cannot be stat'ed or read.
+        """
+
+        if st is None:
+            st = os.stat(path)
+        size = st[stat.ST_SIZE]
+        key = (path, st.st_ino, st.st_mtime_ns)
+
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+
+        if size > self.max_bytes:
+            return None
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        # The file may have changed between the stat() and the read(); only
+        # keep what we read if it still matches the key we computed.
+        if len(data) != size:
+            return None
+
+        with self._lock:
+            # Another transfer may have loaded the same image meanwhile.
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                return image
+
+            # Drop outdated versions of the same file, and their packet
+            # tables.
+            for old in [k for k in self._entries if _path_of(k) == path]:
+                if old in self._entries:
+                    self._remove(old)
+
+            image = CachedImage(key, data)
+            self._evict(image.size)
+            self._entries[key] = image
+            self.size += image.size
+            l.debug('Cached %s (%d bytes, %d/%d bytes used).',
+                    path, image.size, self.size, self.max_bytes)
+            return image
+
+    def get_packet_table(self, image, blksize, mode):
+        """Return the packet table of a cached image, building it if needed.
+
+        Args:
+            image (CachedImage): an image returned by get().
+            blksize (int): the negotiated block size.
+            mode (string): the transfer mode.
+        Returns:
+            A PacketTable, or None if the table does not fit in the cache or
+            the image has been evicted.
+        """
+
+        return self._get_derived(
+                image, (image.key, blksize, mode),
+                lambda: PacketTable.build(image, blksize, mode))
+
+    def get_netascii(self, image):
+        """Return the netascii form of a cached image, converting it if
+        needed.
+
+        Args:
+            image (CachedImage): an image returned by get().
+        Returns:
+            A CachedImage, or None if it does not fit in the cache or the
+            image has been evicted.
+        """
+
+        if image.mode == 'netascii':
+            return image
+
+        key = (image.key, 'netascii')
+        return self._get_derived(
+                image, key,
+                lambda: CachedImage(key, netascii.encode(image.buffer),
+                                    'netascii'))
+
+    def _get_derived(self, image, key, build):
+        """Return the cache entry derived from an image under the given key,
+        building it if needed."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = build()
+        if image.size + entry.size > self.max_bytes:
+            return None
+
+        with self._lock:
+            # Don't keep entries of images that are no longer cached, they
+            # would never be invalidated.
+            if image.key not in self._entries:
+                return None
+
+            existing = self._entries.get(key)
+            if existing is not None:
+                self._entries.move_to_end(key)
+                return existing
+
+            # Keep the image from being evicted to make room for what is
+            # derived from it.
+            self._entries.move_to_end(image.key)
+            self._evict(entry.size, keep=image.key)
+            self._entries[key] = entry
+            self.size += entry.size
+            l.debug('Cached %s of %s (%d bytes).', key[1:],
+                    _path_of(key), entry.size)
+            return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+
+        # Packet tables and netascii images go away with their image.
+        for derived in [k for k in self._entries if k[0] == key]:
+            if derived in self._entries:
+                self._remove(derived)
+
+    def _evict(self, needed, keep=None):
+        """Evict least recently used entries until needed bytes fit in the
+        budget. Must be called with the lock held."""
+        for key in list(self._entries):
+            if self.size + needed <= self.max_bytes:
+                break
+            if key == keep or key not in self._entries:
+                continue
+            l.debug('Evicting %s from the image cache.', _path_of(key))
+            self._remove(key)
+
+
+# Process-wide image cache shared by all TFTP server instances.
+_image_cache = ImageCache()
+
+
+def get_image_cache():
+    """Return the process-wide image cache."""
+    return _image_cache
@@ -0,0 +1,279 @@
+# coding=utf-8
+# This file is part of pTFTPd.
+#
+# pTFTPd is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pTFTPd is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pTFTPd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Transfer lifecycle event bus.
+
+The servers publish an event when a transfer starts, progresses, completes or
+fails. Events are handed to subscribers by a dispatcher thread, through a
+bounded queue, so that a slow subscriber (blinking a LED, calling a web hook)
+never delays the thread serving the transfer: when the queue is full, events
+are dropped and counted rather than waited for.
+
+Publishing an event costs next to nothing when nobody subscribed.
+
+The notification engines of the notify module are fed by subscribing a
+NotifyAdapter, which turns events back into the log records they expect:
+
+    bus = events.get_event_bus()
+    bus.subscribe(events.NotifyAdapter(notify.CallbackEngine(callbacks)))
+"""
+
+import collections
+import logging
+import queue
+import threading
+import time
+
+from metrics import registry
+
+from . import notify
+from . import proto
+
+l = notify.getLogger('tftp-events')
+
+# Event kinds, the transfer states of the notify module.
+STARTED = notify.TRANSFER_STARTED
+PROGRESS = notify.TRANSFER_PROGRESS
+COMPLETED = notify.TRANSFER_COMPLETED
+FAILED = notify.TRANSFER_FAILED
+
+# Maximum number of events waiting to be dispatched.
+EVENT_QUEUE_SIZE = 1024
+
+# Minimum interval between two PROGRESS events of the same transfer.
+EVENT_PROGRESS_SECS = 1
+
+# Maximum number of files whose transfer durations are measured apart, the
+# others are measured under EVENT_OTHER_FILE.
+EVENT_MAX_FILES = 32
+EVENT_OTHER_FILE = 'other'
+
+# Transfer metrics, see the metrics package. Events published on the
+# process-wide bus are counted, whether anyone subscribed or not.
+_metrics = registry.get_registry()
+_TRANSFERS = _metrics.counter('tftp_transfers_total',
+                              'TFTP transfers, by operation and outcome.',
+                              ['op', 'event'])
+_TRANSFER_SECONDS = _metrics.histogram(
+        'tftp_transfer_seconds', 'Duration of the completed TFTP transfers, '
+        'by file.', ['file'])
+_FILES = set()
+_FILES_LOCK = threading.Lock()
+_KIND_NAMES = {
+    notify.TRANSFER_STARTED: 'started',
+    notify.TRANSFER_COMPLETED: 'completed',
+    notify.TRANSFER_FAILED: 'failed',
+}
+_TRANSFER_COUNTERS = {
+    (kind, op): _TRANSFERS.labels(proto.TFTP_OPS[op], name)
+    for kind, name in _KIND_NAMES.items()
+    for op in (proto.OP_RRQ, proto.OP_WRQ)
+}
+
+Event = collections.namedtuple('Event', [
+        'kind',                             # STARTED, PROGRESS, ...
+        'peer',                             # (host, port) of the client
+        'tid',                              # Transfer ID, if allocated
+        'op',                               # OP_RRQ or OP_WRQ
+        'file',                             # Requested file name
+        'transferred',                      # Bytes sent or received so far
+        'total',                            # Size of the file, if known
+        'error',                            # TFTP error code, if failed
+        'elapsed',                          # Seconds since the request
+])
+
+
+def transfer_event(kind, peer_state):
+    """Build the event of a transfer from its state."""
+    if peer_state.op == proto.OP_RRQ:
+        total = peer_state.filesize
+        transferred = min(total, peer_state.block *
+                          peer_state.opts[proto.TFTP_OPTION_BLKSIZE])
+    else:
+        total = peer_state.opts.get(proto.TFTP_OPTION_TSIZE)
+        transferred = peer_state.filesize
+    if kind == COMPLETED:
+        transferred = total = peer_state.filesize
+
+    return Event(kind, peer_state.peer, peer_state.tid, peer_state.op,
+                 peer_state.filename, transferred, total,
+                 peer_state.error if kind == FAILED else None,
+                 time.monotonic() - peer_state.started)
+
+
+class EventBus(object):
+    """Delivers the published events to the subscribers, from a dispatcher
+    thread."""
+
+    def __init__(self, maxsize=EVENT_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0                    # Events lost to a full queue
+        self._subscribers = ()              # (callback, kinds) pairs
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, callback, kinds=None):
+        """Subscribe to the transfer events.
+
+        Args:
+            callback (callable): called with every Event, on the dispatcher
+                thread.
+            kinds (iterable): the kinds of events to receive, or None for
+                all of them.
+        Returns:
+            The callback, to unsubscribe it later.
+        """
+
+        kinds = frozenset(kinds) if kinds is not None else None
+        with self._lock:
+            # Subscribers are replaced rather than modified, so that
+            # publishers can read them without the lock.
+            self._subscribers += ((callback, kinds),)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch,
+                                                name='tftp-events')
+                self._thread.daemon = True
+                self._thread.start()
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers
+                                      if s[0] is not callback)
+
+    def publish(self, kind, peer_state):
+        """Publish an event of the given transfer, without ever blocking."""
+        if not self._subscribers:
+            return
+
+        try:
+            self.queue.put_nowait(transfer_event(kind, peer_state))
+        except queue.Full:
+            self.dropped += 1
+
+    def progress(self, peer_state, now=None):
+        """Publish a PROGRESS event of the given transfer, unless one was
+        published less than EVENT_PROGRESS_SECS ago."""
+        if not self._subscribers:
+            return
+
+        if now is None:
+            now = time.monotonic()
+        if now - peer_state.progressed < EVENT_PROGRESS_SECS:
+            return
+        peer_state.progressed = now
+        self.publish(PROGRESS, peer_state)
+
+    def flush(self):
+        """Wait for the queued events to be dispatched."""
+        self.queue.join()
+
+    def _dispatch(self):
+        while True:
+            event = self.queue.get()
+            try:
+                for callback, kinds in self._subscribers:
+                    if kinds is not None and event.kind not in kinds:
+                        continue
+                    try:
+                        callback(event)
+                    except Exception:
+                        l.exception('Event subscriber failed.')
+            finally:
+                self.queue.task_done()
+
+
+class NotifyAdapter(object):
+    """An event subscriber feeding the notification engines of the notify
+    module, or any logger, with the log records they used to get from the
+    servers."""
+
+    MESSAGES = {
+        STARTED: 'Transfer of %s started.',
+        PROGRESS: 'Transfer of %s in progress.',
+        COMPLETED: 'Transfer of %s completed.',
+        FAILED: 'Transfer of %s failed.',
+    }
+
+    LEVELS = {
+        STARTED: logging.INFO,
+        PROGRESS: logging.DEBUG,
+        COMPLETED: logging.INFO,
+        FAILED: logging.WARNING,
+    }
+
+    def __init__(self, target, name='tftp-events'):
+        """
+        Args:
+            target (logging.Handler or logging.Logger): where to hand the log
+                records, e.g. a notify.CallbackEngine.
+            name (string): the logger name of the records.
+        """
+        self.target = target
+        self.name = name
+
+    def __call__(self, event):
+        record = logging.LogRecord(
+                self.name, self.LEVELS[event.kind], __file__, 0,
+                self.MESSAGES[event.kind], (event.file,), None)
+        record.host, record.port = event.peer[:2]
+        record.tid = event.tid
+        record.file = event.file
+        record.state = event.kind
+        self.target.handle(record)
+
+
+# The process-wide bus. Its dispatcher thread only starts with the first
+# subscriber.
+_event_bus = EventBus()
+
+
+def get_event_bus():
+    """Return the process-wide event bus."""
+    return _event_bus
+
+
+def _file_label(peer_state):
+    """Return the file label to measure a completed transfer under.
+
+    File names come from the clients, so only the files served are measured
+    apart, up to EVENT_MAX_FILES of them, for the metric not to grow a child
+    per uploaded or mistyped name.
+    """
+
+    if peer_state.op != proto.OP_RRQ:
+        return EVENT_OTHER_FILE
+    with _FILES_LOCK:
+        if peer_state.filename not in _FILES:
+            if len(_FILES) >= EVENT_MAX_FILES:
+                return EVENT_OTHER_FILE
+            _FILES.add(peer_state.filename)
+    return peer_state.filename
+
+
+def publish(kind, peer_state):
+    """Publish an event of the given transfer on the process-wide bus, and
+    count it in the transfer metrics."""
+    _TRANSFER_COUNTERS[kind, peer_state.op].inc()
+    if kind == COMPLETED:
+        _TRANSFER_SECONDS.labels(_file_label(peer_state)).observe(
+                time.monotonic() - peer_state.started)
+    _event_bus.publish(kind, peer_state)
+
+
+def progress(peer_state):
+    """Publish a throttled PROGRESS event on the process-wide bus."""
+    _event_bus.progress(peer_state)
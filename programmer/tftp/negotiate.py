@@ -0,0 +1,572 @@
+# coding=utf-8
+# This file is part of pTFTPd.
+#
+# pTFTPd is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pTFTPd is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pTFTPd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""TFTP option negotiation policy.
+
+The boards served by the programming station go through several TFTP
+clients while they boot: the AM335x boot ROM fetches the SPL, the SPL fetches
+U-Boot, U-Boot fetches the kernel and the booted system (busybox, identified by
+its udhcp DHCP client) may fetch more files. Their TFTP implementations and
+receive buffers differ widely, so the options they request are validated and
+clamped against a per-client-class profile, and against the limits of the
+host's UDP stack, before the OACK is built.
+
+A client's class is found from the DHCP vendor class it registered its
+address with, or failing that, from the name of the file it requests. The
+DHCP and TFTP servers run in separate processes, which share the vendor
+classes through a LeaseFile.
+
+Block sizes are also capped so that each DATA packet fits in a single frame
+of the interface the client is reached through: on the USB gadget links,
+losing one fragment of a fragmented datagram loses the whole block. A
+BlksizeTable can further cap them to the block size measured to give the best
+goodput on each interface, and measure it by exploring block sizes across
+transfers.
+"""
+
+import fnmatch
+import functools
+import ipaddress
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from . import notify
+from . import proto
+
+l = notify.getLogger('tftp-negotiate')
+
+# Largest UDP payload of an IPv4 datagram.
+UDP_MAX_PAYLOAD = 65507
+
+# IPv4 (without options) and UDP header sizes.
+_IP_UDP_OVERHEAD = 20 + 8
+
+# Block sizes explored by a BlksizeTable, besides the largest one fitting in
+# the interface MTU.
+BENCHMARK_BLKSIZES = (512, 768, 1024, 1280)
+
+# Time the configuration of the network interfaces, their addresses and MTU,
+# is cached for. Interfaces come and go with the boards plugged in.
+INTERFACE_CACHE_SECS = 5
+
+# File the DHCP server records the vendor class of its clients in, for the
+# TFTP server.
+LEASE_FILE_DEFAULT = os.path.join(tempfile.gettempdir(),
+                                  'bbb_programmer_leases.json')
+
+
+@functools.lru_cache(maxsize=None)
+def get_max_udp_datagram_size():
+    """Retrieve the maximum UDP datagram size allowed by the system.
+
+    Linux has no such limit besides the IPv4 payload size. BSD systems have
+    a sysctl for it, which is only queried once.
+    """
+
+    if sys.platform.startswith('linux'):
+        return UDP_MAX_PAYLOAD
+
+    try:
+        val = subprocess.check_output(['sysctl', '-n',
+                                       'net.inet.udp.maxdgram'])
+        return min(int(val), UDP_MAX_PAYLOAD)
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return UDP_MAX_PAYLOAD
+
+
+@functools.lru_cache(maxsize=None)
+def get_send_buffer_size():
+    """Retrieve the default send buffer size of UDP sockets, which bounds
+    the amount of data a window can have queued at once."""
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    finally:
+        sock.close()
+
+    # Linux reports twice the requested size, half of it being reserved
+    # for its own bookkeeping.
+    if sys.platform.startswith('linux'):
+        size //= 2
+    return size
+
+
+# Interface name -> (expiry, MTU) of the MTUs looked up.
+_mtus = {}
+
+
+def get_interface_mtu(interface):
+    """Retrieve the MTU of a network interface. It is only read again once
+    older than INTERFACE_CACHE_SECS.
+
+    Args:
+        interface (string): the interface name.
+    Returns:
+        The MTU in bytes, or None if it is unknown.
+    """
+
+    now = time.monotonic()
+    cached = _mtus.get(interface)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    try:
+        with open('/sys/class/net/%s/mtu' % interface) as f:
+            mtu = int(f.read())
+    except (OSError, ValueError):
+        mtu = None
+    _mtus[interface] = (now + INTERFACE_CACHE_SECS, mtu)
+    return mtu
+
+
+def mtu_blksize(mtu):
+    """Return the largest block size whose DATA packets fit in a single
+    frame of the given MTU."""
+    return mtu - _IP_UDP_OVERHEAD - proto.DATA_HEADER.size
+
+
+class PeerInterfaces(object):
+    """Finds the network interface each peer is reached through, from the
+    IPv4 addresses of the interfaces.
+
+    The addresses are only looked up again once older than the cache
+    duration, or when a peer is in none of the networks known, e.g. when the
+    interface of a board that was just plugged in came up. Lookups for
+    unknown peers are rate limited.
+    """
+
+    def __init__(self, lookup, ttl=INTERFACE_CACHE_SECS, miss_ttl=1):
+        """Creates an interface cache.
+
+        Args:
+            lookup (callable): returns the (ipaddress.IPv4Interface, name)
+                pairs of the host's network interfaces.
+            ttl (float): the cache duration, in seconds.
+            miss_ttl (float): the minimum age of the cache for a lookup on an
+                unknown peer, in seconds.
+        """
+
+        self.lookup = lookup
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.interfaces = []
+        self.updated = None
+        self._lock = threading.Lock()
+
+    def get(self, peer_ip):
+        """Return the name of the network interface whose IPv4 network holds
+        the given peer address, or None."""
+        found = self.find(peer_ip)
+        return found and found[0]
+
+    def find(self, peer_ip):
+        """Return the name and local IPv4 address, as a string, of the
+        network interface whose IPv4 network holds the given peer address,
+        or None."""
+
+        peer_ip = ipaddress.IPv4Address(peer_ip)
+        now = time.monotonic()
+        with self._lock:
+            if self.updated is None or now - self.updated >= self.ttl:
+                self._update(now)
+            found = self._find(peer_ip)
+            if found is None and now - self.updated >= self.miss_ttl:
+                self._update(now)
+                found = self._find(peer_ip)
+        return found
+
+    def _find(self, peer_ip):
+        for address, name in self.interfaces:
+            if peer_ip in address.network:
+                return name, str(address.ip)
+        return None
+
+    def _update(self, now):
+        self.interfaces = list(self.lookup())
+        self.updated = now
+
+
+class BlksizeTable(object):
+    """The block size giving the best goodput on each interface, persisted
+    as a JSON file.
+
+    In benchmark mode, the table also explores block sizes: each transfer
+    negotiating the blksize option is assigned the next candidate block size
+    of its interface in turn, and its goodput is recorded when it completes.
+    """
+
+    def __init__(self, path, explore=False, candidates=BENCHMARK_BLKSIZES):
+        """Creates a block size table, loading it from its file if it
+        exists.
+
+        Args:
+            path (string): the path of the JSON file.
+            explore (boolean): whether to explore block sizes.
+            candidates (tuple): the block sizes to explore, besides the
+                largest one fitting in the interface MTU.
+        """
+
+        self.path = path
+        self.explore = explore
+        self.candidates = candidates
+        self.results = {}
+        self._turns = {}
+        self._lock = threading.Lock()
+
+        try:
+            with open(path) as f:
+                for interface, results in json.load(f).items():
+                    self.results[interface] = dict(
+                            (int(blksize), result)
+                            for blksize, result in results.items())
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            l.warning('Ignoring unreadable block size table %s: %s', path, e)
+
+    def best(self, interface):
+        """Return the block size with the best goodput measured on the
+        given interface, or None."""
+        with self._lock:
+            results = self.results.get(interface)
+            if not results:
+                return None
+            return max(results,
+                       key=lambda blksize: results[blksize][0] /
+                       max(results[blksize][1], 1e-6))
+
+    def choose(self, interface, limit):
+        """Return the block size to explore with a new transfer.
+
+        Args:
+            interface (string): the interface name.
+            limit (int): the largest acceptable block size.
+        """
+
+        candidates = sorted(set(
+                [b for b in self.candidates if b < limit] + [limit]))
+        with self._lock:
+            turn = self._turns.get(interface, 0)
+            self._turns[interface] = turn + 1
+        return candidates[turn % len(candidates)]
+
+    def record(self, interface, blksize, size, duration):
+        """Record the goodput of a completed transfer exploring a block
+        size, and save the table.
+
+        Args:
+            interface (string): the interface name.
+            blksize (int): the block size explored by the transfer.
+            size (int): the number of bytes transferred.
+            duration (float): the duration of the transfer, in seconds.
+        """
+
+        with self._lock:
+            results = self.results.setdefault(interface, {})
+            total = results.get(blksize, [0, 0.0])
+            results[blksize] = [total[0] + size, total[1] + duration]
+            data = json.dumps(self.results, indent=2, sort_keys=True)
+
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            l.warning('Could not save block size table %s: %s', self.path, e)
+
+
+class LeaseFile(object):
+    """The DHCP vendor class of each client, by leased address, persisted
+    as a JSON file shared by the DHCP server, which registers its leases,
+    and the TFTP server, which looks them up.
+
+    The file is rewritten whenever a lease changes, and reloaded by the
+    readers whenever it was rewritten.
+    """
+
+    def __init__(self, path=LEASE_FILE_DEFAULT):
+        self.path = path
+        self.clients = {}
+        self._stat = None
+        self._lock = threading.Lock()
+
+    def register(self, ip, vendor_class):
+        """Record the vendor class of the client leased an address, e.g. as
+        the lease_callback of a DHCPServer.
+
+        Args:
+            ip (string): the address leased to the client.
+            vendor_class (string): the client's vendor class identifier.
+        """
+
+        with self._lock:
+            self._reload()
+            if self.clients.get(ip) == vendor_class:
+                return
+            self.clients[ip] = vendor_class
+            data = json.dumps(self.clients, indent=2, sort_keys=True)
+
+            tmp = '%s.%d.tmp' % (self.path, os.getpid())
+            try:
+                with open(tmp, 'w') as f:
+                    f.write(data)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                l.warning('Could not save lease file %s: %s', self.path, e)
+
+    def vendor_class(self, ip):
+        """Return the vendor class of the client leased an address, or
+        None."""
+        with self._lock:
+            self._reload()
+            return self.clients.get(ip)
+
+    def _reload(self):
+        """Load the file again if it changed. Must be called with the lock
+        held."""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if key == self._stat:
+            return
+
+        try:
+            with open(self.path) as f:
+                clients = json.load(f)
+            if not isinstance(clients, dict):
+                raise ValueError('not a JSON object')
+        except (OSError, ValueError) as e:
+            l.warning('Ignoring unreadable lease file %s: %s', self.path, e)
+            return
+        self.clients = clients
+        self._stat = key
+
+
+class ClientProfile(object):
+    """The option limits of a class of TFTP clients.
+
+    Attributes:
+        name (string): the name of the client class.
+        blksize (int): the largest block size the clients handle.
+        windowsize (int): the largest window the clients handle.
+        timeout (int): the retransmission timeout used with the clients when
+            they do not negotiate one, in seconds.
+        vendor_classes (tuple): the DHCP vendor class identifiers of the
+            clients.
+        filenames (tuple): fnmatch patterns of the files the clients
+            request.
+    """
+
+    def __init__(self, name, blksize, windowsize, timeout,
+                 vendor_classes=(), filenames=()):
+        self.name = name
+        self.blksize = blksize
+        self.windowsize = windowsize
+        self.timeout = timeout
+        self.vendor_classes = vendor_classes
+        self.filenames = filenames
+
+    def __repr__(self):
+        return 'ClientProfile(%s)' % self.name
+
+    def matches_filename(self, filename):
+        filename = filename.rsplit('/', 1)[-1]
+        return any(fnmatch.fnmatch(filename, pattern)
+                   for pattern in self.filenames)
+
+
+# The block size filling a 1500-byte Ethernet (or RNDIS) frame.
+_ETHERNET_BLKSIZE = 1468
+
+# The AM335x boot ROM only speaks plain RFC1350, and is given more time to
+# answer.
+PROFILE_AM335X_ROM = ClientProfile(
+        'AM335x ROM', proto.TFTP_DEFAULT_PACKET_SIZE, 1, 2,
+        vendor_classes=('AM335x ROM',),
+        filenames=('MLO*', 'u-boot-spl*'))
+
+# The SPL runs from the internal SRAM, with very few network buffers.
+PROFILE_AM335X_SPL = ClientProfile(
+        'AM335x U-Boot SPL', _ETHERNET_BLKSIZE, 4, 1,
+        vendor_classes=('AM335x U-Boot SPL',),
+        filenames=('u-boot*.img',))
+
+PROFILE_UBOOT = ClientProfile(
+        'U-Boot', _ETHERNET_BLKSIZE, 8, 1,
+        vendor_classes=('AM335x U-Boot', 'U-Boot.armv7'),
+        filenames=('zImage*', 'uImage*', '*.dtb', 'uEnv.txt', 'initrd*'))
+
+# The booted system's busybox tftp does not support windows.
+PROFILE_UDHCP = ClientProfile(
+        'udhcp', _ETHERNET_BLKSIZE, 1, 1,
+        vendor_classes=('udhcp*',))
+
+PROFILE_DEFAULT = ClientProfile(
+        'default', proto.TFTP_BLKSIZE_MAX, proto.TFTP_WINDOWSIZE_MAX, 1)
+
+PROFILES = (PROFILE_AM335X_ROM, PROFILE_AM335X_SPL, PROFILE_UBOOT,
+            PROFILE_UDHCP)
+
+
+class NegotiationPolicy(object):
+    """Chooses the profile of each client and negotiates its options."""
+
+    def __init__(self, profiles=PROFILES, default=PROFILE_DEFAULT,
+                 blksizes=None, leases=None):
+        """Creates a negotiation policy.
+
+        Args:
+            profiles (tuple): the ClientProfiles of the known client classes.
+            default (ClientProfile): the profile of other clients.
+            blksizes (BlksizeTable): the best block size of each interface,
+                if any.
+            leases (LeaseFile): the vendor classes registered by a DHCP
+                server running in another process, if any.
+        """
+
+        self.profiles = profiles
+        self.default = default
+        self.blksizes = blksizes
+        self.leases = leases
+        self.clients = {}
+        self._lock = threading.Lock()
+
+    def register(self, ip, vendor_class):
+        """Record the DHCP vendor class of the client leased an address.
+
+        Args:
+            ip (string): the address leased to the client.
+            vendor_class (string): the client's vendor class identifier.
+        """
+
+        with self._lock:
+            self.clients[ip] = vendor_class
+
+    def profile(self, ip, filename):
+        """Return the profile of a client.
+
+        Args:
+            ip (string): the client's address.
+            filename (string): the file requested by the client.
+        Returns:
+            The ClientProfile of the client's class, or the default profile.
+        """
+
+        with self._lock:
+            vendor_class = self.clients.get(ip)
+        if vendor_class is None and self.leases is not None:
+            vendor_class = self.leases.vendor_class(ip)
+
+        if vendor_class is not None:
+            for profile in self.profiles:
+                if any(fnmatch.fnmatch(vendor_class, pattern)
+                       for pattern in profile.vendor_classes):
+                    return profile
+
+        for profile in self.profiles:
+            if profile.matches_filename(filename):
+                return profile
+
+        return self.default
+
+    def negotiate(self, peer_state, opts, interface=None):
+        """Validate and clamp the options requested for a transfer.
+
+        The transfer's retransmission timeout is also set from the client's
+        profile.
+
+        Args:
+            peer_state (TFTPState): the state of the new transfer.
+            opts (dict): the options of the request, as received.
+            interface (string): the name of the interface the client is
+                reached through, if known.
+        Returns:
+            The dictionnary of the requested options to acknowledge, empty
+            if the request had none, or None if they can't be accepted.
+        """
+
+        profile = self.profile(peer_state.peer[0], peer_state.filename)
+        peer_state.timeout = profile.timeout
+        peer_state.interface = interface
+
+        if not opts:
+            return {}
+
+        try:
+            used = proto.TFTPHelper.parse_options(opts)
+        except ValueError:
+            used = None
+        if not used:
+            l.warning('Invalid options %s requested.', opts)
+            return None
+
+        blksize = min(used[proto.TFTP_OPTION_BLKSIZE], profile.blksize,
+                      get_max_udp_datagram_size() - proto.DATA_HEADER.size)
+
+        # Don't let DATA packets be fragmented.
+        mtu = get_interface_mtu(interface) if interface else None
+        if mtu is not None:
+            blksize = max(proto.TFTP_BLKSIZE_MIN,
+                          min(blksize, mtu_blksize(mtu)))
+
+        # Use the block size measured to work best on the interface, or
+        # explore another one when benchmarking.
+        if self.blksizes is not None and interface:
+            if not self.blksizes.explore:
+                blksize = min(blksize,
+                              self.blksizes.best(interface) or blksize)
+            elif proto.TFTP_OPTION_BLKSIZE in opts:
+                blksize = self.blksizes.choose(interface, blksize)
+                peer_state.explored = blksize
+
+        max_window_size = max(1, get_send_buffer_size() //
+                              proto.TFTPHelper.get_data_size(blksize))
+        windowsize = min(used[proto.TFTP_OPTION_WINDOWSIZE],
+                         profile.windowsize, max_window_size)
+
+        if blksize != used[proto.TFTP_OPTION_BLKSIZE] or \
+                windowsize != used[proto.TFTP_OPTION_WINDOWSIZE]:
+            l.info('Restricting %s client to blksize %d, windowsize %d.',
+                   profile.name, blksize, windowsize)
+
+        used[proto.TFTP_OPTION_BLKSIZE] = blksize
+        used[proto.TFTP_OPTION_WINDOWSIZE] = windowsize
+
+        # Only the options requested are acknowledged (RFC2347), the others
+        # keep their default value.
+        return dict((name, value) for name, value in used.items()
+                    if name in opts)
+
+    def completed(self, peer_state):
+        """Record the goodput of a completed RRQ transfer, when exploring
+        block sizes."""
+
+        # The block size explored is kept by the transfer's own state, so that
+        # transfers which failed or expired leave nothing behind.
+        if self.blksizes is not None and peer_state.explored is not None:
+            self.blksizes.record(peer_state.interface, peer_state.explored,
+                                 peer_state.filesize,
+                                 time.monotonic() - peer_state.started)
@@ -0,0 +1,127 @@
+# coding=utf-8
+# This file is part of pTFTPd.
+#
+# pTFTPd is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pTFTPd is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pTFTPd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Incremental netascii codec.
+
+Files are sent in netascii mode with their line endings (LF, or CRLF) turned
+into CRLF, and received with their CRLF line endings turned back into LF.
+Transfers convert their data one block at a time, so a CR ending a block may
+belong to a CRLF pair completed by the next block: the codecs below hold such
+a CR back until they know what follows it.
+"""
+
+CR = b'\r'
+LF = b'\n'
+CRLF = b'\r\n'
+
+
+def encode(data):
+    """Convert a whole buffer to netascii."""
+    return bytes(data).replace(CRLF, LF).replace(LF, CRLF)
+
+
+def decode(data):
+    """Convert a whole netascii buffer back to local line endings."""
+    return bytes(data).replace(CRLF, LF)
+
+
+class _Codec(object):
+    """Holds back a CR ending a chunk until the next chunk is known."""
+
+    def __init__(self):
+        self.cr = False                     # A CR ending the previous chunk
+                                            # was held back
+
+    def _complete(self, data, final):
+        data = bytes(data)
+        if self.cr:
+            data = CR + data
+        self.cr = not final and data.endswith(CR)
+        if self.cr:
+            data = data[:-1]
+        return data
+
+
+class Encoder(_Codec):
+    """Converts a stream of data to netascii, one chunk at a time."""
+
+    def encode(self, data, final=False):
+        """Convert the next chunk of the stream.
+
+        Args:
+            data (bytes-like): the next chunk of data.
+            final (boolean): whether this is the last chunk of the stream.
+        Returns:
+            The converted data, as bytes.
+        """
+        return encode(self._complete(data, final))
+
+
+class Decoder(_Codec):
+    """Converts a netascii stream back to local line endings, one chunk at a
+    time."""
+
+    def decode(self, data, final=False):
+        """Convert the next chunk of the stream.
+
+        Args:
+            data (bytes-like): the next chunk of netascii data.
+            final (boolean): whether this is the last chunk of the stream.
+        Returns:
+            The converted data, as bytes.
+        """
+        return decode(self._complete(data, final))
+
+
+class EncodingReader(object):
+    """Reads fixed-size blocks of netascii data from a source of raw data."""
+
+    def __init__(self, read):
+        """Creates a new reader.
+
+        Args:
+            read (callable): a function returning up to the given number of
+                bytes of raw data, and an empty buffer at the end of the data.
+        """
+
+        self._read = read
+        self.encoder = Encoder()
+        self.buffer = bytearray()           # Converted data not read yet
+        self.eof = False                    # End of the raw data reached
+
+    def read(self, size):
+        """Return the next size bytes of netascii data, or less at the end
+        of the data."""
+
+        # Converting only ever expands the data, so reading size raw bytes
+        # is always enough to fill the block, but for held back CRs.
+        while len(self.buffer) < size and not self.eof:
+            data = self._read(size)
+            self.eof = not data
+            self.buffer += self.encoder.encode(data, final=self.eof)
+
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def snapshot(self):
+        """Return the state of the reader, to restore() along with the read
+        position of its source."""
+        return bytes(self.buffer), self.encoder.cr, self.eof
+
+    def restore(self, snapshot):
+        buffer, self.encoder.cr, self.eof = snapshot
+        self.buffer = bytearray(buffer)
@@ -35,9 +35,11 @@ import sys
 TRANSFER_STARTED = 1
 TRANSFER_COMPLETED = 2
 TRANSFER_FAILED = 3
+TRANSFER_PROGRESS = 4
 
 _STATE_NAMES = {
         TRANSFER_STARTED: 'STARTED',
+        TRANSFER_PROGRESS: 'PROGRESS',
         TRANSFER_COMPLETED: 'COMPLETED',
         TRANSFER_FAILED: 'FAILED',
 }
@@ -132,11 +132,89 @@ TFTP_TIMEOUT_MAX = 255
 TFTP_WINDOWSIZE_MIN = 1
 TFTP_WINDOWSIZE_MAX = 65535
 
+# Packet opcode
+OPCODE = struct.Struct('!H')
+
+# ACK and DATA packet number, following the opcode
+PACKETNUM = struct.Struct('!H')
+
+# DATA packet header (opcode and packet number)
+DATA_HEADER = struct.Struct('!HH')
+
+# ACK packet (opcode and packet number)
+ACK = struct.Struct('!HH')
+
+# ERROR packet header (opcode and error code)
+ERROR_HEADER = struct.Struct('!HH')
+
+_RRQ_OPCODE = OPCODE.pack(OP_RRQ)
+_WRQ_OPCODE = OPCODE.pack(OP_WRQ)
+_OACK_OPCODE = OPCODE.pack(OP_OACK)
+
+# ACK packets by packet number, built the first time they are needed.
+_ACK_PACKETS = [None] * TFTP_PACKETNUM_MAX
+
+# ERROR packets with the standard message of their error code.
+_ERROR_PACKETS = dict(
+    (errno, ERROR_HEADER.pack(OP_ERROR, errno) + error.encode('ascii') +
+     b'\0') for errno, error in TFTP_ERRORS.items())
+
+# OACK packets by option set. Servers only ever send a few option sets, the
+# ones their client profiles negotiate.
+_OACK_PACKETS = {}
+_OACK_PACKETS_MAX = 256
+
+
+def _pack_fields(fields):
+    """Pack strings as a sequence of NUL-terminated ASCII fields."""
+    return b''.join(str(field).encode('ascii') + b'\0' for field in fields)
+
+
+def _pack_options(opts):
+    return _pack_fields(value for opt in opts.items() for value in opt)
+
+
+def _parse_fields(packet):
+    """Parse a sequence of NUL-terminated ASCII fields, which must come in
+    (name, value) pairs."""
+    fields = str(packet, 'ascii').split('\0')[:-1]
+
+    # If the length of the parsed list is not even, the packet is
+    # malformed and thus parsing should fail.
+    if len(fields) % 2 != 0:
+        raise SyntaxError('invalid request packet')
+
+    return fields
+
+
+def _parse_request(request):
+    """Parse the filename, mode and options of a RRQ or WRQ packet."""
+    fields = _parse_fields(request)
+
+    if not fields or not fields[0]:
+        raise SyntaxError('invalid filename')
+    filename = fields[0]
+
+    mode = fields[1].lower()
+    if mode not in TFTP_MODES:
+        raise SyntaxError('unknown mode %s' % mode)
+
+    opts = {}
+    for i in range(2, len(fields), 2):
+        opt = fields[i].lower()
+        if opt in TFTP_OPTIONS:
+            opts[opt] = fields[i + 1]
+
+    return filename, mode, opts
+
 
 # noinspection PyPep8Naming
 class TFTPHelper(object):
     """
     Static helper methods for the TFTP protocol.
+
+    The packets sent the most (ACK, ERROR and OACK packets) are built once,
+    and shared: callers must not modify them.
     """
 
     def createRRQ(filename, mode, opts):
@@ -155,17 +233,8 @@ class TFTPHelper(object):
             l.debug('  >   %s: %s (mode: %s, opts: %s)',
                     TFTP_OPS[OP_RRQ], filename, mode, opts)
 
-        packet = struct.pack('!H%dsc%dsc' % (len(filename), len(mode)),
-                             OP_RRQ,
-                             filename.encode('ascii'), b'\0',
-                             mode.encode('ascii'), b'\0')
-
-        for opt, val in opts.items():
-            packet += struct.pack('!%dsc%dsc' % (len(opt), len(str(val))),
-                                  opt.encode('ascii'), b'\0',
-                                  str(val).encode('ascii'), b'\0')
-
-        return packet
+        return (_RRQ_OPCODE + _pack_fields((filename, mode)) +
+                _pack_options(opts))
 
     def createWRQ(filename, mode, opts):
         """
@@ -183,17 +252,8 @@ class TFTPHelper(object):
             l.debug('  >   %s: %s (mode: %s, opts: %s)',
                     TFTP_OPS[OP_WRQ], filename, mode, opts)
 
-        packet = struct.pack('!H%dsc%dsc' % (len(filename), len(mode)),
-                             OP_WRQ,
-                             filename.encode('ascii'), b'\0',
-                             mode.encode('ascii'), b'\0')
-
-        for opt, val in opts.items():
-            packet += struct.pack('!%dsc%dsc' % (len(opt), len(str(val))),
-                                  opt.encode('ascii'), b'\0',
-                                  str(val).encode('ascii'), b'\0')
-
-        return packet
+        return (_WRQ_OPCODE + _pack_fields((filename, mode)) +
+                _pack_options(opts))
 
     def createACK(num):
         """
@@ -211,7 +271,10 @@ class TFTPHelper(object):
             elif num == 0:
                 l.debug('  >   %s: Acknowledging transfer.', TFTP_OPS[OP_ACK])
 
-        return struct.pack('!HH', OP_ACK, num)
+        packet = _ACK_PACKETS[num]
+        if packet is None:
+            packet = _ACK_PACKETS[num] = ACK.pack(OP_ACK, num)
+        return packet
 
     def createERROR(errno, errmsg=None):
         """
@@ -226,15 +289,15 @@ class TFTPHelper(object):
           The error packet as a string.
         """
 
-        error = TFTP_ERRORS[errno]
-        if errno == ERROR_UNDEF and errmsg:
-            error = errmsg
-
         if _LOG_PROTO:
-            l.debug('  > %s: %d %s', TFTP_OPS[OP_ERROR], errno, error)
-        return struct.pack('!HH%dsc' % len(error),
-                           OP_ERROR, errno,
-                           error.encode('ascii'), b'\0')
+            l.debug('  > %s: %d %s', TFTP_OPS[OP_ERROR], errno,
+                    errmsg if errno == ERROR_UNDEF and errmsg
+                    else TFTP_ERRORS[errno])
+
+        if errno == ERROR_UNDEF and errmsg:
+            return (ERROR_HEADER.pack(OP_ERROR, errno) +
+                    errmsg.encode('ascii') + b'\0')
+        return _ERROR_PACKETS[errno]
 
     def createDATA(num, data):
         """
@@ -242,7 +305,7 @@ class TFTPHelper(object):
 
         Args:
           num: the data packet number (int).
-          data: the data to be sent (bytes).
+          data: the data to be sent (bytes or memoryview).
         Returns:
           The data packet as a string.
         """
@@ -250,7 +313,28 @@ class TFTPHelper(object):
         if _LOG_PROTO:
             l.debug('  >  %s: #%d (%d bytes)', TFTP_OPS[OP_DATA], num,
                     len(data))
-        return struct.pack('!HH%ds' % len(data), OP_DATA, num, data)
+        return DATA_HEADER.pack(OP_DATA, num) + data
+
+    def createDATAVector(num, data, header):
+        """
+        Creates a TFTP data packet as a scatter/gather vector, suitable for
+        socket.sendmsg(). Neither the payload nor the header are copied.
+
+        Args:
+          num: the data packet number (int).
+          data: the data to be sent (bytes or memoryview).
+          header: a writable buffer of DATA_HEADER.size bytes, in which the
+            packet header is packed. It can be reused once the packet has
+            been sent.
+        Returns:
+          The data packet as a [header, data] list.
+        """
+
+        if _LOG_PROTO:
+            l.debug('  >  %s: #%d (%d bytes)', TFTP_OPS[OP_DATA], num,
+                    len(data))
+        DATA_HEADER.pack_into(header, 0, OP_DATA, num)
+        return [header, data]
 
     def createOACK(opts):
         """
@@ -265,47 +349,30 @@ class TFTPHelper(object):
         if _LOG_PROTO:
             l.debug('  >  %s: %s', TFTP_OPS[OP_OACK], opts)
 
-        opts_str = ''
-        for opt, val in opts.items():
-            opts_str += '%s%c%s%c' % (opt, '\0', val, '\0')
-
-        return struct.pack('!H%ds' % len(opts_str),
-                           OP_OACK, opts_str.encode('ascii'))
+        key = tuple(opts.items())
+        packet = _OACK_PACKETS.get(key)
+        if packet is None:
+            packet = _OACK_OPCODE + _pack_options(opts)
+            # The transfer size option makes most option sets unique, don't
+            # let them pile up.
+            if len(_OACK_PACKETS) >= _OACK_PACKETS_MAX:
+                _OACK_PACKETS.clear()
+            _OACK_PACKETS[key] = packet
+        return packet
 
     def parseRRQ(request):
         """
         Parses a RRQ packet to extract the requested mode and filename.
 
         Args:
-          request: the RRQ packet without the TFTP opcode (string).
+          request: the RRQ packet without the TFTP opcode (bytes-like).
         Returns:
           The filename, mode and options of the request.
         Throws:
           If the parsing failed, a SyntaxError is raised.
         """
 
-        packet = request.split(b'\0')[:-1]
-
-        # If the length of the parsed list is not even, the packet is
-        # malformed and thus parsing should fail.
-        if len(packet) % 2 != 0:
-            raise SyntaxError('invalid request packet')
-
-        filename = packet[0].decode('ascii')
-        if not filename:
-            raise SyntaxError('invalid filename')
-
-        mode = packet[1].decode('ascii').lower()
-        if mode not in TFTP_MODES:
-            raise SyntaxError('unknown mode %s' % mode)
-
-        opts = {}
-        for i in range(2, len(packet)-1, 2):
-            opt = packet[i].decode('ascii').lower()
-            val = packet[i+1].decode('ascii')
-
-            if opt in TFTP_OPTIONS:
-                opts[opt] = val
+        filename, mode, opts = _parse_request(request)
 
         if _LOG_PROTO:
             l.debug('  <   %s: %s (mode: %s, opts: %s)',
@@ -317,35 +384,14 @@ class TFTPHelper(object):
         Parses a WRQ packet to extract the requested mode and filename.
 
         Args:
-          request: the WRQ packet without the TFTP opcode (string).
+          request: the WRQ packet without the TFTP opcode (bytes-like).
         Returns:
           The filename, mode and options of the request.
         Throws:
           If the parsing failed, a SyntaxError is raised.
         """
 
-        packet = request.split(b'\0')[:-1]
-
-        # If the length of the parsed list is not even, the packet is
-        # malformed and thus parsing should fail.
-        if len(packet) % 2 != 0:
-            raise SyntaxError('invalid request packet')
-
-        filename = packet[0].decode('ascii')
-        if not filename:
-            raise SyntaxError('invalid filename')
-
-        mode = packet[1].decode('ascii').lower()
-        if mode not in TFTP_MODES:
-            raise SyntaxError('unknown mode %s' % mode)
-
-        opts = {}
-        for i in range(2, len(packet)-1, 2):
-            opt = packet[i].decode('ascii').lower()
-            val = packet[i+1].decode('ascii')
-
-            if opt in TFTP_OPTIONS:
-                opts[opt] = val
+        filename, mode, opts = _parse_request(request)
 
         if _LOG_PROTO:
             l.debug('  <   %s: %s (mode: %s, opts: %s)',
@@ -357,7 +403,7 @@ class TFTPHelper(object):
         Parses a ACK packet to extract the data packet number acked.
 
         Args:
-          request: the ACK packet without the TFTP opcode (string).
+          request: the ACK packet without the TFTP opcode (bytes-like).
         Returns:
           The number of the ACKed packet.
         Throws:
@@ -365,12 +411,10 @@ class TFTPHelper(object):
         """
 
         try:
-            packet = struct.unpack('!H', request)
+            num = PACKETNUM.unpack(request)[0]
         except struct.error:
             raise SyntaxError('invalid acknowledgment packet')
 
-        num = packet[0]
-
         if _LOG_PROTO:
             if num > 0:
                 l.debug('  <   %s: #%d', TFTP_OPS[OP_ACK], num)
@@ -384,20 +428,20 @@ class TFTPHelper(object):
         Parses a DATA packet to extract the data packet number acked.
 
         Args:
-          request: the DATA packet without the TFTP opcode (string).
+          request: the DATA packet without the TFTP opcode (bytes-like).
         Returns:
           A (num, data) tuple containing the number of the data packet
-          and the data itself.
+          and the data itself, a slice of the request (a memoryview of the
+          receive buffer, if the request is one).
         Throws:
           If the parsing failed, a SyntaxError is raised.
         """
 
         try:
-            packet = struct.unpack('!H', request[:2])
+            num = PACKETNUM.unpack_from(request)[0]
         except struct.error:
             raise SyntaxError('invalid data packet')
 
-        num = packet[0]
         data = request[2:]
 
         if _LOG_PROTO:
@@ -410,7 +454,7 @@ class TFTPHelper(object):
         Parses an ERROR packet to extract the data packet number acked.
 
         Args:
-          request: the ERROR packet without the TFTP opcode (string).
+          request: the ERROR packet without the TFTP opcode (bytes-like).
         Returns:
           A (errno, errmsg) tuple containing the error number and the
           associated error message.
@@ -419,9 +463,8 @@ class TFTPHelper(object):
         """
 
         try:
-            packet = struct.unpack('!H', request[:2])
-            errno = packet[0]
-            errmsg = request[2:].split(b'\0')[0].decode('ascii')
+            errno = PACKETNUM.unpack_from(request)[0]
+            errmsg = bytes(request[2:]).split(b'\0', 1)[0].decode('ascii')
         except (struct.error, IndexError):
             raise SyntaxError('invalid error packet')
 
@@ -434,23 +477,15 @@ class TFTPHelper(object):
         Parses an OACK packet to extract the validated options.
 
         Args:
-          request (string): the OACK packet without the TFTP opcode.
+          request (bytes-like): the OACK packet without the TFTP opcode.
         Returns:
           A dictionnary of the acknowledged options.
         """
 
-        packet = request.split(b'\0')[:-1]
-
-        # If the length of the parsed list is not even, the packet is
-        # malformed and thus parsing should fail.
-        if len(packet) % 2 != 0:
-            raise SyntaxError('invalid request packet')
-
+        fields = _parse_fields(request)
         opts = {}
-        for i in range(0, len(packet)-1, 2):
-            opt = packet[i].decode('ascii').lower()
-            val = packet[i+1].decode('ascii')
-            opts[opt] = val
+        for i in range(0, len(fields), 2):
+            opts[fields[i].lower()] = fields[i + 1]
 
         if _LOG_PROTO:
             l.debug('  <  %s: %s', TFTP_OPS[OP_OACK], opts)
@@ -460,7 +495,7 @@ class TFTPHelper(object):
     def get_opcode(data):
         if data:
             try:
-                return struct.unpack('!H', data[:2])[0]
+                return OPCODE.unpack_from(data)[0]
             except (struct.error, KeyError):
                 raise SyntaxError('invalid packet')
 
@@ -516,6 +551,7 @@ class TFTPHelper(object):
     createWRQ = staticmethod(createWRQ)
     createACK = staticmethod(createACK)
     createDATA = staticmethod(createDATA)
+    createDATAVector = staticmethod(createDATAVector)
     createERROR = staticmethod(createERROR)
     createOACK = staticmethod(createOACK)
 
@@ -0,0 +1,168 @@
+# coding=utf-8
+# This file is part of pTFTPd.
+#
+# pTFTPd is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pTFTPd is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pTFTPd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Session table of the transfers in progress.
+
+Transfer states are registered by peer, and dropped once their peer has been
+silent for longer than the session timeout. Sessions are indexed by their
+expiry time in a heap, so that reaping them only costs the sessions that
+actually expire: a session whose peer was seen again since it was indexed is
+simply indexed again with its new expiry time.
+
+The table may be used from several threads at once: the server handler, the
+transfer threads and the reaper.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+from . import notify
+from . import state
+
+l = notify.getLogger('tftp-sessions')
+
+
+class SessionTable(object):
+    """A thread-safe registry of transfer states by peer, expiring them
+    when they time out."""
+
+    def __init__(self, timeout=state.STATE_TIMEOUT_SECS, expired=None):
+        """Creates an empty table.
+
+        Args:
+            timeout (float): the time after which a silent peer's session
+                expires, in seconds.
+            expired (callable): called with the peer and the state of every
+                expired session, once removed from the table.
+        """
+
+        self.timeout = timeout
+        self.expired = expired
+        self._sessions = {}                 # peer -> (state, id)
+        self._heap = []                     # (expiry, id, peer)
+        self._ids = itertools.count()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, peer):
+        return peer in self._sessions
+
+    def __iter__(self):
+        with self._cond:
+            return iter(list(self._sessions))
+
+    def __getitem__(self, peer):
+        return self._sessions[peer][0]
+
+    def get(self, peer, default=None):
+        session = self._sessions.get(peer)
+        return default if session is None else session[0]
+
+    def __setitem__(self, peer, peer_state):
+        with self._cond:
+            session_id = next(self._ids)
+            self._sessions[peer] = (peer_state, session_id)
+            heapq.heappush(self._heap, (peer_state.last_seen + self.timeout,
+                                        session_id, peer))
+            if self._heap[0][1] == session_id:
+                self._cond.notify()
+
+    def __delitem__(self, peer):
+        with self._cond:
+            del self._sessions[peer]
+
+    def pop(self, peer, default=None):
+        """Remove the session of the given peer, if still registered, and
+        return its state."""
+        with self._cond:
+            session = self._sessions.pop(peer, None)
+        return default if session is None else session[0]
+
+    def next_expiry(self):
+        """Returns the time.monotonic() time of the next possible expiry, or
+        None if the table is empty."""
+        with self._cond:
+            return self._heap[0][0] if self._heap else None
+
+    def reap(self, now=None):
+        """Remove the sessions that expired by the given time.
+
+        Args:
+            now (float): the current time.monotonic() value.
+        Returns:
+            The number of sessions expired.
+        """
+
+        if now is None:
+            now = time.monotonic()
+
+        expired = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                _, session_id, peer = heapq.heappop(self._heap)
+                peer_state, current_id = self._sessions.get(peer, (None, None))
+                if current_id != session_id:
+                    # Removed or replaced since.
+                    continue
+
+                expiry = peer_state.last_seen + self.timeout
+                if expiry > now:
+                    heapq.heappush(self._heap, (expiry, session_id, peer))
+                    continue
+
+                del self._sessions[peer]
+                expired.append((peer, peer_state))
+
+        # Expiry callbacks are called without the lock held, as they may
+        # have to wait for uploads to be written out.
+        for peer, peer_state in expired:
+            if self.expired is None:
+                continue
+            try:
+                self.expired(peer, peer_state)
+            except Exception:
+                l.exception('Session expiry callback failed.')
+        return len(expired)
+
+    def wait(self, timeout=None):
+        """Wait until a session may have expired, or for the given time at
+        most."""
+        with self._cond:
+            delay = timeout
+            if self._heap:
+                delay = self._heap[0][0] - time.monotonic()
+                if timeout is not None:
+                    delay = min(delay, timeout)
+            if delay is None or delay > 0:
+                self._cond.wait(delay)
+
+
+class SessionReaper(threading.Thread):
+    """A thread expiring the sessions of a table as they time out."""
+
+    def __init__(self, table):
+        threading.Thread.__init__(self)
+        self.table = table
+        self.daemon = True
+
+    def run(self):
+        while True:
+            self.table.wait()
+            self.table.reap()
@@ -17,11 +17,20 @@
 # You should have received a copy of the GNU General Public License
 # along with pTFTPd.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import errno
 import os
 import time
+import types
 
+from metrics import registry
+
+from . import netascii
+from . import notify
 from . import proto
+from . import writer
+
+l = notify.getLogger('tftp-state')
 
 STATE_SEND = 1
 STATE_SEND_OACK = 2
@@ -30,8 +39,47 @@ STATE_RECV = 8
 STATE_RECV_ACK = 16
 STATE_ERROR = 32
 
+# Outcomes of an ACK received while sending (see TFTPState.ack).
+ACK_WINDOW = 1
+ACK_PARTIAL = 2
+ACK_DUPLICATE = 3
+ACK_INVALID = 4
+
+# Outcomes of a DATA packet received while receiving (see TFTPState.receive).
+DATA_NEXT = 1
+DATA_AHEAD = 2
+DATA_DUPLICATE = 3
+DATA_INVALID = 4
+
 STATE_TIMEOUT_SECS = 10
 
+# Default retransmission timeout, when the client did not negotiate one with
+# the timeout option (RFC2349). The timeout doubles after each retransmission
+# of the same packets.
+STATE_RETRANSMIT_SECS = 1
+
+# Number of times the same packets are retransmitted before giving up.
+STATE_RETRIES_MAX = 5
+
+# Pause between the bursts a window is split into when the transfer backs
+# off, to let the peer drain its receive buffers.
+STATE_BURST_GAP_SECS = 0.002
+
+# Transfer metrics, see the metrics package.
+_metrics = registry.get_registry()
+_DATA_SENT = _metrics.counter('tftp_data_sent_bytes_total',
+                              'Bytes of file data sent in DATA packets.')
+_DATA_RECEIVED = _metrics.counter('tftp_data_received_bytes_total',
+                                  'Bytes of file data received.')
+_RETRANSMITS = _metrics.counter('tftp_retransmits_total',
+                                'Packets retransmitted.')
+
+# Options of the transfers that did not negotiate any, shared by all of them.
+STATE_DEFAULT_OPTS = types.MappingProxyType({
+    proto.TFTP_OPTION_BLKSIZE: proto.TFTP_DEFAULT_PACKET_SIZE,
+    proto.TFTP_OPTION_WINDOWSIZE: proto.TFTP_DEFAULT_WINDOW_SIZE,
+})
+
 
 class TFTPState(object):
     """
@@ -39,8 +87,21 @@ class TFTPState(object):
     stateful, we use a global state registry of TFTPState objects to
     keep track of each request's state through the life of a connexion
     with a client.
+
+    A server may have to keep thousands of short transfers around, so states
+    are slotted, and release their file as soon as the transfer ends through
+    close() rather than when they get garbage collected.
     """
 
+    __slots__ = ('peer', 'op', 'path', 'filename', 'mode', 'filepath', 'tid',
+                 'sock', 'interface', 'explored', 'file', 'image', 'offset', 'packets',
+                 'block', 'filesize', 'state', 'done', 'opts', 'oack',
+                 'last_seen', 'started', 'progressed', 'packetnum',
+                 'last_acked', 'loop_packetnum', 'total_packets', 'error',
+                 'data', 'netascii', 'ahead', 'reordered', 'unacked',
+                 'marks', 'retries', 'timeout', 'retransmits', 'burst',
+                 'pacing', 'congested', 'trajectory', 'headers')
+
     def __init__(self, peer, op, path, filename, mode, loop_packet=True):
         """
         Initializes a new TFTP state for the given peer.
@@ -61,20 +122,33 @@ class TFTPState(object):
         self.filepath = os.path.abspath(os.path.join(self.path, self.filename))
 
         self.tid = None                     # Transfer ID
+        self.sock = None                    # Socket of the transfer, bound
+                                            # to the transfer ID port
+        self.interface = None               # Network interface the peer is
+                                            # reached through, if known
+        self.explored = None                # Block size explored by the
+                                            # transfer, when benchmarking
         self.file = None                    # File object to read from or
                                             # write to
+        self.image = None                   # Cached image to serve from
+                                            # instead of the file
+        self.offset = 0                     # Read position in the image
+        self.packets = None                 # Precomputed DATA packets to
+                                            # serve, if any
+        self.block = 0                      # Number of DATA blocks produced
         self.filesize = 0                   # File size in bytes
         self.state = None                   # Current transaction state
                                             # (send/recv/last/error)
         self.done = False                   # Transaction complete flag
 
         # Option defaults
-        self.opts = {
-            proto.TFTP_OPTION_BLKSIZE: proto.TFTP_DEFAULT_PACKET_SIZE,
-            proto.TFTP_OPTION_WINDOWSIZE: proto.TFTP_DEFAULT_WINDOW_SIZE,
-        }
+        self.opts = STATE_DEFAULT_OPTS
+        self.oack = None                    # Options acknowledged by OACK
 
-        self.last_seen = time.time()
+        self.last_seen = time.monotonic()
+        self.started = self.last_seen
+        self.progressed = self.started      # Time of the last progress
+                                            # event (see events module)
 
         self.packetnum = None               # Current data packet number
         self.last_acked = 0                 # Packet number of the last acked
@@ -85,7 +159,38 @@ class TFTPState(object):
         self.error = None                   # TFTP error code to send
                                             # (if state == error)
         self.data = None
-        self.tosend = bytes()
+        self.netascii = None                # Netascii codec of the transfer,
+                                            # if converting on the fly
+        self.ahead = {}                     # DATA blocks received ahead of
+                                            # a missing one, by packet number
+        self.reordered = None               # Blocks received out of order,
+                                            # by distance to the missing
+                                            # block (a Counter), if any
+
+        self.unacked = []                   # Packets sent and not acked yet
+        self.marks = []                     # Read positions of the unacked
+                                            # DATA packets, to resume from
+        self.retries = 0                    # Retransmissions of the unacked
+                                            # packets
+        self.timeout = STATE_RETRANSMIT_SECS  # Retransmission timeout, unless
+                                            # negotiated
+        self.retransmits = 0                # Total number of packets
+                                            # retransmitted
+
+        # Window congestion control. Windows are sent in bursts of up to
+        # self.burst packets, which grows by one packet for every window
+        # acked without loss and is halved when packets get lost.
+        self.burst = proto.TFTP_DEFAULT_WINDOW_SIZE
+        self.pacing = 0                     # Delay between two DATA packets
+                                            # of a window, in seconds
+        self.congested = False              # Burst already reduced for the
+                                            # current window
+        self.trajectory = []                # (block, burst) changes of the
+                                            # burst size
+
+        # DATA packet header buffers, one per packet of a window. They are
+        # reused from one window to the next.
+        self.headers = []
 
     def extra(self, state):
         """Build an extra information dictionnary we can pass to logging
@@ -103,15 +208,6 @@ class TFTPState(object):
                 'file': self.filename,
                 'state': state}
 
-    def __del__(self):
-        if not self.file:
-            return
-
-        try:
-            self.file.close()
-        except AttributeError:
-            pass
-
     def __str__(self):
         s = "TFTPState/%s for %s<%s>\n" % (proto.TFTP_OPS[self.op],
                                            self.peer,
@@ -120,6 +216,8 @@ class TFTPState(object):
         s += "  mode : %s\n" % self.mode
         s += "  state: %s\n" % self.state
         s += "  opts : %s\n" % self.opts
+        s += "  retransmits: %d\n" % self.retransmits
+        s += "  burst: %d\n" % self.burst
 
         return s
 
@@ -128,29 +226,260 @@ class TFTPState(object):
 
     def purge(self):
         """
-        Remove the used file on demand.
+        Remove the uploaded file on demand. Uploads are written to a
+        temporary file until they complete, which is removed.
         """
 
         if self.filepath and self.file:
-            try:
-                os.remove(self.filepath)
-                return True
-            except OSError:
-                return False
+            self.file.abort()
+            self.file = None
+            return True
+
+    def close(self):
+        """
+        Release the resources of the transfer once it is over, whether it
+        completed or not. Uploads are only ever published by a successful
+        transfer, the others are purged. Closing a state twice is harmless.
+        """
+
+        try:
+            if self.op == proto.OP_WRQ:
+                if not self.done:
+                    self.purge()
+            elif self.file:
+                self.file.close()
+        finally:
+            self.file = None
+            self.image = None
+            self.packets = None
+            self.netascii = None
+            self.ahead = {}
 
     def ping(self):
         """
         Update the last seen value to restart the watchdog.
         """
 
-        self.last_seen = time.time()
+        self.last_seen = time.monotonic()
+
+    def rto(self):
+        """
+        Returns the current retransmission timeout, in seconds. It starts at
+        the negotiated timeout and doubles with every retransmission.
+        """
+
+        timeout = self.opts.get(proto.TFTP_OPTION_TIMEOUT, self.timeout)
+        return min(timeout << self.retries, max(timeout, STATE_TIMEOUT_SECS))
+
+    def resend(self):
+        """
+        Returns the packets that have not been acknowledged yet, to be sent
+        again.
+        """
+
+        self.retransmits += len(self.unacked)
+        _RETRANSMITS.inc(len(self.unacked))
+        return self.unacked
+
+    def retransmit(self):
+        """
+        Handle a retransmission timeout.
+
+        Returns:
+          The list of packets to send again, or None if they have been
+          retransmitted too many times already and the transfer should be
+          abandoned.
+        """
+
+        if self.retries >= STATE_RETRIES_MAX:
+            return None
+
+        # Acknowledge what was received of the window so far, so that the
+        # client resends only what is missing.
+        if self.state == STATE_RECV and self.__received():
+            self.last_acked = (self.packetnum - 1) % proto.TFTP_PACKETNUM_MAX
+            self.unacked = [proto.TFTPHelper.createACK(self.last_acked)]
+
+        self.shrink()
+        self.retries += 1
+        self.ping()
+        return self.resend()
+
+    def seed(self, burst=None):
+        """
+        Set the initial burst size of the transfer, typically from the one
+        its client ended its previous transfer with. Starts with full windows
+        by default.
+        """
+
+        windowsize = self.opts[proto.TFTP_OPTION_WINDOWSIZE]
+        self.burst = max(1, min(burst or windowsize, windowsize))
+        self.trajectory = [(self.block, self.burst)]
+
+    def grow(self):
+        """Additively increase the burst size after a clean window."""
+        if self.burst < self.opts[proto.TFTP_OPTION_WINDOWSIZE]:
+            self.burst += 1
+            self.trajectory.append((self.block, self.burst))
+
+    def shrink(self):
+        """Halve the burst size after a loss, once per window."""
+        if self.congested:
+            return
+        self.congested = True
+        if self.burst > 1:
+            self.burst //= 2
+            self.trajectory.append((self.block, self.burst))
+
+    def throughput(self):
+        """Returns the average transfer rate so far, in bytes per
+        second."""
+        elapsed = time.monotonic() - self.started
+        return self.filesize / elapsed if elapsed > 0 else 0
+
+    def ack(self, num):
+        """
+        Acknowledge the DATA packets sent up to the given packet number.
+
+        With windowed transfers (RFC7440), an ACK for a packet within the
+        window means the packets following it were lost: the transfer is
+        rewound so that the next window starts right after the acked packet.
+
+        Args:
+          num (integer): the packet number of the received ACK.
+        Returns:
+          ACK_WINDOW if all the packets sent have been acked, ACK_PARTIAL if
+          the transfer has been rewound to the acked packet, ACK_DUPLICATE if
+          the ACK acknowledges nothing new and ACK_INVALID if it does not
+          match any packet sent.
+        """
+
+        windowsize = self.opts[proto.TFTP_OPTION_WINDOWSIZE]
+        sent = (self.packetnum - self.last_acked) % proto.TFTP_PACKETNUM_MAX
+        acked = (num - self.last_acked) % proto.TFTP_PACKETNUM_MAX
+
+        # Acks the whole window, or the OACK when no DATA was sent yet.
+        if acked == sent and (sent or self.unacked):
+            if sent and not self.retries:
+                self.grow()
+            self.last_acked = num
+            return ACK_WINDOW
+
+        # The client acked the previous window again, or only part of the
+        # current one.
+        if sent and (0 < acked < sent or (acked == 0 and windowsize > 1)):
+            self.__rewind(acked)
+            self.shrink()
+            self.last_acked = self.packetnum = num
+            return ACK_PARTIAL
+
+        if acked == 0 or \
+                (self.last_acked - num) % proto.TFTP_PACKETNUM_MAX <= windowsize:
+            self.shrink()
+            return ACK_DUPLICATE
+
+        return ACK_INVALID
+
+    def receive(self, num, data):
+        """
+        Handle a DATA packet received.
+
+        With windowed transfers (RFC7440), the blocks received ahead of a
+        missing one are kept until the missing block arrives, and are then
+        written in order. When the client reaches the end of its window with
+        blocks missing, the blocks received up to the first missing one are
+        acked, so that the client resends from there.
+
+        Args:
+          num (integer): the packet number of the DATA packet.
+          data (bytes-like): the block of data.
+        Returns:
+          A tuple (outcome, packet) where outcome is DATA_NEXT if the block
+          was the expected one, DATA_AHEAD if it was kept for later,
+          DATA_DUPLICATE if it was already received and DATA_INVALID if it
+          is outside of the window, and packet is the packet to reply with,
+          if any.
+        """
+
+        windowsize = self.opts[proto.TFTP_OPTION_WINDOWSIZE]
+        distance = (num - self.packetnum) % proto.TFTP_PACKETNUM_MAX
+        window = (num - self.last_acked) % proto.TFTP_PACKETNUM_MAX
+
+        if distance == 0:
+            self.data = data
+            packet = self.next()
+
+            # Write the blocks that were waiting for this one.
+            while self.packetnum in self.ahead and \
+                    self.state == STATE_RECV and not self.done:
+                self.data = self.ahead.pop(self.packetnum)
+                packet = self.next() or packet
+            return DATA_NEXT, packet
+
+        if (self.packetnum - num) % proto.TFTP_PACKETNUM_MAX <= windowsize:
+            # Our ACK was lost, the client resent its window.
+            if num == self.last_acked:
+                self.retransmits += 1
+                _RETRANSMITS.inc()
+                return DATA_DUPLICATE, proto.TFTPHelper.createACK(num)
+            return DATA_DUPLICATE, None
+
+        if 0 < window <= windowsize:
+            if num not in self.ahead:
+                self.ahead[num] = bytes(data)
+                if self.reordered is None:
+                    self.reordered = collections.Counter()
+                self.reordered[distance] += 1
+
+            # The client is done with its window, or with the file.
+            if window == windowsize or \
+                    len(data) < self.opts[proto.TFTP_OPTION_BLKSIZE]:
+                return DATA_AHEAD, self.__cumulative_ack()
+            return DATA_AHEAD, None
+
+        self.state = STATE_ERROR
+        self.error = proto.ERROR_ILLEGAL_OP
+        return DATA_INVALID, self.next()
+
+    def __received(self):
+        """Returns whether DATA blocks were received since the last ACK."""
+        return self.packetnum is not None and \
+            (self.packetnum - 1 - self.last_acked) % \
+            proto.TFTP_PACKETNUM_MAX != 0
+
+    def __cumulative_ack(self):
+        """Ack the blocks received up to the first missing one."""
+        self.last_acked = (self.packetnum - 1) % proto.TFTP_PACKETNUM_MAX
+        return self.__flight(proto.TFTPHelper.createACK(self.last_acked))
+
+    def __rewind(self, acked):
+        """Resume the transfer after the given number of packets of the
+        current window."""
+        self.block, position, codec = self.marks[acked]
+        if self.image is None and self.file:
+            self.file.seek(position)
+        else:
+            self.offset = position
+        if codec is not None:
+            self.netascii.restore(codec)
+
+        if self.state == STATE_SEND_LAST:
+            self.state = STATE_SEND
+
+    def __flight(self, packet):
+        """Start a new flight of packets, the peer having acked the previous
+        one."""
+        self.unacked = [packet]
+        self.retries = 0
+        return packet
 
     def set_opts(self, opts):
         """
         Set this state options.
 
         Args:
-          opts (dict): a dictionnary of validated options.
+          opts (dict): a dictionnary of validated options, the ones to
+            acknowledge. The others keep their default value.
         """
 
         if not opts:
@@ -159,7 +488,9 @@ class TFTPState(object):
         if opts.get(proto.TFTP_OPTION_TSIZE) == 0:
             opts[proto.TFTP_OPTION_TSIZE] = self.filesize
 
-        self.opts = opts
+        self.oack = opts
+        self.opts = dict(STATE_DEFAULT_OPTS, **opts)
+        self.seed()
 
     def next(self):
         """
@@ -187,17 +518,65 @@ class TFTPState(object):
 
         return None
 
+    def __read(self, size):
+        if self.image is None:
+            return self.file.read(size)
+
+        # Serve a slice of the shared image buffer, without copying it.
+        start = self.offset
+        self.offset = min(start + size, self.image.size)
+        return self.image.buffer[start:self.offset]
+
     def __next_send(self):
-        blksize = self.opts[proto.TFTP_OPTION_BLKSIZE]
-        fromfile = self.file.read(blksize - len(self.tosend))
+        # The last packet sent was acked, this one starts a new window.
+        if self.packetnum == self.last_acked:
+            self.unacked = []
+            self.marks = []
+            self.retries = 0
+            self.congested = False
+
+        # Files are converted to netascii on the fly, unless served from a
+        # converted image.
+        if self.netascii is None and self.mode == 'netascii' and \
+                self.packets is None and \
+                (self.image is None or self.image.mode != 'netascii'):
+            self.netascii = netascii.EncodingReader(self.__read)
+
+        # Remember where this packet is read from, should the transfer have to
+        # be resumed from it.
+        if self.image is None and self.file and self.packets is None:
+            position = self.file.tell()
+        else:
+            position = self.offset
+        codec = self.netascii.snapshot() if self.netascii else None
+        self.marks.append((self.block, position, codec))
+
+        if self.packets is not None:
+            packet = self.__next_table_packet()
+        else:
+            packet = self.__next_data_packet()
+        self.unacked.append(packet)
 
-        # Convert LF to CRLF if needed
-        if self.mode == 'netascii':
-            fromfile = proto.OCTET_TO_NETASCII.sub(b'\r\n', fromfile)
+        # If the window hasn't been completed yet, send the DATA packet
+        # and provide a continuation for the next DATA packet to send in the
+        # window, paced if needed.
+        sent = (self.packetnum - self.last_acked) % proto.TFTP_PACKETNUM_MAX
+        if self.state == STATE_SEND and \
+                sent < self.opts[proto.TFTP_OPTION_WINDOWSIZE]:
+            if sent % self.burst == 0:
+                return packet, self.next, self.pacing + STATE_BURST_GAP_SECS
+            if self.pacing:
+                return packet, self.next, self.pacing
+            return packet, self.next
+
+        # Otherwise just send this DATA packet and we'll wait for the client to
+        # reply with a ACK.
+        return packet
 
-        self.data = self.tosend + fromfile
-        self.tosend = bytes()
+    def __next_table_packet(self):
+        packet = self.packets[self.block]
 
+        self.block += 1
         self.packetnum += 1
         self.total_packets += 1
 
@@ -205,59 +584,79 @@ class TFTPState(object):
         if self.packetnum == proto.TFTP_PACKETNUM_MAX and self.loop_packetnum:
             self.packetnum = proto.TFTP_PACKETNUM_RESET
 
-        data_len = len(self.data)
-        if data_len > blksize:
-            self.tosend = self.data[blksize:]
-            self.data = self.data[:blksize]
-        elif data_len < blksize:
-            self.file.close()
+        if self.block == len(self.packets):
             self.state = STATE_SEND_LAST
 
-        packet = proto.TFTPHelper.createDATA(self.packetnum, self.data)
+        _DATA_SENT.inc(len(packet) - proto.DATA_HEADER.size)
+        return packet
 
-        # If the window hasn't been completed yet, send the DATA packet
-        # and provide a continuation for the next DATA packet to send in the
-        # window.
-        next_window = self.last_acked + self.opts[proto.TFTP_OPTION_WINDOWSIZE]
-        if self.state == STATE_SEND and self.packetnum < next_window:
-            return packet, self.next
+    def __next_data_packet(self):
+        blksize = self.opts[proto.TFTP_OPTION_BLKSIZE]
+        if self.netascii is not None:
+            self.data = self.netascii.read(blksize)
+        else:
+            self.data = self.__read(blksize)
 
-        # Otherwise just send this DATA packet and we'll wait for the client to
-        # reply with a ACK.
-        return packet
+        self.block += 1
+        self.packetnum += 1
+        self.total_packets += 1
+
+        # Packet number wraparound
+        if self.packetnum == proto.TFTP_PACKETNUM_MAX and self.loop_packetnum:
+            self.packetnum = proto.TFTP_PACKETNUM_RESET
+
+        if len(self.data) < blksize:
+            # The file is kept open until the last packet is acked, in case
+            # the transfer has to be resumed from an earlier packet.
+            self.state = STATE_SEND_LAST
+
+        # Unacked packets of the window may be retransmitted, so each of them
+        # needs its own header buffer.
+        index = len(self.unacked)
+        if index == len(self.headers):
+            self.headers.append(bytearray(proto.DATA_HEADER.size))
+
+        _DATA_SENT.inc(len(self.data))
+
+        return proto.TFTPHelper.createDATAVector(self.packetnum, self.data,
+                                                 self.headers[index])
 
     def __next_send_oack(self):
         self.state = STATE_SEND if self.op == proto.OP_RRQ else STATE_RECV
-        return proto.TFTPHelper.createOACK(self.opts)
+        return self.__flight(proto.TFTPHelper.createOACK(self.oack))
 
     def __next_recv_ack(self):
         self.state = STATE_RECV
-        return proto.TFTPHelper.createACK(0)
+        return self.__flight(proto.TFTPHelper.createACK(0))
 
     def __next_recv(self):
+        last = len(self.data) < self.opts[proto.TFTP_OPTION_BLKSIZE]
+
         # Convert CRLF to LF if needed
         if self.mode == 'netascii':
-            self.data = proto.NETASCII_TO_OCTET.sub(b'\n', self.data)
-
-        data_len = len(self.data)
-        if data_len < self.opts[proto.TFTP_OPTION_BLKSIZE]:
-            self.done = True
+            if self.netascii is None:
+                self.netascii = netascii.Decoder()
+            self.data = self.netascii.decode(self.data, final=last)
 
+        # Blocks are written behind (see tftp.writer), the upload is only
+        # complete once the file has been published.
         try:
             self.filesize += len(self.data)
+            _DATA_RECEIVED.inc(len(self.data))
             self.file.write(self.data)
+            if last:
+                self.file.close()
         except IOError as e:
-            self.file.close()
-            if e.errno == errno.ENOSPC:
-                return proto.TFTPHelper.createERROR(proto.ERROR_DISK_FULL)
+            self.state = STATE_ERROR
+            if e.errno in writer.DISK_FULL_ERRNOS:
+                self.error = proto.ERROR_DISK_FULL
             else:
-                print('Undefined error occured: {}!'
-                      .format(errno.errorcode[e.errno]))
-                return proto.TFTPHelper.createERROR(proto.ERROR_UNDEF)
-
-        if self.done:
-            self.file.close()
+                l.error('Undefined error while writing %s: %s!',
+                        self.filename, errno.errorcode.get(e.errno, e))
+                self.error = proto.ERROR_UNDEF
+            return self.__next_error()
 
+        self.done = last
         packetnum = self.packetnum
 
         # Compute next packet number
@@ -270,10 +669,14 @@ class TFTPState(object):
             self.packetnum = proto.TFTP_PACKETNUM_RESET
 
         # Only return a ACK if the window size has been reached, or when done
-        next_window = self.last_acked + self.opts[proto.TFTP_OPTION_WINDOWSIZE]
-        if self.done or packetnum >= next_window:
+        received = (packetnum - self.last_acked) % proto.TFTP_PACKETNUM_MAX
+        if self.done or received >= self.opts[proto.TFTP_OPTION_WINDOWSIZE]:
             self.last_acked = packetnum
-            return proto.TFTPHelper.createACK(packetnum)
+            return self.__flight(proto.TFTPHelper.createACK(packetnum))
 
     def __next_error(self):
+        # Errors are not acknowledged, and thus never retransmitted: the
+        # transfer is over.
+        self.unacked = []
+        self.close()
         return proto.TFTPHelper.createERROR(self.error)
\ No newline at end of file
@@ -0,0 +1,152 @@
+import os
+import tempfile
+from unittest import TestCase
+from tftp import proto
+from tftp import state
+from tftp.cache import ImageCache
+
+
+class TestImageCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = self.dir.name
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name, data, mtime=None):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_hit_shares_buffer(self):
+        path = self.write('zImage', b'x' * 100)
+        cache = ImageCache(1000)
+        first = cache.get(path)
+        second = cache.get(path)
+        self.assertIs(first, second)
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(100, cache.size)
+
+    def test_modified_file_is_reloaded(self):
+        path = self.write('zImage', b'a' * 10, mtime=1000)
+        cache = ImageCache(1000)
+        cache.get(path)
+        self.write('zImage', b'b' * 20, mtime=2000)
+        image = cache.get(path)
+        self.assertEqual(b'b' * 20, bytes(image.buffer))
+        self.assertEqual(1, len(cache))
+        self.assertEqual(20, cache.size)
+
+    def test_lru_eviction(self):
+        a = self.write('a', b'a' * 40)
+        b = self.write('b', b'b' * 40)
+        c = self.write('c', b'c' * 40)
+        cache = ImageCache(100)
+        cache.get(a)
+        cache.get(b)
+        cache.get(a)
+        cache.get(c)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(80, cache.size)
+        cache.get(a)
+        self.assertEqual(2, cache.hits)
+
+    def test_too_large_is_not_cached(self):
+        path = self.write('big', b'x' * 200)
+        cache = ImageCache(100)
+        self.assertIsNone(cache.get(path))
+        self.assertEqual(0, len(cache))
+
+    def test_state_serves_from_image(self):
+        path = self.write('u-boot-restore.img', b'0123456789' * 60)
+        cache = ImageCache(1000)
+        peer_state = state.TFTPState(('127.0.0.1', 1234), proto.OP_RRQ,
+                                     self.root, 'u-boot-restore.img',
+                                     'octet')
+        peer_state.image = cache.get(path)
+        peer_state.filesize = peer_state.image.size
+        peer_state.packetnum = 0
+        peer_state.state = state.STATE_SEND
+
+        packet = peer_state.next()
+        self.assertEqual(b'\x00\x03\x00\x01' + (b'0123456789' * 60)[:512],
+                         b''.join(packet))
+        packet = peer_state.next()
+        self.assertEqual(b'\x00\x03\x00\x02' + (b'0123456789' * 60)[512:],
+                         b''.join(packet))
+        self.assertEqual(state.STATE_SEND_LAST, peer_state.state)
+
+    def test_packet_table(self):
+        path = self.write('u-boot-spl-restore.bin', b'x' * 1024)
+        cache = ImageCache(10000)
+        image = cache.get(path)
+        table = cache.get_packet_table(image, 512, 'octet')
+        self.assertEqual(3, len(table.packets))
+        self.assertEqual(b'\x00\x03\x00\x03', table.packets[2])
+        self.assertIs(table, cache.get_packet_table(image, 512, 'octet'))
+        self.assertEqual(image.size + table.size, cache.size)
+
+    def test_packet_table_dropped_with_image(self):
+        path = self.write('uEnv.txt', b'a\nb\n', mtime=1000)
+        cache = ImageCache(10000)
+        image = cache.get(path)
+        table = cache.get_packet_table(image, 512, 'netascii')
+        self.assertEqual(b'\x00\x03\x00\x01a\r\nb\r\n', table.packets[0])
+        self.write('uEnv.txt', b'c\n', mtime=2000)
+        image = cache.get(path)
+        self.assertEqual(1, len(cache))
+        self.assertEqual(image.size, cache.size)
+
+    def test_state_serves_from_table(self):
+        path = self.write('zImage', b'z' * 1500)
+        cache = ImageCache(10000)
+        peer_state = state.TFTPState(('127.0.0.1', 1234), proto.OP_RRQ,
+                                     self.root, 'zImage', 'octet')
+        peer_state.image = cache.get(path)
+        peer_state.packets = cache.get_packet_table(peer_state.image, 512,
+                                                    'octet').packets
+        peer_state.packetnum = 0
+        peer_state.state = state.STATE_SEND
+        peer_state.set_opts({proto.TFTP_OPTION_BLKSIZE: 512,
+                             proto.TFTP_OPTION_WINDOWSIZE: 4})
+
+        packets = []
+        response = peer_state.next()
+        while type(response) == tuple:
+            packets.append(response[0])
+            response = response[1]()
+        packets.append(response)
+        self.assertEqual(peer_state.packets, packets)
+        self.assertEqual(state.STATE_SEND_LAST, peer_state.state)
+
+    def test_netascii_image(self):
+        path = self.write('uEnv.txt', b'a\r\nb\n' * 200, mtime=1000)
+        cache = ImageCache(10000)
+        image = cache.get(path)
+        converted = cache.get_netascii(image)
+        self.assertEqual(b'a\r\nb\r\n' * 200, bytes(converted.buffer))
+        self.assertIs(converted, cache.get_netascii(image))
+        self.assertIs(converted, cache.get_netascii(converted))
+
+        # Served as is, and in the same blocks as converted on the fly.
+        blocks = {}
+        for source in (image, converted):
+            peer_state = state.TFTPState(('127.0.0.1', 1234), proto.OP_RRQ,
+                                         self.root, 'uEnv.txt', 'netascii')
+            peer_state.image = source
+            peer_state.packetnum = 0
+            peer_state.state = state.STATE_SEND
+            blocks[source.mode] = []
+            while peer_state.state == state.STATE_SEND:
+                blocks[source.mode].append(b''.join(peer_state.next()))
+                peer_state.last_acked = peer_state.packetnum
+        self.assertEqual(blocks['octet'], blocks['netascii'])
+        self.assertEqual(3, len(blocks['octet']))
+
+        self.write('uEnv.txt', b'c\n', mtime=2000)
+        cache.get(path)
+        self.assertEqual(1, len(cache))
@@ -0,0 +1,125 @@
+import threading
+from unittest import TestCase
+from tftp import events
+from tftp import notify
+from tftp import proto
+from tftp import state
+
+
+def make_state(port=1, op=proto.OP_RRQ):
+    peer_state = state.TFTPState(('127.0.0.1', port), op, '/tftpboot',
+                                 'u-boot.img', 'octet')
+    peer_state.tid = 40000 + port
+    return peer_state
+
+
+class TestEventBus(TestCase):
+    def setUp(self):
+        self.bus = events.EventBus(maxsize=4)
+
+    def test_subscribers(self):
+        received, failures = [], []
+        self.bus.subscribe(received.append)
+        self.bus.subscribe(failures.append, kinds=[events.FAILED])
+
+        peer_state = make_state()
+        peer_state.filesize = 1000
+        self.bus.publish(events.STARTED, peer_state)
+        peer_state.error = proto.ERROR_UNKNOWN_ID
+        self.bus.publish(events.FAILED, peer_state)
+        self.bus.flush()
+
+        self.assertEqual([events.STARTED, events.FAILED],
+                         [event.kind for event in received])
+        self.assertEqual(1, len(failures))
+        event = failures[0]
+        self.assertEqual((('127.0.0.1', 1), 40001, 'u-boot.img', 0, 1000,
+                          proto.ERROR_UNKNOWN_ID),
+                         (event.peer, event.tid, event.file,
+                          event.transferred, event.total, event.error))
+
+    def test_no_subscribers(self):
+        self.bus.publish(events.STARTED, make_state())
+        self.assertEqual(0, self.bus.queue.qsize())
+
+    def test_slow_subscriber(self):
+        release = threading.Event()
+        received = []
+
+        def subscriber(event):
+            release.wait()
+            received.append(event)
+
+        self.bus.subscribe(subscriber)
+        for port in range(10):
+            self.bus.publish(events.STARTED, make_state(port))
+        self.assertGreaterEqual(self.bus.dropped, 5)
+        release.set()
+        self.bus.flush()
+        self.assertEqual(10, len(received) + self.bus.dropped)
+
+    def test_failing_subscriber(self):
+        received = []
+        self.bus.subscribe(lambda event: 1 / 0)
+        self.bus.subscribe(received.append)
+        self.bus.publish(events.COMPLETED, make_state())
+        self.bus.flush()
+        self.assertEqual(1, len(received))
+
+    def test_progress(self):
+        received = []
+        self.bus.subscribe(received.append)
+        peer_state = make_state()
+        start = peer_state.started
+        self.bus.progress(peer_state, start + 0.5)
+        self.bus.progress(peer_state, start + 1.5)
+        self.bus.progress(peer_state, start + 2)
+        self.bus.progress(peer_state, start + 3)
+        self.bus.flush()
+        self.assertEqual(2, len(received))
+
+
+class TestNotifyAdapter(TestCase):
+    def test_callbacks(self):
+        calls = []
+        engine = notify.CallbackEngine({
+            notify.TRANSFER_COMPLETED: lambda **kwargs: calls.append(kwargs),
+        })
+        bus = events.EventBus()
+        bus.subscribe(events.NotifyAdapter(engine))
+        bus.publish(events.STARTED, make_state())
+        bus.publish(events.COMPLETED, make_state(2, proto.OP_WRQ))
+        bus.flush()
+        self.assertEqual([{'host': '127.0.0.1', 'port': 2,
+                           'file': 'u-boot.img',
+                           'state': notify.TRANSFER_COMPLETED}], calls)
+
+
+class TestTransferMetrics(TestCase):
+    def setUp(self):
+        self.files = set(events._FILES)
+        self.max_files = events.EVENT_MAX_FILES
+        events._FILES.clear()
+        events.EVENT_MAX_FILES = 2
+
+    def tearDown(self):
+        events._FILES.clear()
+        events._FILES.update(self.files)
+        events.EVENT_MAX_FILES = self.max_files
+
+    def count(self, label):
+        return dict(events._TRANSFER_SECONDS.samples()).get(
+                (label,), ([], 0, 0))[2]
+
+    def test_file_labels(self):
+        others = self.count(events.EVENT_OTHER_FILE)
+        for filename in ('MLO', 'u-boot.img', 'zImage', 'MLO'):
+            peer_state = make_state()
+            peer_state.filename = filename
+            events.publish(events.COMPLETED, peer_state)
+        events.publish(events.COMPLETED, make_state(2, proto.OP_WRQ))
+
+        # Uploads and the files beyond the first ones served are measured
+        # together.
+        self.assertEqual({'MLO', 'u-boot.img'}, events._FILES)
+        self.assertEqual(others + 2, self.count(events.EVENT_OTHER_FILE))
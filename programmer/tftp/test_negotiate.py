@@ -0,0 +1,203 @@
+import ipaddress
+import os
+import tempfile
+from unittest import TestCase
+from tftp import negotiate
+from tftp import proto
+from tftp import state
+
+
+class TestNegotiationPolicy(TestCase):
+    def setUp(self):
+        self.policy = negotiate.NegotiationPolicy()
+
+    def new_state(self, filename, ip='192.168.4.2'):
+        return state.TFTPState((ip, 1234), proto.OP_RRQ, '/tmp', filename,
+                               'octet')
+
+    def test_profile_from_vendor_class(self):
+        self.policy.register('192.168.4.2', 'AM335x U-Boot SPL')
+        self.assertIs(negotiate.PROFILE_AM335X_SPL,
+                      self.policy.profile('192.168.4.2', 'zImage'))
+        self.policy.register('192.168.4.2', 'udhcp 1.23.1')
+        self.assertIs(negotiate.PROFILE_UDHCP,
+                      self.policy.profile('192.168.4.2', 'zImage'))
+
+    def test_profile_from_filename(self):
+        self.assertIs(negotiate.PROFILE_AM335X_ROM,
+                      self.policy.profile('192.168.4.3',
+                                          'u-boot-spl-restore.bin'))
+        self.assertIs(negotiate.PROFILE_UBOOT,
+                      self.policy.profile('192.168.4.3', 'boot/zImage'))
+        self.assertIs(negotiate.PROFILE_DEFAULT,
+                      self.policy.profile('192.168.4.3', 'rootfs.tar'))
+
+    def test_clamps_to_profile(self):
+        self.policy.register('192.168.4.2', 'AM335x U-Boot SPL')
+        peer_state = self.new_state('u-boot-restore.img')
+        opts = self.policy.negotiate(peer_state, {'blksize': '16384',
+                                                  'windowsize': '16',
+                                                  'timeout': '3'})
+        self.assertEqual(1468, opts[proto.TFTP_OPTION_BLKSIZE])
+        self.assertEqual(4, opts[proto.TFTP_OPTION_WINDOWSIZE])
+        self.assertEqual(3, opts[proto.TFTP_OPTION_TIMEOUT])
+
+    def test_timeout_from_profile(self):
+        peer_state = self.new_state('MLO')
+        self.assertEqual({}, self.policy.negotiate(peer_state, {}))
+        self.assertEqual(negotiate.PROFILE_AM335X_ROM.timeout,
+                         peer_state.rto())
+
+    def test_acknowledges_requested_options(self):
+        peer_state = self.new_state('rootfs.tar')
+        opts = self.policy.negotiate(peer_state, {'blksize': '1400'})
+        self.assertEqual({proto.TFTP_OPTION_BLKSIZE: 1400}, opts)
+
+        peer_state.set_opts(opts)
+        peer_state.state = state.STATE_SEND_OACK
+        self.assertEqual(b'\x00\x06blksize\x001400\x00',
+                         peer_state.next())
+        self.assertEqual(proto.TFTP_DEFAULT_WINDOW_SIZE,
+                         peer_state.opts[proto.TFTP_OPTION_WINDOWSIZE])
+
+    def test_invalid_options(self):
+        peer_state = self.new_state('zImage')
+        self.assertIsNone(self.policy.negotiate(peer_state,
+                                                {'blksize': 'large'}))
+        self.assertIsNone(self.policy.negotiate(peer_state,
+                                                {'windowsize': '0'}))
+
+    def test_window_fits_send_buffer(self):
+        peer_state = self.new_state('rootfs.tar')
+        opts = self.policy.negotiate(peer_state, {'blksize': '65464',
+                                                  'windowsize': '65535'})
+        datagram = proto.TFTPHelper.get_data_size(
+                opts[proto.TFTP_OPTION_BLKSIZE])
+        self.assertLessEqual(datagram, negotiate.UDP_MAX_PAYLOAD)
+        self.assertLessEqual(
+                opts[proto.TFTP_OPTION_WINDOWSIZE],
+                max(1, negotiate.get_send_buffer_size() // datagram))
+
+
+class TestBlksize(TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'blksizes.json')
+        self.peer_state = state.TFTPState(('192.168.4.2', 1234),
+                                          proto.OP_RRQ, '/tmp', 'rootfs.tar',
+                                          'octet')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rmdir(os.path.dirname(self.path))
+
+    def negotiate(self, policy, mtu):
+        original = negotiate.get_interface_mtu
+        negotiate.get_interface_mtu = lambda interface: mtu
+        try:
+            opts = policy.negotiate(self.peer_state, {'blksize': '8192'},
+                                    'usb0')
+        finally:
+            negotiate.get_interface_mtu = original
+        return opts[proto.TFTP_OPTION_BLKSIZE]
+
+    def test_fits_mtu(self):
+        policy = negotiate.NegotiationPolicy()
+        self.assertEqual(1468, self.negotiate(policy, 1500))
+        self.assertEqual(8192, self.negotiate(policy, None))
+
+    def test_explore_and_record(self):
+        table = negotiate.BlksizeTable(self.path, explore=True,
+                                       candidates=(512, 1024))
+        policy = negotiate.NegotiationPolicy(blksizes=table)
+        goodput = {512: 1.0, 1024: 4.0, 1468: 2.0}
+        for _ in range(3):
+            blksize = self.negotiate(policy, 1500)
+            self.assertEqual(blksize, self.peer_state.explored)
+            table.record('usb0', blksize, 4096, 4096 / goodput[blksize])
+        self.assertEqual(1024, table.best('usb0'))
+
+        # The best block size is used once loaded back.
+        table = negotiate.BlksizeTable(self.path)
+        self.assertEqual(1024, table.best('usb0'))
+        policy = negotiate.NegotiationPolicy(blksizes=table)
+        self.assertEqual(1024, self.negotiate(policy, 1500))
+
+    def test_abandoned_exploration(self):
+        table = negotiate.BlksizeTable(self.path, explore=True,
+                                       candidates=(512, 1024))
+        policy = negotiate.NegotiationPolicy(blksizes=table)
+        self.negotiate(policy, 1500)
+
+        # The transfer is abandoned, and the client retries from the same
+        # port without options: its goodput is not recorded under the block
+        # size explored by the first transfer.
+        self.peer_state = state.TFTPState(self.peer_state.peer, proto.OP_RRQ,
+                                          '/tmp', 'rootfs.tar', 'octet')
+        self.assertEqual({}, policy.negotiate(self.peer_state, {}, 'usb0'))
+        self.peer_state.filesize = 4096
+        policy.completed(self.peer_state)
+        self.assertEqual({}, table.results)
+        self.assertFalse(os.path.exists(self.path))
+
+
+class TestLeaseFile(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'leases.json')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_shared(self):
+        dhcp = negotiate.LeaseFile(self.path)
+        leases = negotiate.LeaseFile(self.path)
+        self.assertIsNone(leases.vendor_class('192.168.4.2'))
+
+        dhcp.register('192.168.4.2', 'AM335x ROM')
+        self.assertEqual('AM335x ROM', leases.vendor_class('192.168.4.2'))
+        dhcp.register('192.168.4.2', 'AM335x U-Boot SPL')
+        dhcp.register('192.168.4.3', 'udhcp 1.23.1')
+        self.assertEqual('AM335x U-Boot SPL',
+                         leases.vendor_class('192.168.4.2'))
+
+        policy = negotiate.NegotiationPolicy(leases=leases)
+        self.assertIs(negotiate.PROFILE_UDHCP,
+                      policy.profile('192.168.4.3', 'zImage'))
+
+    def test_unreadable(self):
+        with open(self.path, 'w') as f:
+            f.write('[')
+        leases = negotiate.LeaseFile(self.path)
+        self.assertIsNone(leases.vendor_class('192.168.4.2'))
+
+
+class TestPeerInterfaces(TestCase):
+    def setUp(self):
+        self.lookups = 0
+        self.addresses = [(ipaddress.IPv4Interface('192.168.4.1/24'),
+                           'usb0')]
+        self.interfaces = negotiate.PeerInterfaces(self.lookup, ttl=60,
+                                                   miss_ttl=0)
+
+    def lookup(self):
+        self.lookups += 1
+        return self.addresses
+
+    def test_cached(self):
+        self.assertEqual('usb0', self.interfaces.get('192.168.4.2'))
+        self.assertEqual('usb0', self.interfaces.get('192.168.4.3'))
+        self.assertEqual(1, self.lookups)
+
+    def test_new_interface(self):
+        self.assertEqual('usb0', self.interfaces.get('192.168.4.2'))
+        self.addresses = self.addresses + [
+            (ipaddress.IPv4Interface('192.168.5.1/24'), 'usb1')]
+        self.assertEqual('usb1', self.interfaces.get('192.168.5.2'))
+        self.assertEqual(2, self.lookups)
+
+    def test_expired(self):
+        self.interfaces.ttl = 0
+        self.interfaces.get('192.168.4.2')
+        self.addresses = []
+        self.assertIsNone(self.interfaces.get('192.168.4.2'))
@@ -0,0 +1,47 @@
+from unittest import TestCase
+from tftp import netascii
+from tftp import proto
+
+
+TEXT = b'setenv bootargs console=ttyO0\r\nboot\nrun\r\r\n\n\r'
+
+
+class TestNetascii(TestCase):
+    def test_matches_regex(self):
+        self.assertEqual(proto.OCTET_TO_NETASCII.sub(b'\r\n', TEXT),
+                         netascii.encode(TEXT))
+        self.assertEqual(proto.NETASCII_TO_OCTET.sub(b'\n', TEXT),
+                         netascii.decode(TEXT))
+
+    def test_split_crlf(self):
+        for split in range(len(TEXT) + 1):
+            encoder = netascii.Encoder()
+            encoded = encoder.encode(TEXT[:split]) + \
+                encoder.encode(TEXT[split:], final=True)
+            self.assertEqual(netascii.encode(TEXT), encoded, split)
+
+            decoder = netascii.Decoder()
+            decoded = decoder.decode(TEXT[:split]) + \
+                decoder.decode(TEXT[split:], final=True)
+            self.assertEqual(netascii.decode(TEXT), decoded, split)
+
+    def test_reader(self):
+        for size in range(1, 8):
+            data = memoryview(TEXT * 3)
+            offset = 0
+
+            def read(n):
+                nonlocal offset
+                chunk = data[offset:offset + n]
+                offset += len(chunk)
+                return chunk
+
+            reader = netascii.EncodingReader(read)
+            blocks = []
+            while True:
+                block = reader.read(size)
+                blocks.append(block)
+                if len(block) < size:
+                    break
+            self.assertTrue(all(len(b) == size for b in blocks[:-1]))
+            self.assertEqual(netascii.encode(TEXT * 3), b''.join(blocks))
@@ -0,0 +1,55 @@
+from unittest import TestCase
+from benchmarks.bench_proto import Reference
+from tftp import proto
+from tftp.proto import TFTPHelper
+
+OPTS = {proto.TFTP_OPTION_BLKSIZE: 1468, proto.TFTP_OPTION_TSIZE: 12345}
+
+
+class TestCodecs(TestCase):
+    def test_same_packets_as_reference(self):
+        for num in (0, 1, 255, 256, 65535):
+            self.assertEqual(Reference.createACK(num),
+                             TFTPHelper.createACK(num))
+            self.assertEqual(Reference.createDATA(num, b'data'),
+                             TFTPHelper.createDATA(num, b'data'))
+        for errno in proto.TFTP_ERRORS:
+            self.assertEqual(Reference.createERROR(errno),
+                             TFTPHelper.createERROR(errno))
+        self.assertEqual(Reference.createERROR(proto.ERROR_UNDEF, 'Oops.'),
+                         TFTPHelper.createERROR(proto.ERROR_UNDEF, 'Oops.'))
+        self.assertEqual(Reference.createRRQ('MLO', 'octet', OPTS),
+                         TFTPHelper.createRRQ('MLO', 'octet', OPTS))
+        self.assertEqual(Reference.createOACK(OPTS),
+                         TFTPHelper.createOACK(OPTS))
+
+    def test_memoized_packets(self):
+        self.assertIs(TFTPHelper.createACK(7), TFTPHelper.createACK(7))
+        self.assertIs(TFTPHelper.createOACK(OPTS),
+                      TFTPHelper.createOACK(dict(OPTS)))
+        self.assertNotEqual(TFTPHelper.createOACK(OPTS),
+                            TFTPHelper.createOACK({'blksize': 512}))
+
+    def test_parse(self):
+        request = b'MLO\0OCTET\0BlkSize\x001468\0foo\0bar\0'
+        for packet in (request, memoryview(request)):
+            self.assertEqual(Reference.parseRRQ(bytes(packet)),
+                             TFTPHelper.parseRRQ(packet))
+            self.assertEqual(Reference.parseOACK(bytes(packet)),
+                             TFTPHelper.parseOACK(packet))
+        self.assertEqual((5, 'Unknown transfer ID.'),
+                         TFTPHelper.parseERROR(memoryview(
+                                 TFTPHelper.createERROR(5))[2:]))
+        num, data = TFTPHelper.parseDATA(memoryview(b'\x01\x02abc'))
+        self.assertEqual((258, b'abc'), (num, bytes(data)))
+
+    def test_malformed(self):
+        for packet in (b'', b'MLO', b'MLO\0', b'\0octet\0',
+                       b'MLO\0mail\0'):
+            with self.assertRaises(SyntaxError):
+                TFTPHelper.parseRRQ(packet)
+        with self.assertRaises(SyntaxError):
+            TFTPHelper.parseACK(b'\x00')
+        with self.assertRaises(SyntaxError):
+            TFTPHelper.parseDATA(b'\x00')
+
@@ -0,0 +1,231 @@
+import asyncio
+import os
+import socket
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from tftp import proto
+from tftp import trace
+
+try:
+    from tftp import AsyncServer
+    from tftp import Server
+except ImportError:
+    # The servers look up their network interfaces with netifaces.
+    AsyncServer = Server = None
+
+
+class ServerTestCase(object):
+    """Tests of a TFTP server engine, serving on the loopback interface."""
+
+    def setUp(self):
+        if Server is None:
+            self.skipTest('netifaces is not installed')
+        self.dir = tempfile.TemporaryDirectory()
+        self.content = os.urandom(5000)
+        with open(os.path.join(self.dir.name, 'zImage'), 'wb') as f:
+            f.write(self.content)
+        self.start()
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(('127.0.0.1', 0))
+        self.client.settimeout(2)
+
+    def tearDown(self):
+        self.client.close()
+        self.stop()
+        self.dir.cleanup()
+
+    def request(self, packet):
+        self.client.sendto(packet, ('127.0.0.1', self.port))
+
+    def receive(self):
+        return self.client.recvfrom(65536)
+
+    def download(self, first=None):
+        """Download zImage to the end, acking every DATA packet, and return
+        its content and the address of the transfer."""
+        data = b''
+        packet, address = first or self.receive()
+        while True:
+            num, block = proto.TFTPHelper.parseDATA(packet[2:])
+            data += block
+            self.client.sendto(proto.TFTPHelper.createACK(num), address)
+            if len(block) < proto.TFTP_DEFAULT_PACKET_SIZE:
+                return data, address
+            packet, address = self.receive()
+
+    def wait_idle(self):
+        """Wait for the server to be done with the last ACK of a download,
+        which it does not answer."""
+        deadline = time.monotonic() + 2
+        while len(self.clients) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_rrq(self):
+        self.request(proto.TFTPHelper.createRRQ('zImage', 'octet', {}))
+        data, address = self.download()
+        self.assertEqual(self.content, data)
+        self.wait_idle()
+        self.assertEqual(0, len(self.clients))
+
+    def test_transfer_id(self):
+        self.request(proto.TFTPHelper.createRRQ('zImage', 'octet', {}))
+        first, address = self.receive()
+
+        # The transfer goes on from its own port, every packet of it.
+        self.assertEqual('127.0.0.1', address[0])
+        self.assertNotEqual(self.port, address[1])
+        self.assertEqual(address[1], self.clients[
+                self.client.getsockname()].tid)
+        addresses = set()
+        packet = (first, address)
+        while True:
+            num, block = proto.TFTPHelper.parseDATA(packet[0][2:])
+            addresses.add(packet[1])
+            self.client.sendto(proto.TFTPHelper.createACK(num), address)
+            if len(block) < proto.TFTP_DEFAULT_PACKET_SIZE:
+                break
+            packet = self.receive()
+        self.assertEqual({address}, addresses)
+
+    def test_unknown_transfer_id(self):
+        self.request(proto.TFTPHelper.createRRQ('zImage', 'octet', {}))
+        first, address = self.receive()
+
+        stranger = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        stranger.bind(('127.0.0.1', 0))
+        stranger.settimeout(0.5)
+        try:
+            # Transfer packets sent to the server port are answered with an
+            # ERROR...
+            stranger.sendto(proto.TFTPHelper.createACK(1),
+                            ('127.0.0.1', self.port))
+            packet, _ = stranger.recvfrom(65536)
+            self.assertEqual(
+                    proto.TFTPHelper.createERROR(proto.ERROR_UNKNOWN_ID),
+                    packet)
+
+            # ...and the transfer port only takes its peer's packets.
+            stranger.sendto(proto.TFTPHelper.createERROR(proto.ERROR_UNDEF),
+                            address)
+            self.assertRaises(socket.timeout, stranger.recvfrom, 65536)
+        finally:
+            stranger.close()
+
+        data, _ = self.download((first, address))
+        self.assertEqual(self.content, data)
+
+    def test_duplicate_rrq(self):
+        rrq = proto.TFTPHelper.createRRQ('zImage', 'octet', {})
+        self.request(rrq)
+        first, address = self.receive()
+        self.request(rrq)
+        again, again_address = self.receive()
+        self.assertEqual(first, again)
+        self.assertEqual(address, again_address)
+
+        # The duplicate is answered by the transfer in progress, which goes
+        # on as if its first packet had been lost.
+        peer_state = self.clients[self.client.getsockname()]
+        self.assertEqual(1, len(self.transfers))
+        self.assertEqual(1, peer_state.retransmits)
+        self.assertEqual(0, peer_state.retries)
+        data, _ = self.download((first, address))
+        self.assertEqual(self.content, data)
+
+    def test_wrq(self):
+        content = os.urandom(2000)
+        self.request(proto.TFTPHelper.createWRQ('backup.img', 'octet', {}))
+        packet, address = self.receive()
+        self.assertEqual(proto.TFTPHelper.createACK(0), packet)
+        for num, offset in enumerate(range(0, len(content) + 1, 512), 1):
+            self.client.sendto(proto.TFTPHelper.createDATA(
+                    num, content[offset:offset + 512]), address)
+            packet, _ = self.receive()
+            self.assertEqual(proto.TFTPHelper.createACK(num), packet)
+
+        # The file is published before the last block is acked.
+        with open(os.path.join(self.dir.name, 'backup.img'), 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual(0, len(self.clients))
+
+    def test_trace(self):
+        rrq = proto.TFTPHelper.createRRQ('zImage', 'octet', {})
+        self.request(rrq)
+        self.download()
+
+        # Packets are traced by the interface they went through, with its
+        # address.
+        ring = trace.get_trace_ring('lo')
+        self.assertEqual(socket.inet_aton('127.0.0.1'), ring.address)
+        records = [record for record in ring.records()
+                   if record[2] == self.client.getsockname()]
+        self.assertEqual((trace.TRACE_IN, rrq), (records[0][1], records[0][5]))
+        self.assertEqual(proto.OP_DATA,
+                         proto.TFTPHelper.get_opcode(records[1][5]))
+
+
+class TestServer(ServerTestCase, TestCase):
+    def start(self):
+        self.server = Server.Server('127.0.0.1', self.dir.name, 0,
+                                    image_cache_size=0)
+        self.thread = threading.Thread(target=self.server.server.serve_forever)
+        self.thread.start()
+        self.port = self.server.server.server_address[1]
+        self.clients = self.server.client_registry
+        self.transfers = self.server.server.transfers
+
+    def stop(self):
+        self.server.server.shutdown()
+        self.thread.join()
+        self.server.server.server_close()
+
+    def test_expired_transfer(self):
+        self.request(proto.TFTPHelper.createRRQ('zImage', 'octet', {}))
+        self.receive()
+        peer_state = self.clients[self.client.getsockname()]
+        thread = self.transfers[peer_state]
+
+        # The reaper waits for the transfer to be done with its state.
+        with thread.lock:
+            reaper = threading.Thread(target=self.clients.reap,
+                                      args=(time.monotonic() + 100,))
+            reaper.start()
+            reaper.join(0.1)
+            self.assertTrue(reaper.is_alive())
+            self.assertIsNotNone(peer_state.file)
+        reaper.join()
+        self.assertIsNone(peer_state.file)
+
+        thread.join()
+        self.assertEqual({}, self.transfers)
+
+
+class TestAsyncServer(ServerTestCase, TestCase):
+    def start(self):
+        self.server = AsyncServer.AsyncServer('127.0.0.1', self.dir.name, 0,
+                                              image_cache_size=0)
+        self.loop = asyncio.new_event_loop()
+        self.loop.create_task(self.server.serve())
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+        started = threading.Event()
+        self.loop.call_soon_threadsafe(started.set)
+        started.wait()
+        while self.server.transport is None:
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0.01),
+                                             self.loop).result()
+        self.port = self.server.transport.get_extra_info('sockname')[1]
+        self.clients = self.server.clients
+        self.transfers = self.server.transfers
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
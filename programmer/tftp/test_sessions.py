@@ -0,0 +1,58 @@
+import threading
+from unittest import TestCase
+from tftp import proto
+from tftp import state
+from tftp.sessions import SessionReaper, SessionTable
+
+
+class TestSessionTable(TestCase):
+    def setUp(self):
+        self.expired = []
+        self.table = SessionTable(timeout=10, expired=lambda peer, peer_state:
+                                  self.expired.append(peer))
+
+    def add(self, port, last_seen):
+        peer = ('127.0.0.1', port)
+        peer_state = state.TFTPState(peer, proto.OP_RRQ, '/tmp', 'MLO',
+                                     'octet')
+        peer_state.last_seen = last_seen
+        self.table[peer] = peer_state
+        return peer_state
+
+    def test_expires_in_order(self):
+        self.add(1, 100)
+        self.add(2, 102)
+        self.add(3, 101)
+        self.assertEqual(0, self.table.reap(109))
+        self.assertEqual(2, self.table.reap(111.5))
+        self.assertEqual([('127.0.0.1', 1), ('127.0.0.1', 3)], self.expired)
+        self.assertEqual(1, len(self.table))
+        self.assertEqual(112, self.table.next_expiry())
+
+    def test_seen_again(self):
+        peer_state = self.add(1, 100)
+        peer_state.last_seen = 105
+        self.assertEqual(0, self.table.reap(110))
+        self.assertEqual(115, self.table.next_expiry())
+        self.assertEqual(1, self.table.reap(115))
+
+    def test_removed_or_replaced(self):
+        self.add(1, 100)
+        self.add(2, 100)
+        self.assertIsNotNone(self.table.pop(('127.0.0.1', 1)))
+        self.assertIsNone(self.table.pop(('127.0.0.1', 1)))
+        replacement = self.add(2, 105)
+        self.assertEqual(0, self.table.reap(110))
+        self.assertIs(replacement, self.table.get(('127.0.0.1', 2)))
+        self.assertEqual([], self.expired)
+
+    def test_reaper(self):
+        table = SessionTable(timeout=0.05)
+        done = threading.Event()
+        table.expired = lambda peer, peer_state: done.set()
+        SessionReaper(table).start()
+        peer = ('127.0.0.1', 1)
+        table[peer] = state.TFTPState(peer, proto.OP_RRQ, '/tmp', 'MLO',
+                                      'octet')
+        self.assertTrue(done.wait(5))
+        self.assertNotIn(peer, table)
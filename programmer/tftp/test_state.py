@@ -0,0 +1,369 @@
+import os
+import socket
+import tempfile
+from unittest import TestCase
+from tftp import cache
+from tftp import netascii
+from tftp import proto
+from tftp import state
+from tftp.writer import Writer
+
+
+def send_window(peer_state):
+    """Return the DATA packets of the next window, as bytes."""
+    packets = []
+    response = peer_state.next()
+    while response:
+        if type(response) == tuple:
+            packet, response = response[:2]
+            response = response()
+        else:
+            packet, response = response, None
+        packets.append(b''.join(packet) if type(packet) == list else packet)
+    return packets
+
+
+class TestWindowRecovery(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.data = bytes(range(256)) * 21
+        with open(os.path.join(self.root, 'MLO'), 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        os.remove(os.path.join(self.root, 'MLO'))
+        os.rmdir(self.root)
+
+    def new_state(self, source, windowsize=4):
+        peer_state = state.TFTPState(('127.0.0.1', 1234), proto.OP_RRQ,
+                                     self.root, 'MLO', 'octet')
+        peer_state.set_opts({proto.TFTP_OPTION_BLKSIZE: 512,
+                             proto.TFTP_OPTION_WINDOWSIZE: windowsize})
+        if source == 'file':
+            peer_state.file = open(peer_state.filepath, 'rb')
+        else:
+            peer_state.image = cache.ImageCache().get(peer_state.filepath)
+            if source == 'table':
+                peer_state.packets = cache.PacketTable.build(
+                        peer_state.image, 512, 'octet').packets
+        peer_state.packetnum = 0
+        peer_state.state = state.STATE_SEND
+        return peer_state
+
+    def expected(self, num):
+        offset = (num - 1) * 512
+        return proto.TFTPHelper.createDATA(num,
+                                           self.data[offset:offset + 512])
+
+    def test_partial_ack_rewinds(self):
+        for source in ('file', 'image', 'table'):
+            peer_state = self.new_state(source)
+            self.assertEqual([self.expected(n) for n in range(1, 5)],
+                             send_window(peer_state))
+
+            # Packets 3 and 4 were lost.
+            self.assertEqual(state.ACK_PARTIAL, peer_state.ack(2))
+            self.assertEqual([self.expected(n) for n in range(3, 7)],
+                             send_window(peer_state), source)
+
+            self.assertEqual(state.ACK_WINDOW, peer_state.ack(6))
+            self.assertEqual(4, len(send_window(peer_state)))
+            self.assertEqual(state.ACK_WINDOW, peer_state.ack(10))
+            self.assertEqual([self.expected(11)], send_window(peer_state))
+            self.assertEqual(state.STATE_SEND_LAST, peer_state.state)
+
+            # The last packet was lost.
+            self.assertEqual(state.ACK_PARTIAL, peer_state.ack(10))
+            self.assertEqual(state.STATE_SEND, peer_state.state)
+            self.assertEqual([self.expected(11)], send_window(peer_state))
+            self.assertEqual(state.ACK_WINDOW, peer_state.ack(11))
+            if peer_state.file:
+                peer_state.file.close()
+
+    def test_netascii_rewind(self):
+        with open(os.path.join(self.root, 'MLO'), 'wb') as f:
+            f.write(b'x' * 511 + b'\r\n' + b'\n' * 600 + b'y\r' * 700)
+        expected = netascii.encode(b'x' * 511 + b'\r\n' + b'\n' * 600 +
+                                   b'y\r' * 700)
+        for source in ('file', 'image'):
+            peer_state = self.new_state(source)
+            peer_state.mode = 'netascii'
+            first = send_window(peer_state)
+            self.assertEqual(state.ACK_PARTIAL, peer_state.ack(1))
+            blocks = first[:1]
+            while True:
+                window = send_window(peer_state)
+                blocks.extend(window)
+                if peer_state.state == state.STATE_SEND_LAST:
+                    break
+                peer_state.ack(peer_state.packetnum)
+            self.assertEqual(expected, b''.join(b[4:] for b in blocks),
+                             source)
+            if peer_state.file:
+                peer_state.file.close()
+
+    def test_previous_window_acked_again(self):
+        peer_state = self.new_state('image')
+        send_window(peer_state)
+        self.assertEqual(state.ACK_WINDOW, peer_state.ack(4))
+        send_window(peer_state)
+        self.assertEqual(state.ACK_PARTIAL, peer_state.ack(4))
+        self.assertEqual(self.expected(5), send_window(peer_state)[0])
+
+    def test_duplicate_and_invalid(self):
+        peer_state = self.new_state('image', windowsize=1)
+        send_window(peer_state)
+        self.assertEqual(state.ACK_DUPLICATE, peer_state.ack(0))
+        self.assertEqual(state.ACK_INVALID, peer_state.ack(100))
+        self.assertEqual(state.ACK_WINDOW, peer_state.ack(1))
+
+    def test_wraparound(self):
+        peer_state = self.new_state('image')
+        peer_state.packetnum = peer_state.last_acked = \
+            proto.TFTP_PACKETNUM_MAX - 2
+        self.assertEqual(4, len(send_window(peer_state)))
+        self.assertEqual(2, peer_state.packetnum)
+        self.assertEqual(state.ACK_PARTIAL, peer_state.ack(0))
+        self.assertEqual(4, len(send_window(peer_state)))
+        self.assertEqual(state.ACK_WINDOW, peer_state.ack(4))
+
+
+class TestScatterGather(TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.receiver.settimeout(1)
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+        self.root.cleanup()
+
+    def transfer(self, data, source):
+        """Send a file the way the server does, and return the datagrams
+        received."""
+        path = os.path.join(self.root.name, 'MLO')
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        peer_state = state.TFTPState(('127.0.0.1', 1234), proto.OP_RRQ,
+                                     self.root.name, 'MLO', 'octet')
+        if source == 'file':
+            peer_state.file = open(path, 'rb')
+        else:
+            peer_state.image = cache.ImageCache().get(path)
+        peer_state.packetnum = 0
+        peer_state.state = state.STATE_SEND
+
+        datagrams = []
+        while peer_state.state == state.STATE_SEND:
+            packet = peer_state.next()
+            self.assertIs(list, type(packet))
+            self.sender.sendmsg(packet, [], 0,
+                                self.receiver.getsockname())
+            datagrams.append(self.receiver.recv(65536))
+            peer_state.ack(len(datagrams))
+        peer_state.close()
+        return datagrams
+
+    def expected(self, data, count):
+        return [proto.TFTPHelper.createDATA(num, data[(num - 1) * 512:
+                                                      num * 512])
+                for num in range(1, count + 1)]
+
+    def test_short_last_block(self):
+        data = os.urandom(5000)
+        for source in ('file', 'image'):
+            datagrams = self.transfer(data, source)
+            self.assertEqual(self.expected(data, 10), datagrams, source)
+            self.assertEqual(4 + 392, len(datagrams[-1]))
+
+    def test_empty_last_block(self):
+        data = os.urandom(1024)
+        for source in ('file', 'image'):
+            datagrams = self.transfer(data, source)
+            self.assertEqual(self.expected(data, 3), datagrams, source)
+            self.assertEqual(b'\x00\x03\x00\x03', datagrams[-1])
+
+
+class TestCongestionControl(TestCase):
+    def setUp(self):
+        self.state = state.TFTPState(('127.0.0.1', 1234), proto.OP_RRQ,
+                                     '/tmp', 'MLO', 'octet')
+        self.state.set_opts({proto.TFTP_OPTION_BLKSIZE: 512,
+                             proto.TFTP_OPTION_WINDOWSIZE: 8})
+        self.state.image = cache.CachedImage(('MLO', 0, 0), bytes(512 * 64))
+        self.state.packetnum = 0
+        self.state.state = state.STATE_SEND
+
+    def window(self):
+        """Send a window, returning the delays between its packets."""
+        delays = []
+        response = self.state.next()
+        while type(response) == tuple:
+            delays.append(response[2] if len(response) > 2 else 0)
+            response = response[1]()
+        return delays
+
+    def test_full_windows_by_default(self):
+        self.assertEqual(8, self.state.burst)
+        self.assertEqual([0] * 7, self.window())
+
+    def test_shrinks_on_loss_and_grows_back(self):
+        self.window()
+        self.assertEqual(state.ACK_PARTIAL, self.state.ack(5))
+        self.assertEqual(4, self.state.burst)
+
+        # Lost packets only halve the burst once per window.
+        self.assertEqual(state.ACK_DUPLICATE, self.state.ack(4))
+        self.assertEqual(4, self.state.burst)
+
+        gap = state.STATE_BURST_GAP_SECS
+        self.assertEqual([0, 0, 0, gap, 0, 0, 0], self.window())
+        self.assertEqual(state.ACK_WINDOW, self.state.ack(13))
+        self.assertEqual(5, self.state.burst)
+        self.assertEqual([(0, 8), (5, 4), (13, 5)], self.state.trajectory)
+
+    def test_seed_and_pacing(self):
+        self.state.seed(2)
+        self.state.pacing = 0.01
+        gap = 0.01 + state.STATE_BURST_GAP_SECS
+        self.assertEqual([0.01, gap, 0.01, gap, 0.01, gap, 0.01],
+                         self.window())
+        self.state.seed(100)
+        self.assertEqual(8, self.state.burst)
+
+
+class TestWindowedReceive(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.state = state.TFTPState(('127.0.0.1', 1234), proto.OP_WRQ,
+                                     self.root, 'dump.bin', 'octet')
+        self.state.set_opts({proto.TFTP_OPTION_BLKSIZE: 512,
+                             proto.TFTP_OPTION_WINDOWSIZE: 4})
+        self.state.file = Writer(self.state.filepath)
+        self.state.packetnum = 1
+        self.state.state = state.STATE_RECV
+
+    def tearDown(self):
+        if self.state.file:
+            self.state.file.abort()
+        for name in os.listdir(self.root):
+            os.remove(os.path.join(self.root, name))
+        os.rmdir(self.root)
+
+    def receive(self, num, size=512):
+        return self.state.receive(num, bytes([num]) * size)
+
+    def test_undefined_write_error(self):
+        class FailingWriter(object):
+            def write(self, data):
+                raise IOError('Write failed.')
+
+            def abort(self):
+                pass
+
+        self.state.file.abort()
+        self.state.file = FailingWriter()
+        self.assertEqual(
+                proto.TFTPHelper.createERROR(proto.ERROR_UNDEF),
+                self.receive(1)[1])
+        self.assertEqual(state.STATE_ERROR, self.state.state)
+
+    def check_file(self, blocks):
+        with open(self.state.filepath, 'rb') as f:
+            self.assertEqual(b''.join(bytes([num]) * size
+                                      for num, size in blocks), f.read())
+
+    def test_reordered(self):
+        self.assertEqual((state.DATA_AHEAD, None), self.receive(3))
+        self.assertEqual((state.DATA_AHEAD, None), self.receive(2))
+        self.assertEqual((state.DATA_NEXT, None), self.receive(1))
+        self.assertEqual((state.DATA_NEXT, proto.TFTPHelper.createACK(4)),
+                         self.receive(4))
+        self.assertEqual({1: 1, 2: 1}, self.state.reordered)
+        self.assertEqual((state.DATA_NEXT, proto.TFTPHelper.createACK(5)),
+                         self.receive(5, 10))
+        self.assertTrue(self.state.done)
+        self.check_file([(1, 512), (2, 512), (3, 512), (4, 512), (5, 10)])
+
+    def test_lost_block(self):
+        self.receive(1)
+        self.assertEqual((state.DATA_AHEAD, None), self.receive(3))
+        self.assertEqual((state.DATA_AHEAD, proto.TFTPHelper.createACK(1)),
+                         self.receive(4))
+
+        # The client resends its window from block 2.
+        self.assertEqual((state.DATA_NEXT, None), self.receive(2))
+        self.assertEqual((state.DATA_DUPLICATE, None), self.receive(3))
+        self.assertEqual((state.DATA_DUPLICATE, None), self.receive(4))
+        self.assertEqual((state.DATA_NEXT, proto.TFTPHelper.createACK(5)),
+                         self.receive(5, 0))
+        self.assertTrue(self.state.done)
+        self.check_file([(1, 512), (2, 512), (3, 512), (4, 512)])
+
+    def test_lost_ack(self):
+        for num in range(1, 5):
+            self.receive(num)
+        self.assertEqual((state.DATA_DUPLICATE,
+                          proto.TFTPHelper.createACK(4)), self.receive(4))
+
+    def test_lost_window_tail(self):
+        self.receive(1)
+        self.receive(3)
+        self.assertEqual([proto.TFTPHelper.createACK(1)],
+                         self.state.retransmit())
+
+    def test_outside_of_window(self):
+        outcome, packet = self.receive(9)
+        self.assertEqual(state.DATA_INVALID, outcome)
+        self.assertEqual(state.STATE_ERROR, self.state.state)
+        self.assertEqual(proto.TFTPHelper.createERROR(proto.ERROR_ILLEGAL_OP),
+                         packet)
+
+
+class TestClose(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        with open(os.path.join(self.root, 'MLO'), 'wb') as f:
+            f.write(b'x' * 1000)
+
+    def tearDown(self):
+        for name in os.listdir(self.root):
+            os.remove(os.path.join(self.root, name))
+        os.rmdir(self.root)
+
+    def test_slots_and_shared_options(self):
+        peer_state = state.TFTPState(('127.0.0.1', 1234), proto.OP_RRQ,
+                                     self.root, 'MLO', 'octet')
+        self.assertFalse(hasattr(peer_state, '__dict__'))
+        self.assertIs(state.STATE_DEFAULT_OPTS, peer_state.opts)
+        with self.assertRaises(TypeError):
+            peer_state.opts[proto.TFTP_OPTION_BLKSIZE] = 1024
+
+    def test_error_releases_file(self):
+        peer_state = state.TFTPState(('127.0.0.1', 1234), proto.OP_RRQ,
+                                     self.root, 'MLO', 'octet')
+        f = peer_state.file = open(peer_state.filepath, 'rb')
+        peer_state.state = state.STATE_ERROR
+        peer_state.error = proto.ERROR_ILLEGAL_OP
+        peer_state.next()
+        self.assertTrue(f.closed)
+        self.assertIsNone(peer_state.file)
+        peer_state.close()
+
+    def test_upload(self):
+        for done in (False, True):
+            peer_state = state.TFTPState(('127.0.0.1', 1234), proto.OP_WRQ,
+                                         self.root, 'log.txt', 'octet')
+            peer_state.file = Writer(peer_state.filepath)
+            peer_state.packetnum = 1
+            peer_state.state = state.STATE_RECV
+            if done:
+                peer_state.receive(1, b'log')
+            peer_state.close()
+            self.assertEqual(done, os.path.exists(peer_state.filepath))
+            self.assertEqual(sorted(['MLO', 'log.txt'][:1 + done]),
+                             sorted(os.listdir(self.root)))
@@ -0,0 +1,57 @@
+from unittest import TestCase
+from tftp import proto
+from tftp import state
+from tftp.timers import TimerWheel
+
+
+class TestTimerWheel(TestCase):
+    def test_fires_when_due(self):
+        wheel = TimerWheel(tick=0.1, slots=8)
+        fired = []
+        wheel.schedule(0.25, fired.append, 'a')
+        self.assertEqual(0, wheel.advance(wheel.time + 0.2))
+        self.assertEqual(1, wheel.advance(wheel.time + 0.1))
+        self.assertEqual(['a'], fired)
+
+    def test_cancel(self):
+        wheel = TimerWheel(tick=0.1, slots=8)
+        fired = []
+        timer = wheel.schedule(0.1, fired.append, 'a')
+        timer.cancel()
+        wheel.advance(wheel.time + 1)
+        self.assertEqual([], fired)
+
+    def test_more_than_one_turn(self):
+        wheel = TimerWheel(tick=0.1, slots=4)
+        fired = []
+        wheel.schedule(1.0, fired.append, 'a')
+        wheel.advance(wheel.time + 0.5)
+        self.assertEqual([], fired)
+        wheel.advance(wheel.time + 0.5)
+        self.assertEqual(['a'], fired)
+
+
+class TestRetransmit(TestCase):
+    def setUp(self):
+        self.state = state.TFTPState(('127.0.0.1', 1234), proto.OP_WRQ,
+                                     '/tmp', 'log.txt', 'octet')
+        self.state.state = state.STATE_RECV_ACK
+
+    def test_backoff(self):
+        packet = self.state.next()
+        self.assertEqual(state.STATE_RETRANSMIT_SECS, self.state.rto())
+        self.assertEqual([packet], self.state.retransmit())
+        self.assertEqual(2 * state.STATE_RETRANSMIT_SECS, self.state.rto())
+        self.assertEqual(1, self.state.retransmits)
+
+    def test_negotiated_timeout(self):
+        self.state.set_opts({proto.TFTP_OPTION_BLKSIZE: 512,
+                             proto.TFTP_OPTION_WINDOWSIZE: 1,
+                             proto.TFTP_OPTION_TIMEOUT: 3})
+        self.assertEqual(3, self.state.rto())
+
+    def test_gives_up(self):
+        self.state.next()
+        for _ in range(state.STATE_RETRIES_MAX):
+            self.assertIsNotNone(self.state.retransmit())
+        self.assertIsNone(self.state.retransmit())
@@ -0,0 +1,78 @@
+import os
+import struct
+import tempfile
+from unittest import TestCase
+from tftp import proto
+from tftp import trace
+from tftp.proto import TFTPHelper
+
+PEER = ('192.168.7.2', 1234)
+
+
+class TestTraceRing(TestCase):
+    def setUp(self):
+        self.ring = trace.TraceRing('test', '192.168.7.1', size=4)
+
+    def test_records(self):
+        request = TFTPHelper.createRRQ('a-rather-long-file-name.img',
+                                       'octet', {})
+        self.ring.record(trace.TRACE_IN, memoryview(request), PEER, 69)
+        self.ring.record(trace.TRACE_OUT,
+                         [proto.DATA_HEADER.pack(proto.OP_DATA, 1),
+                          bytes(512)], PEER, 40000)
+
+        (_, direction, peer, port, length, data), data_record = \
+            self.ring.records()
+        self.assertEqual((trace.TRACE_IN, PEER, 69, len(request)),
+                         (direction, peer, port, length))
+        self.assertEqual(request[:trace.TRACE_SNAP_LEN], data)
+        self.assertEqual((trace.TRACE_OUT, 40000, 516, b'\x00\x03\x00\x01'),
+                         (data_record[1], data_record[3], data_record[4],
+                          data_record[5]))
+
+    def test_wraps_around(self):
+        for num in range(10):
+            self.ring.record(trace.TRACE_IN, TFTPHelper.createACK(num), PEER,
+                             40000)
+        self.assertEqual([TFTPHelper.createACK(num) for num in range(6, 10)],
+                         [record[5] for record in self.ring.records()])
+
+    def test_pcap(self):
+        self.ring.record(trace.TRACE_IN, TFTPHelper.createACK(7), PEER, 40000)
+        self.ring.record(trace.TRACE_OUT, TFTPHelper.createERROR(5), PEER,
+                         40000)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace.pcap')
+            self.assertEqual(2, self.ring.dump(path))
+            with open(path, 'rb') as f:
+                pcap = f.read()
+
+        magic, _, _, _, _, _, linktype = struct.unpack_from('=IHHiIII', pcap)
+        self.assertEqual((0xa1b2c3d4, 101), (magic, linktype))
+
+        _, _, caplen, length = struct.unpack_from('=IIII', pcap, 24)
+        self.assertEqual((32, 32), (caplen, length))
+        packet = pcap[40:40 + caplen]
+        self.assertEqual(0, trace._checksum(packet[:20]))
+        self.assertEqual(b'\xc0\xa8\x07\x02\xc0\xa8\x07\x01', packet[12:20])
+        self.assertEqual((1234, 40000, 12), struct.unpack('!HHH',
+                                                          packet[20:26]))
+        self.assertEqual(TFTPHelper.createACK(7), packet[28:])
+
+        _, _, caplen, length = struct.unpack_from('=IIII', pcap, 40 + 32)
+        error = TFTPHelper.createERROR(5)
+        self.assertEqual((28 + trace.TRACE_SNAP_LEN, 28 + len(error)),
+                         (caplen, length))
+        packet = pcap[56 + 32:]
+        self.assertEqual((40000, 1234), struct.unpack('!HH', packet[20:24]))
+
+
+class TestTraceRings(TestCase):
+    def test_by_name(self):
+        ring = trace.get_trace_ring('test-usb0', '192.168.7.1')
+        self.assertIs(ring, trace.get_trace_ring('test-usb0', '192.168.7.1'))
+        self.assertEqual(b'\xc0\xa8\x07\x01', ring.address)
+
+        # The interface got another address.
+        self.assertIs(ring, trace.get_trace_ring('test-usb0', '192.168.8.1'))
+        self.assertEqual(b'\xc0\xa8\x08\x01', ring.address)
@@ -0,0 +1,82 @@
+import errno
+import os
+import tempfile
+from unittest import TestCase
+from tftp import proto
+from tftp import state
+from tftp.writer import Writer
+
+
+class TestWriter(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'backup.img')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_published_on_close(self):
+        writer = Writer(self.path, sync_bytes=1000)
+        writer.preallocate(100000)
+        for i in range(100):
+            writer.write(bytes([i]) * 512)
+        writer.flush()
+        self.assertFalse(os.path.exists(self.path))
+
+        writer.close()
+        with open(self.path, 'rb') as f:
+            self.assertEqual(b''.join(bytes([i]) * 512 for i in range(100)),
+                             f.read())
+        self.assertEqual(['backup.img'], os.listdir(self.dir.name))
+
+    def test_copies_receive_buffers(self):
+        buffer = bytearray(b'a' * 512)
+        writer = Writer(self.path)
+        writer.write(memoryview(buffer)[:256])
+        buffer[:] = b'b' * 512
+        writer.close()
+        with open(self.path, 'rb') as f:
+            self.assertEqual(b'a' * 256, f.read())
+
+    def test_abort(self):
+        writer = Writer(self.path)
+        writer.write(b'x' * 512)
+        writer.abort()
+        self.assertEqual([], os.listdir(self.dir.name))
+
+    def test_write_error(self):
+        writer = Writer(self.path)
+        os.close(writer.fd)
+        writer.fd = os.open(os.devnull, os.O_RDONLY)
+        writer.write(b'x' * 512)
+        with self.assertRaises(OSError) as cm:
+            writer.flush()
+        self.assertEqual(errno.EBADF, cm.exception.errno)
+        with self.assertRaises(OSError):
+            writer.write(b'x' * 512)
+        writer.abort()
+
+    def test_state_upload(self):
+        peer_state = state.TFTPState(('127.0.0.1', 1234), proto.OP_WRQ,
+                                     self.dir.name, 'backup.img', 'netascii')
+        peer_state.file = Writer(peer_state.filepath)
+        peer_state.packetnum = 1
+        peer_state.state = state.STATE_RECV
+        for data in (b'a' * 511 + b'\r', b'\n' + b'b' * 511, b'c\r\n'):
+            peer_state.data = data
+            peer_state.next()
+        self.assertTrue(peer_state.done)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(b'a' * 511 + b'\n' + b'b' * 511 + b'c\n',
+                             f.read())
+
+    def test_state_purge(self):
+        peer_state = state.TFTPState(('127.0.0.1', 1234), proto.OP_WRQ,
+                                     self.dir.name, 'backup.img', 'octet')
+        peer_state.file = Writer(peer_state.filepath)
+        peer_state.packetnum = 1
+        peer_state.state = state.STATE_RECV
+        peer_state.data = b'x' * 512
+        peer_state.next()
+        self.assertTrue(peer_state.purge())
+        self.assertEqual([], os.listdir(self.dir.name))
@@ -0,0 +1,140 @@
+# coding=utf-8
+# This file is part of pTFTPd.
+#
+# pTFTPd is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pTFTPd is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pTFTPd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Timer wheel scheduler.
+
+The TFTP server arms a retransmission timer for every flight of packets it
+sends, and cancels or re-arms it for every packet it receives. A hashed timer
+wheel makes scheduling and cancelling timers O(1), whatever the number of
+transfers in progress, at the cost of a bounded (one tick) firing imprecision.
+"""
+
+import math
+import threading
+import time
+
+from . import notify
+
+l = notify.getLogger('tftp-timers')
+
+# Resolution of the retransmission timers, in seconds.
+TIMER_TICK_SECS = 0.05
+
+# Number of slots of the wheel. Timers further away than one turn of the wheel
+# simply stay in their slot for more than one turn.
+TIMER_WHEEL_SLOTS = 256
+
+
+class Timer(object):
+    """A scheduled callback. Cancelled timers are dropped lazily, when the
+    wheel reaches their slot."""
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel(object):
+    """A thread-safe hashed timer wheel, driven by a monotonic clock."""
+
+    def __init__(self, tick=TIMER_TICK_SECS, slots=TIMER_WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = 0
+        self.start = time.monotonic()
+        self.time = self.start
+        self._lock = threading.Lock()
+
+    def schedule(self, delay, callback, *args):
+        """Schedule a callback.
+
+        Args:
+            delay (float): the delay after which the callback is called, in
+                seconds. It is rounded up to the next tick.
+            callback (callable): the function to call.
+            args: arguments to pass to the callback.
+        Returns:
+            The Timer object, which can be cancelled.
+        """
+
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        with self._lock:
+            timer = Timer(self.current + ticks, callback, args)
+            self.slots[timer.tick % len(self.slots)].append(timer)
+        return timer
+
+    def advance(self, now=None):
+        """Move the wheel forward to the given time, and call the callbacks
+        of the timers that expired in the meantime.
+
+        Args:
+            now (float): the current time.monotonic() value.
+        Returns:
+            The number of callbacks called.
+        """
+
+        if now is None:
+            now = time.monotonic()
+
+        # The wheel's time is derived from its tick count, rather than
+        # accumulated a tick at a time, which would drift, and a time within
+        # rounding error of a tick counts as having reached it.
+        ticks = int((now - self.start) / self.tick + 1e-6)
+
+        expired = []
+        with self._lock:
+            while self.current < ticks:
+                self.current += 1
+
+                index = self.current % len(self.slots)
+                pending = []
+                for timer in self.slots[index]:
+                    if timer.cancelled:
+                        continue
+                    if timer.tick <= self.current:
+                        expired.append(timer)
+                    else:
+                        pending.append(timer)
+                self.slots[index] = pending
+            self.time = self.start + self.current * self.tick
+
+        # Callbacks are called without the lock held, so that they can
+        # schedule new timers.
+        for timer in expired:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                l.exception('Timer callback failed.')
+        return len(expired)
+
+
+class TimerThread(threading.Thread):
+    """A thread driving a timer wheel."""
+
+    def __init__(self, wheel):
+        threading.Thread.__init__(self)
+        self.wheel = wheel
+        self.setDaemon(True)
+
+    def run(self):
+        while True:
+            time.sleep(self.wheel.tick)
+            self.wheel.advance()
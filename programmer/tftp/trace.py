@@ -0,0 +1,245 @@
+# coding=utf-8
+# This file is part of pTFTPd.
+#
+# pTFTPd is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pTFTPd is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pTFTPd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Always-on packet trace rings.
+
+Every TFTP packet sent or received by a server is recorded in a fixed-size
+ring buffer, one per network interface the peers are reached through, or per
+server address for peers of unknown interfaces, overwriting the
+oldest records once full. A record only holds the packet's timestamp,
+direction, length, peer, local port and first TRACE_SNAP_LEN bytes, which is
+enough for its opcode, block number, and most of a request's file name or an
+error message. Recording a packet is a single struct.pack_into() call into a
+preallocated buffer, cheap enough to be left enabled under load, unlike the
+protocol dump of proto._LOG_PROTO.
+
+The rings can be dumped on demand to pcap files readable by Wireshark, with
+dump_all(), or by sending the process the signal set up by
+install_signal_handler(). Packets are exported as raw IPv4/UDP datagrams,
+truncated to their recorded bytes.
+"""
+
+import itertools
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+
+from . import notify
+
+l = notify.getLogger('tftp-trace')
+
+# Number of packets recorded by a ring.
+TRACE_RING_SIZE = 4096
+
+# Number of bytes recorded from the start of each packet.
+TRACE_SNAP_LEN = 24
+
+# Packet directions.
+TRACE_IN = 0
+TRACE_OUT = 1
+
+# Record: sequence number, timestamp, direction, recorded length, local
+# port, packet length, peer port, peer address, followed by the recorded
+# bytes.
+_RECORD = struct.Struct('=QdBBHIH4s')
+_RECORD_SIZE = _RECORD.size + TRACE_SNAP_LEN
+
+# pcap file format, with raw IP packets (LINKTYPE_RAW).
+_PCAP_HEADER = struct.Struct('=IHHiIII')
+_PCAP_MAGIC = 0xa1b2c3d4
+_PCAP_LINKTYPE_RAW = 101
+_PCAP_RECORD = struct.Struct('=IIII')
+_IPV4_HEADER = struct.Struct('!BBHHHBBH4s4s')
+_UDP_HEADER = struct.Struct('!HHHH')
+_HEADERS_LEN = _IPV4_HEADER.size + _UDP_HEADER.size
+
+# Maximum number of packed peer addresses kept by a ring.
+_PEERS_MAX = 256
+
+
+def _checksum(header):
+    """Return the Internet checksum of an IPv4 header."""
+    total = sum(struct.unpack('!%dH' % (len(header) // 2), header))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+class TraceRing(object):
+    """A ring buffer of packet records."""
+
+    def __init__(self, name, address='0.0.0.0', size=TRACE_RING_SIZE):
+        """Creates an empty ring.
+
+        Args:
+            name (string): the name of the ring, used in the names of its
+                dumps.
+            address (string): the local IPv4 address of the recorded
+                packets.
+            size (int): the number of packets recorded.
+        """
+
+        self.name = name
+        self.address = socket.inet_aton(address)
+        self.size = size
+        self.buffer = bytearray(size * _RECORD_SIZE)
+        # Records are numbered by an atomic counter, so that threads can
+        # record packets without taking a lock.
+        self._seqs = itertools.count(1)
+        self._peers = {}                    # Peer IPs, packed
+
+    def record(self, direction, packet, peer, port):
+        """Record a packet.
+
+        Args:
+            direction (int): TRACE_IN or TRACE_OUT.
+            packet (bytes-like or list): the datagram, or a scatter/gather
+                vector of buffers.
+            peer (tuple): the (ip, port) of the peer.
+            port (int): the local port of the packet.
+        """
+
+        if type(packet) == list:
+            length = sum(len(buf) for buf in packet)
+            head = packet[0]
+        else:
+            length = len(packet)
+            head = packet
+        snap = min(len(head), TRACE_SNAP_LEN)
+
+        ip = self._peers.get(peer[0])
+        if ip is None:
+            if len(self._peers) >= _PEERS_MAX:
+                self._peers.clear()
+            ip = self._peers[peer[0]] = socket.inet_aton(peer[0])
+
+        seq = next(self._seqs)
+        offset = (seq % self.size) * _RECORD_SIZE
+        _RECORD.pack_into(self.buffer, offset, seq, time.time(), direction,
+                          snap, port, length, peer[1], ip)
+        offset += _RECORD.size
+        self.buffer[offset:offset + snap] = head[:snap]
+
+    def records(self):
+        """Return the recorded packets, oldest first, as (timestamp,
+        direction, peer, port, length, data) tuples."""
+        records = []
+        for offset in range(0, len(self.buffer), _RECORD_SIZE):
+            (seq, timestamp, direction, snap, port, length, peer_port,
+             ip) = _RECORD.unpack_from(self.buffer, offset)
+            if not seq:
+                continue
+            offset += _RECORD.size
+            records.append((seq, timestamp, direction,
+                            (socket.inet_ntoa(ip), peer_port), port, length,
+                            bytes(self.buffer[offset:offset + snap])))
+        records.sort()
+        return [record[1:] for record in records]
+
+    def dump(self, path):
+        """Write the recorded packets to a pcap file.
+
+        Returns:
+            The number of packets written.
+        """
+
+        records = self.records()
+        with open(path, 'wb') as f:
+            f.write(_PCAP_HEADER.pack(_PCAP_MAGIC, 2, 4, 0, 0,
+                                      _HEADERS_LEN + 65535,
+                                      _PCAP_LINKTYPE_RAW))
+            for ident, (timestamp, direction, peer, port, length,
+                        data) in enumerate(records):
+                f.write(_PCAP_RECORD.pack(
+                        int(timestamp), int(timestamp % 1 * 1000000),
+                        _HEADERS_LEN + len(data), _HEADERS_LEN + length))
+                f.write(self._headers(ident, direction, peer, port, length))
+                f.write(data)
+        return len(records)
+
+    def _headers(self, ident, direction, peer, port, length):
+        """Build the IPv4 and UDP headers of a recorded packet."""
+        src, sport = socket.inet_aton(peer[0]), peer[1]
+        dst, dport = self.address, port
+        if direction == TRACE_OUT:
+            src, sport, dst, dport = dst, dport, src, sport
+
+        total = _HEADERS_LEN + length
+        ip = _IPV4_HEADER.pack(0x45, 0, min(total, 0xffff), ident & 0xffff,
+                               0, 64, socket.IPPROTO_UDP, 0, src, dst)
+        ip = ip[:10] + struct.pack('!H', _checksum(ip)) + ip[12:]
+        # A zero UDP checksum stands for no checksum.
+        return ip + _UDP_HEADER.pack(sport, dport,
+                                     min(_UDP_HEADER.size + length, 0xffff),
+                                     0)
+
+
+_rings = {}
+_rings_lock = threading.Lock()
+
+
+def get_trace_ring(name, address=None):
+    """Return the trace ring of the given name, e.g. the name of an
+    interface, creating it if needed.
+
+    Args:
+        name (string): the name of the ring.
+        address (string): the local IPv4 address of the packets recorded by
+            the ring, if known. The address of an existing ring is updated.
+    """
+    with _rings_lock:
+        ring = _rings.get(name)
+        if ring is None:
+            ring = _rings[name] = TraceRing(name, address or '0.0.0.0')
+        elif address is not None:
+            ring.address = socket.inet_aton(address)
+        return ring
+
+
+def dump_all(directory):
+    """Dump all the trace rings to pcap files in the given directory.
+
+    Returns:
+        The list of the written files.
+    """
+
+    with _rings_lock:
+        rings = list(_rings.values())
+
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    paths = []
+    for ring in rings:
+        path = os.path.join(directory, 'tftp-%s-%s.pcap' % (ring.name, stamp))
+        count = ring.dump(path)
+        l.info('Dumped %d packet(s) to %s.', count, path)
+        paths.append(path)
+    return paths
+
+
+def install_signal_handler(directory, signum=signal.SIGUSR1):
+    """Dump all the trace rings to the given directory whenever the process
+    receives the given signal. Must be called from the main thread."""
+
+    def handler(signum, frame):
+        try:
+            dump_all(directory)
+        except OSError as e:
+            l.error('Could not dump the packet traces: %s', e)
+
+    signal.signal(signum, handler)
@@ -0,0 +1,231 @@
+# coding=utf-8
+# This file is part of pTFTPd.
+#
+# pTFTPd is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pTFTPd is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pTFTPd.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Write-behind file writer for TFTP uploads.
+
+Uploaded blocks are handed to a writer thread instead of being written by the
+thread serving the transfer, so that a slow SD card does not delay the ACK
+the client waits for before sending its next block. Blocks queued for the
+same file are written together with a single writev() call.
+
+Uploads are written to a temporary file next to their destination, which
+can be preallocated from the transfer size announced by the client, and which
+is only renamed to its final name once complete. Failed uploads never leave a
+partial file behind.
+
+Write errors are reported by the next call to write(), or by close().
+"""
+
+import errno
+import itertools
+import os
+import queue
+import threading
+
+from . import notify
+
+l = notify.getLogger('tftp-writer')
+
+# Maximum number of blocks written by a single writev() call.
+WRITER_BATCH_MAX = 64
+
+# Errors meaning the file does not fit on the disk.
+DISK_FULL_ERRNOS = (errno.ENOSPC, errno.EDQUOT, errno.EFBIG)
+
+# Suffixes of the temporary files of uploads in progress.
+_tmp_ids = itertools.count()
+
+
+def _writev(fd, buffers):
+    """Write all the given buffers, returning the number of bytes written."""
+    total = sum(len(b) for b in buffers)
+    written = os.writev(fd, buffers)
+    if written < total:
+        rest = memoryview(b''.join(buffers))[written:]
+        while rest:
+            rest = rest[os.write(fd, rest):]
+    return total
+
+
+class WriterThread(threading.Thread):
+    """The thread writing the queued blocks of all uploads."""
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.queue = queue.Queue()
+        self.daemon = True
+
+    def submit(self, writer, data):
+        self.queue.put((writer, data))
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            try:
+                while len(items) < WRITER_BATCH_MAX:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            for writer, group in itertools.groupby(items,
+                                                   key=lambda item: item[0]):
+                writer._write([data for _, data in group])
+
+
+_writer_thread = None
+_writer_thread_lock = threading.Lock()
+
+
+def get_writer_thread():
+    """Return the process-wide writer thread, starting it if needed."""
+    global _writer_thread
+    with _writer_thread_lock:
+        if _writer_thread is None:
+            _writer_thread = WriterThread()
+            _writer_thread.start()
+        return _writer_thread
+
+
+class Writer(object):
+    """A file being uploaded, written behind by the writer thread."""
+
+    def __init__(self, path, fsync=True, sync_bytes=0):
+        """Creates the temporary file of a new upload.
+
+        Args:
+            path (string): the final path of the uploaded file.
+            fsync (boolean): whether to sync the file to disk before
+                publishing it.
+            sync_bytes (int): sync the written data to disk every time this
+                many bytes have been written, or never if 0.
+        Throws:
+            IOError/OSError if the temporary file cannot be created.
+        """
+
+        self.path = path
+        self.fsync = fsync
+        self.sync_bytes = sync_bytes
+
+        directory, name = os.path.split(path)
+        self.tmppath = os.path.join(directory, '.%s.%d.%d.part' % (
+                name, os.getpid(), next(_tmp_ids)))
+        self.fd = os.open(self.tmppath, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                          0o666)
+
+        self.written = 0                    # Bytes written to the file
+        self.unsynced = 0                   # Bytes written since last sync
+        self.pending = 0                    # Blocks queued, not written yet
+        self.error = None                   # Error of a failed write
+        self._cond = threading.Condition()
+        self._thread = get_writer_thread()
+
+    def preallocate(self, size):
+        """Allocate the disk space of the file ahead of its upload.
+
+        Args:
+            size (int): the announced size of the file, in bytes.
+        Throws:
+            OSError with one of DISK_FULL_ERRNOS if the file does not fit.
+        """
+
+        if not size or not hasattr(os, 'posix_fallocate'):
+            return
+
+        try:
+            os.posix_fallocate(self.fd, 0, size)
+        except OSError as e:
+            if e.errno in DISK_FULL_ERRNOS:
+                raise
+            # The filesystem does not support it, do without.
+            l.debug('Could not preallocate %s: %s', self.path, e)
+
+    def write(self, data):
+        """Queue a block to be written. The data is copied, as it may be a
+        view of a receive buffer.
+
+        Throws:
+            IOError/OSError if a previous block could not be written.
+        """
+
+        if self.error is not None:
+            raise self.error
+
+        with self._cond:
+            self.pending += 1
+        self._thread.submit(self, bytes(data))
+
+    def _write(self, buffers):
+        """Write blocks, on the writer thread."""
+        try:
+            if self.error is None and self.fd is not None:
+                written = _writev(self.fd, buffers)
+                self.written += written
+                self.unsynced += written
+                if self.sync_bytes and self.unsynced >= self.sync_bytes:
+                    os.fdatasync(self.fd)
+                    self.unsynced = 0
+        except OSError as e:
+            self.error = e
+        finally:
+            with self._cond:
+                self.pending -= len(buffers)
+                self._cond.notify_all()
+
+    def flush(self):
+        """Wait for the queued blocks to be written.
+
+        Throws:
+            IOError/OSError if a block could not be written.
+        """
+
+        with self._cond:
+            while self.pending:
+                self._cond.wait()
+
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Complete the upload, and publish the file under its final name.
+
+        Throws:
+            IOError/OSError if the file could not be completed, in which case
+            abort() should be called.
+        """
+
+        self.flush()
+
+        # Drop the preallocated space that was not used.
+        os.ftruncate(self.fd, self.written)
+        if self.fsync:
+            os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.tmppath, self.path)
+
+    def abort(self):
+        """Abandon the upload, removing its temporary file."""
+        with self._cond:
+            while self.pending:
+                self._cond.wait()
+            fd, self.fd = self.fd, None
+
+        if fd is not None:
+            os.close(fd)
+        try:
+            os.remove(self.tmppath)
+        except OSError:
+            pass